@@ -5,14 +5,31 @@ JOBB 0: Ladda Bronze-lagret (0_Load_Bronze_Data.py)
 Syfte: Kopiera ALLA rådata-tabeller från MariaDB till MSSQL (Bronze).
 Strategi:
   - Stora tabeller (CDR, Cases): Inkrementell laddning (baserat på Created).
-  - Små tabeller (Customers, Queues, Users): Full laddning (Truncate/Insert).
+    Vattenstämpel per tabell i en state-tabell (Bronze_Load_Watermarks) och
+    idempotent MERGE på den naturliga nyckeln (CallId + Created, CaseId). Nyckeln måste
+    vara unik per rad; dubbletter avbryter laddningen (BRONZE_KEY_COLS åsidosätter).
+    Läsning (MariaDB) och skrivning (MSSQL) överlappar via en begränsad kö,
+    med adaptiv batchstorlek.
+  - First-Touch-tabell (Bronze_Call_First_Touch): en rad per CallId, uppdateras
+    bara för de CallIds som berörs av varje CDR-batch (läses direkt av Jobb 1).
+  - Små tabeller (Customers, Queues, Users): Full laddning, men bara om källans
+    fingeravtryck (antal rader + checksumma) har ändrats. Ändringar appliceras
+    som rad-diff (MERGE) så att index och statistik behålls.
+  - Parallellt läge: Oberoende jobb körs i en begränsad trådpool
+    (config.BRONZE_MAX_CONCURRENT_JOBS, max config.BRONZE_MAX_JOBS_PER_SOURCE
+    samtidiga jobb per källdatabas). Motorer delas per anslutningssträng.
 """
 
 import pandas as pd
 from sqlalchemy import create_engine, text
 import config
+from DataDriven_utils import bulk_write, first_touch_sql, sql_column_types
 import sys
+import time
+import queue
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Konfiguration för Bronze-laddning
 BRONZE_JOBS = [
@@ -22,14 +39,17 @@ BRONZE_JOBS = [
         "source_table": "queue_cdr",
         "target_table": "Bronze_Queue_CDR",
         "load_type": "INCREMENTAL",
-        "time_col": "Created"
+        "time_col": "Created",
+        "key_cols": ["CallId", "Created"],
+        "maintain_first_touch": True
     },
     {
         "source_db_conn": config.CASE_DB_CONN_STR,
         "source_table": "cases",
         "target_table": "Bronze_Cases",
         "load_type": "INCREMENTAL",
-        "time_col": "Created"
+        "time_col": "Created",
+        "key_cols": ["CaseId"]
     },
     
     # --- SMÅ TABELLER (Full Load - Ersätt allt) ---
@@ -37,93 +57,490 @@ BRONZE_JOBS = [
         "source_db_conn": config.BILLING_DB_CONN_STR,
         "source_table": "customers",
         "target_table": "Bronze_Billing_Customers",
-        "load_type": "FULL"
+        "load_type": "FULL",
+        "key_cols": ["CustomerId"]
     },
     {
         "source_db_conn": config.QUEUE_DB_CONN_STR,
         "source_table": "queuegroups",
         "target_table": "Bronze_Queue_Groups",
-        "load_type": "FULL"
+        "load_type": "FULL",
+        "key_cols": ["ID"]
     },
     {
         "source_db_conn": config.CASE_DB_CONN_STR,
         "source_table": "users",
         "target_table": "Bronze_Case_Users",
-        "load_type": "FULL"
+        "load_type": "FULL",
+        "key_cols": ["UserId"]
     }
 ]
 
-def sync_bronze_layer():
+# Nyckeln måste vara unik per rad i källan. Per måltabell kan den åsidosättas,
+# t.ex. {'Bronze_Queue_CDR': ['CallId', 'LegId']} om källan har ett ben-/rad-id.
+KEY_COLS_OVERRIDE = getattr(config, 'BRONZE_KEY_COLS', {})
+# Minsta längd för nyckelkolumner av strängtyp (NVARCHAR(n), indexerbar)
+KEY_STRING_LENGTH = getattr(config, 'BRONZE_KEY_STRING_LENGTH', 128)
+
+# Parallellitet (1 = seriell körning som tidigare)
+MAX_CONCURRENT_JOBS = getattr(config, 'BRONZE_MAX_CONCURRENT_JOBS', 1)
+# Skyddar MariaDB-källorna: max antal samtidiga jobb mot samma källdatabas
+MAX_JOBS_PER_SOURCE = getattr(config, 'BRONZE_MAX_JOBS_PER_SOURCE', 1)
+
+def create_source_engines(jobs, pool_size):
+    """ Skapar EN motor per unik källa (anslutningssträng) som delas mellan jobben. """
+    engines = {}
+    for job in jobs:
+        conn_str = job['source_db_conn']
+        if conn_str not in engines:
+            engines[conn_str] = create_engine(conn_str, pool_size=pool_size, pool_pre_ping=True)
+    return engines
+
+# State-tabell för inkrementella laddningar (en rad per committad batch)
+WATERMARK_TABLE = config.TABLE_NAMES.get('Bronze_Watermarks', 'Bronze_Load_Watermarks')
+
+def ensure_watermark_table(mssql_engine):
+    with mssql_engine.begin() as conn:
+        conn.execute(text(f"""
+            IF OBJECT_ID('{WATERMARK_TABLE}', 'U') IS NULL
+            CREATE TABLE [{WATERMARK_TABLE}] (
+                BatchId BIGINT IDENTITY(1,1) PRIMARY KEY,
+                TargetTable NVARCHAR(128) NOT NULL,
+                HighWatermark DATETIME2 NOT NULL,
+                MinCreated DATETIME2 NULL,
+                MinKey NVARCHAR(128) NULL,
+                MaxKey NVARCHAR(128) NULL,
+                RowsLoaded INT NOT NULL,
+                LoadedAt DATETIME2 NOT NULL DEFAULT SYSDATETIME()
+            );
+        """))
+
+def get_watermark(mssql_engine, target_table, time_col, log=print):
+    """
+    Hämtar senaste committade vattenstämpel för tabellen.
+    Finns ingen (första körningen) görs EN bootstrap via MAX(time_col).
+    """
+    df_wm = pd.read_sql(
+        text(f"SELECT TOP 1 HighWatermark FROM [{WATERMARK_TABLE}] WHERE TargetTable = :t ORDER BY BatchId DESC"),
+        mssql_engine, params={'t': target_table}
+    )
+    if not df_wm.empty and pd.notna(df_wm.iloc[0]['HighWatermark']):
+        return df_wm.iloc[0]['HighWatermark']
+
+    try:
+        check_sql = f"SELECT MAX({time_col}) as last_entry FROM [{target_table}]"
+        # Obs: Detta kastar fel om tabellen inte finns, vilket vi fångar
+        df_max = pd.read_sql(check_sql, mssql_engine)
+        if not df_max.empty and pd.notna(df_max.iloc[0]['last_entry']):
+            log("   -> Ingen vattenstämpel ännu, bootstrap från MAX i Bronze.")
+            return df_max.iloc[0]['last_entry']
+    except:
+        pass
+    return None
+
+def ensure_target_table(mssql_engine, chunk, target_table, key_cols):
+    """
+    Skapar måltabellen och ett index på nyckeln om de saknas. Typerna härleds som i
+    bulk_write (hela batchen); nyckelkolumner av strängtyp blir NVARCHAR(n) så att de går att indexera.
+    """
+    dtype = sql_column_types(chunk, bounded_cols=key_cols, min_length=KEY_STRING_LENGTH)
+    chunk.head(0).to_sql(target_table, mssql_engine, if_exists='append', index=False, dtype=dtype)
+    key_list = ", ".join([f"[{c}]" for c in key_cols])
+    with mssql_engine.begin() as conn:
+        conn.execute(text(f"""
+            IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_{target_table}_Key' AND object_id = OBJECT_ID('{target_table}'))
+            CREATE INDEX [IX_{target_table}_Key] ON [{target_table}] ({key_list});
+        """))
+
+def merge_from_staging(conn, target_table, staging_table, columns, key_cols, delete_missing=False):
+    """
+    MERGE från STAGING till måltabellen på nyckeln.
+    - Uppdaterar bara rader där något värde faktiskt skiljer (NULL-säkert via EXCEPT).
+    - delete_missing=True: rader som saknas i källan tas bort (full rad-diff).
+    Returnerar antal INSERT/UPDATE/DELETE.
+    """
+    on_clause = " AND ".join([f"t.[{c}] = s.[{c}]" for c in key_cols])
+    value_cols = [c for c in columns if c not in key_cols]
+    all_cols = ", ".join([f"[{c}]" for c in columns])
+    src_cols = ", ".join([f"s.[{c}]" for c in columns])
+    update_clause = ""
+    if value_cols:
+        s_vals = ", ".join([f"s.[{c}]" for c in value_cols])
+        t_vals = ", ".join([f"t.[{c}]" for c in value_cols])
+        update_clause = (f"WHEN MATCHED AND EXISTS (SELECT {s_vals} EXCEPT SELECT {t_vals}) THEN UPDATE SET "
+                         + ", ".join([f"t.[{c}] = s.[{c}]" for c in value_cols]))
+    delete_clause = "WHEN NOT MATCHED BY SOURCE THEN DELETE" if delete_missing else ""
+
+    rows = conn.execute(text(f"""
+        MERGE [{target_table}] AS t
+        USING [{staging_table}] AS s ON {on_clause}
+        {update_clause}
+        WHEN NOT MATCHED BY TARGET THEN INSERT ({all_cols}) VALUES ({src_cols})
+        {delete_clause}
+        OUTPUT $action;
+    """)).fetchall()
+    actions = {'INSERT': 0, 'UPDATE': 0, 'DELETE': 0}
+    for row in rows:
+        actions[row[0]] += 1
+    return actions
+
+# Materialiserad First-Touch per CallId (läses av Jobb 1 istället för fönsterfunktionerna)
+FIRST_TOUCH_TABLE = config.BRONZE_TABLES.get('first_touch', 'Bronze_Call_First_Touch')
+
+def refresh_first_touch(conn, target_table, staging_table):
+    """
+    Räknar om First-Touch för de CallIds som finns i batchen (alla deras ben i Bronze).
+    Första gången byggs tabellen från hela Bronze CDR.
+    """
+    if conn.execute(text(f"SELECT OBJECT_ID('{FIRST_TOUCH_TABLE}', 'U')")).scalar() is None:
+        conn.execute(text(first_touch_sql(f"SELECT * FROM [{target_table}]", select_into=FIRST_TOUCH_TABLE)))
+        conn.execute(text(f"CREATE CLUSTERED INDEX [IX_{FIRST_TOUCH_TABLE}_Created] ON [{FIRST_TOUCH_TABLE}] (Created)"))
+        conn.execute(text(f"CREATE UNIQUE INDEX [IX_{FIRST_TOUCH_TABLE}_CallId] ON [{FIRST_TOUCH_TABLE}] (CallId)"))
+        return
+
+    touched = f"SELECT DISTINCT CallId FROM [{staging_table}]"
+    conn.execute(text(f"DELETE FROM [{FIRST_TOUCH_TABLE}] WHERE CallId IN ({touched})"))
+    conn.execute(text(first_touch_sql(
+        f"SELECT * FROM [{target_table}] WHERE CallId IN ({touched})",
+        insert_into=FIRST_TOUCH_TABLE
+    )))
+
+def unique_on_key(df, key_cols, target_table):
+    """
+    MERGE kräver EN rad per nyckel i batchen. Helt identiska rader tas bort; olika rader
+    med samma nyckel (t.ex. två ben i samma CallId med samma Created) slängs inte tyst,
+    utan jobbet avbryts så att nyckeln kan rättas (config.BRONZE_KEY_COLS).
+    """
+    df = df.drop_duplicates()
+    dup = df.duplicated(subset=key_cols, keep=False)
+    if dup.any():
+        examples = df.loc[dup, key_cols].drop_duplicates().head(3).to_dict('records')
+        raise ValueError(f"{int(dup.sum())} rader i {target_table} delar nyckeln {key_cols} men skiljer sig "
+                         f"i övriga kolumner (t.ex. {examples}). Ange en unik nyckel i config.BRONZE_KEY_COLS.")
+    return df
+
+def upsert_batch(mssql_engine, chunk, target_table, key_cols, time_col, after_merge=None):
+    """
+    Idempotent skrivning av en batch: STAGING -> MERGE på nyckeln, och
+    vattenstämpeln registreras i SAMMA transaktion som MERGE.
+    after_merge(conn, target_table, staging_table) körs i samma transaktion
+    (t.ex. refresh_first_touch).
+    Returnerar antal NYA (insatta) rader.
+    """
+    chunk = unique_on_key(chunk, key_cols, target_table)
+    staging_table = f"{target_table}_STAGING"
+    bulk_write(chunk, staging_table, mssql_engine, if_exists='replace')
+
+    first_key = chunk[key_cols[0]]
+    with mssql_engine.begin() as conn:
+        actions = merge_from_staging(conn, target_table, staging_table, list(chunk.columns), key_cols)
+        if after_merge is not None:
+            after_merge(conn, target_table, staging_table)
+        conn.execute(text(f"""
+            INSERT INTO [{WATERMARK_TABLE}] (TargetTable, HighWatermark, MinCreated, MinKey, MaxKey, RowsLoaded)
+            VALUES (:t, :hw, :lo, :kmin, :kmax, :n)
+        """), {
+            't': target_table,
+            'hw': pd.to_datetime(chunk[time_col].max()).to_pydatetime(),
+            'lo': pd.to_datetime(chunk[time_col].min()).to_pydatetime(),
+            'kmin': str(first_key.min()), 'kmax': str(first_key.max()),
+            'n': len(chunk)
+        })
+    return actions['INSERT']
+
+# Fingeravtryck för FULL-tabeller (en rad per måltabell)
+FINGERPRINT_TABLE = config.TABLE_NAMES.get('Bronze_Fingerprints', 'Bronze_Load_Fingerprints')
+# 'DIFF' = rad-diff via MERGE (behåller index/statistik), 'REPLACE' = gamla beteendet
+FULL_LOAD_MODE = getattr(config, 'BRONZE_FULL_LOAD_MODE', 'DIFF').upper()
+
+def get_source_fingerprint(source_engine, source_table, updated_col=None):
+    """ Billigt fingeravtryck i källan: antal rader + MariaDB CHECKSUM TABLE (+ ev. MAX(updated_col)). """
+    with source_engine.connect() as conn:
+        row_count = conn.execute(text(f"SELECT COUNT(*) FROM {source_table}")).scalar()
+        checksum = conn.execute(text(f"CHECKSUM TABLE {source_table}")).fetchone()[1]
+        max_updated = conn.execute(text(f"SELECT MAX({updated_col}) FROM {source_table}")).scalar() if updated_col else None
+    return f"{row_count}|{checksum}|{max_updated}"
+
+def get_stored_fingerprint(mssql_engine, target_table):
+    with mssql_engine.begin() as conn:
+        conn.execute(text(f"""
+            IF OBJECT_ID('{FINGERPRINT_TABLE}', 'U') IS NULL
+            CREATE TABLE [{FINGERPRINT_TABLE}] (
+                TargetTable NVARCHAR(128) NOT NULL PRIMARY KEY,
+                Fingerprint NVARCHAR(256) NOT NULL,
+                UpdatedAt DATETIME2 NOT NULL DEFAULT SYSDATETIME()
+            );
+        """))
+        return conn.execute(
+            text(f"SELECT Fingerprint FROM [{FINGERPRINT_TABLE}] WHERE TargetTable = :t"), {'t': target_table}
+        ).scalar()
+
+def save_fingerprint(mssql_engine, target_table, fingerprint):
+    with mssql_engine.begin() as conn:
+        conn.execute(text(f"""
+            MERGE [{FINGERPRINT_TABLE}] AS t
+            USING (SELECT :t AS TargetTable, :f AS Fingerprint) AS s ON t.TargetTable = s.TargetTable
+            WHEN MATCHED THEN UPDATE SET Fingerprint = s.Fingerprint, UpdatedAt = SYSDATETIME()
+            WHEN NOT MATCHED THEN INSERT (TargetTable, Fingerprint) VALUES (s.TargetTable, s.Fingerprint);
+        """), {'t': target_table, 'f': fingerprint})
+
+def get_target_columns(mssql_engine, target_table):
+    """ Kolumnerna i måltabellen, eller None om tabellen inte finns. """
+    with mssql_engine.connect() as conn:
+        if conn.execute(text(f"SELECT OBJECT_ID('{target_table}', 'U')")).scalar() is None:
+            return None
+    return list(pd.read_sql(f"SELECT TOP 0 * FROM [{target_table}]", mssql_engine).columns)
+
+# Pipelinat läge: läsare och skrivare i olika trådar med en begränsad kö emellan
+STREAMING_MODE = getattr(config, 'BRONZE_STREAMING_MODE', True)
+PIPELINE_QUEUE_SIZE = getattr(config, 'BRONZE_PIPELINE_QUEUE_SIZE', 2)
+CHUNK_ROWS_START = 50000
+CHUNK_ROWS_MIN = 5000
+CHUNK_ROWS_MAX = 500000
+# Mål per batch: ungefärlig minnesstorlek och skrivtid
+CHUNK_TARGET_MB = getattr(config, 'BRONZE_CHUNK_TARGET_MB', 64)
+CHUNK_TARGET_WRITE_SEC = getattr(config, 'BRONZE_CHUNK_TARGET_WRITE_SEC', 10)
+
+def next_chunk_rows(bytes_per_row, write_rows_per_sec):
+    """ Batchstorlek utifrån observerad radbredd och skrivhastighet. """
+    rows = CHUNK_ROWS_MAX
+    if bytes_per_row:
+        rows = min(rows, int(CHUNK_TARGET_MB * 1024 * 1024 / bytes_per_row))
+    if write_rows_per_sec:
+        rows = min(rows, int(write_rows_per_sec * CHUNK_TARGET_WRITE_SEC))
+    return max(CHUNK_ROWS_MIN, rows)
+
+def stream_incremental_load(query, source_engine, mssql_engine, target_table, key_cols, time_col, log=print, after_merge=None):
+    """
+    Producent/konsument: en läsartråd hämtar batchar från källan (server-side cursor)
+    medan huvudtråden skriver (upsert + vattenstämpel) föregående batch.
+    Kön är begränsad -> läsaren väntar (backpressure) om skrivningen inte hinner med.
+    Batcharna skrivs i ordning så vattenstämpeln förblir korrekt.
+    """
+    batches = queue.Queue(maxsize=max(1, PIPELINE_QUEUE_SIZE))
+    stop = threading.Event()
+    END = object()
+    stats = {'read_sec': 0.0, 'put_wait_sec': 0.0, 'get_wait_sec': 0.0, 'write_sec': 0.0,
+             'bytes_per_row': None, 'write_rows_per_sec': None}
+
+    def put(item):
+        # Backpressure: blockera tills kön har plats (men avbryt om skrivaren fallerat)
+        t0 = time.perf_counter()
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=1)
+                break
+            except queue.Full:
+                continue
+        stats['put_wait_sec'] += time.perf_counter() - t0
+
+    def reader():
+        try:
+            with source_engine.connect().execution_options(stream_results=True) as conn:
+                result = conn.execute(text(query))
+                columns = list(result.keys())
+                chunk_rows = CHUNK_ROWS_START
+                while not stop.is_set():
+                    t0 = time.perf_counter()
+                    rows = result.fetchmany(chunk_rows)
+                    if not rows:
+                        break
+                    chunk = pd.DataFrame.from_records(rows, columns=columns)
+                    stats['read_sec'] += time.perf_counter() - t0
+                    stats['bytes_per_row'] = chunk.memory_usage(deep=True).sum() / len(chunk)
+                    put(chunk)
+                    chunk_rows = next_chunk_rows(stats['bytes_per_row'], stats['write_rows_per_sec'])
+        except Exception as e:
+            put(e)
+            return
+        put(END)
+
+    reader_thread = threading.Thread(target=reader, name=f"reader-{target_table}", daemon=True)
+    reader_thread.start()
+
+    rows_count = 0
+    rows_read = 0
+    table_ready = False
+    try:
+        while True:
+            t0 = time.perf_counter()
+            chunk = batches.get()
+            stats['get_wait_sec'] += time.perf_counter() - t0
+            if chunk is END:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+
+            t0 = time.perf_counter()
+            if not table_ready:
+                ensure_target_table(mssql_engine, chunk, target_table, key_cols)
+                table_ready = True
+            new_rows = upsert_batch(mssql_engine, chunk, target_table, key_cols, time_col, after_merge=after_merge)
+            write_sec = time.perf_counter() - t0
+            stats['write_sec'] += write_sec
+            stats['write_rows_per_sec'] = len(chunk) / max(write_sec, 1e-6)
+            rows_count += new_rows
+            rows_read += len(chunk)
+            log(f"   -> Laddat {len(chunk)} rader, {new_rows} nya (t.o.m. {chunk[time_col].max()}) "
+                f"| totalt {rows_read} | kö {batches.qsize()}/{batches.maxsize} "
+                f"| {stats['bytes_per_row']:.0f} B/rad, {stats['write_rows_per_sec']:.0f} rader/s")
+    finally:
+        stop.set()
+        reader_thread.join(timeout=30)
+
+    # Tidsfördelning per steg: väntar skrivaren på läsaren (källan är flaskhals) eller tvärtom?
+    log(f"   -> Tider: läsning {stats['read_sec']:.1f}s, skrivning {stats['write_sec']:.1f}s, "
+        f"läsare väntade (backpressure) {stats['put_wait_sec']:.1f}s, skrivare väntade {stats['get_wait_sec']:.1f}s")
+    return rows_count
+
+def sync_bronze_job(job, source_engine, mssql_engine, log=print):
+    """
+    Synkar EN tabell (INCREMENTAL eller FULL).
+    Returnerar antal laddade rader. Fel kastas vidare till anroparen.
+    """
+    target_table = job['target_table']
+    source_table = job['source_table']
+    load_type = job['load_type']
+    rows_count = 0
+
+    if load_type == 'INCREMENTAL':
+        # 1. Hitta vattenstämpel (ingen full scan av Bronze)
+        time_col = job['time_col']
+        key_cols = KEY_COLS_OVERRIDE.get(target_table, job['key_cols'])
+        ensure_watermark_table(mssql_engine)
+        last_date = get_watermark(mssql_engine, target_table, time_col, log=log)
+        if last_date is not None:
+            log(f"   -> Vattenstämpel i Bronze: {last_date}")
+        else:
+            log("   -> Tabellen finns inte eller är tom. Kör full historik.")
+
+        # 2. Hämta data från och med vattenstämpeln ('>=' så att rader med samma
+        #    tidsstämpel som gränsen aldrig tappas; MERGE gör omkörningen idempotent)
+        if last_date is not None:
+            query = f"SELECT * FROM {source_table} WHERE {time_col} >= '{last_date}' ORDER BY {time_col}"
+        else:
+            query = f"SELECT * FROM {source_table} ORDER BY {time_col}"
+
+        # 3. Spara (Upsert per batch + vattenstämpel [+ First-Touch])
+        after_merge = refresh_first_touch if job.get('maintain_first_touch') else None
+        if STREAMING_MODE:
+            rows_count = stream_incremental_load(query, source_engine, mssql_engine, target_table, key_cols, time_col,
+                                                 log=log, after_merge=after_merge)
+        else:
+            table_ready = False
+            for chunk in pd.read_sql(query, source_engine, chunksize=CHUNK_ROWS_START):
+                if not table_ready:
+                    ensure_target_table(mssql_engine, chunk, target_table, key_cols)
+                    table_ready = True
+                new_rows = upsert_batch(mssql_engine, chunk, target_table, key_cols, time_col, after_merge=after_merge)
+                rows_count += new_rows
+                log(f"   -> Laddat {len(chunk)} rader, {new_rows} nya (t.o.m. {chunk[time_col].max()})...")
+        
+        if rows_count == 0:
+            log("   -> Inga nya rader.")
+        else:
+            log(f"   -> KLART! Totalt {rows_count} nya rader.")
+
+    elif load_type == 'FULL':
+        # 1. Jämför källans fingeravtryck med det senast sparade
+        fingerprint = get_source_fingerprint(source_engine, source_table, job.get('updated_col'))
+        target_cols = get_target_columns(mssql_engine, target_table)
+        if target_cols is not None and fingerprint == get_stored_fingerprint(mssql_engine, target_table):
+            log("   -> Oförändrad sedan förra körningen. Hoppar över.")
+            return 0
+
+        # 2. För små register: Hämta allt
+        query = f"SELECT * FROM {source_table}"
+        df_full = pd.read_sql(query, source_engine)
+        
+        if df_full.empty:
+            log("   -> VARNING: Källtabellen var tom.")
+            return 0
+
+        key_cols = KEY_COLS_OVERRIDE.get(target_table, job.get('key_cols'))
+        can_diff = (FULL_LOAD_MODE == 'DIFF' and key_cols and target_cols is not None
+                    and set(target_cols) == set(df_full.columns))
+
+        if can_diff:
+            # 3a. Rad-diff: bara ändrade/nya/borttagna rader rörs
+            df_full = unique_on_key(df_full, key_cols, target_table)
+            staging_table = f"{target_table}_STAGING"
+            bulk_write(df_full, staging_table, mssql_engine, if_exists='replace')
+            with mssql_engine.begin() as conn:
+                actions = merge_from_staging(conn, target_table, staging_table, list(df_full.columns), key_cols, delete_missing=True)
+            rows_count = actions['INSERT'] + actions['UPDATE'] + actions['DELETE']
+            log(f"   -> KLART! Diff: {actions['INSERT']} nya, {actions['UPDATE']} ändrade, {actions['DELETE']} borttagna.")
+        else:
+            # 3b. Första körningen / schemaändring: ersätt tabellen
+            bulk_write(df_full, target_table, mssql_engine, if_exists='replace')
+            rows_count = len(df_full)
+            log(f"   -> KLART! Ersatte tabellen med {rows_count} rader.")
+
+        save_fingerprint(mssql_engine, target_table, fingerprint)
+
+    return rows_count
+
+def sync_bronze_layer(max_workers=None):
     print("--- Startar Jobb 0: Synkronisera Bronze-lager (Multi-Table) ---")
 
+    max_workers = max(1, int(max_workers or MAX_CONCURRENT_JOBS))
+    per_source = max(1, int(MAX_JOBS_PER_SOURCE))
+
     try:
-        mssql_engine = create_engine(config.MSSQL_CONN_STR)
+        mssql_engine = create_engine(config.MSSQL_CONN_STR, pool_size=max(5, max_workers))
         print("-> Ansluten till MSSQL (Mål).")
     except Exception as e:
         print(f"FATALT FEL: Kunde inte ansluta till MSSQL: {e}")
         sys.exit(1)
 
-    for job in BRONZE_JOBS:
+    source_engines = create_source_engines(BRONZE_JOBS, pool_size=per_source)
+    source_locks = {conn: threading.BoundedSemaphore(per_source) for conn in source_engines}
+    print_lock = threading.Lock()
+    print(f"-> {len(BRONZE_JOBS)} jobb, {len(source_engines)} källor, max {max_workers} samtidiga jobb ({per_source} per källa).")
+
+    def run_job(job):
         target_table = job['target_table']
-        source_table = job['source_table']
-        load_type = job['load_type']
-        
-        print(f"\n-> Bearbetar: {source_table} -> {target_table} ({load_type})...")
+        prefix = f"[{target_table}] " if max_workers > 1 else ""
 
-        try:
-            # Anslut till specifik källdatabas för detta jobb
-            source_engine = create_engine(job['source_db_conn'])
-            
-            if load_type == 'INCREMENTAL':
-                # 1. Hitta sista datum i Bronze
-                time_col = job['time_col']
-                last_date = None
-                
-                try:
-                    check_sql = f"SELECT MAX({time_col}) as last_entry FROM [{target_table}]"
-                    # Obs: Detta kastar fel om tabellen inte finns, vilket vi fångar
-                    df_max = pd.read_sql(check_sql, mssql_engine)
-                    if not df_max.empty and pd.notna(df_max.iloc[0]['last_entry']):
-                        last_date = df_max.iloc[0]['last_entry']
-                        print(f"   -> Senaste data i Bronze: {last_date}")
-                except:
-                    print("   -> Tabellen finns inte eller är tom. Kör full historik.")
-
-                # 2. Hämta data nyare än sista datum
-                if last_date:
-                    query = f"SELECT * FROM {source_table} WHERE {time_col} > '{last_date}'"
-                else:
-                    query = f"SELECT * FROM {source_table}"
-
-                # 3. Spara (Append)
-                rows_count = 0
-                for chunk in pd.read_sql(query, source_engine, chunksize=50000):
-                    chunk.to_sql(target_table, mssql_engine, if_exists='append', index=False)
-                    rows_count += len(chunk)
-                    print(f"   -> Laddat {len(chunk)} rader...")
-                
-                if rows_count == 0:
-                    print("   -> Inga nya rader.")
-                else:
-                    print(f"   -> KLART! Totalt {rows_count} nya rader.")
-
-            elif load_type == 'FULL':
-                # För små register: Hämta allt och skriv över
-                query = f"SELECT * FROM {source_table}"
-                df_full = pd.read_sql(query, source_engine)
-                
-                if not df_full.empty:
-                    df_full.to_sql(target_table, mssql_engine, if_exists='replace', index=False)
-                    print(f"   -> KLART! Ersatte tabellen med {len(df_full)} rader.")
-                else:
-                    print("   -> VARNING: Källtabellen var tom.")
+        def log(msg):
+            with print_lock:
+                print(f"{prefix}{msg}")
 
-        except Exception as e:
-            print(f"FEL vid synk av {target_table}: {e}")
-            traceback.print_exc()
-            # fortsätter till nästa tabell även om en misslyckas
+        with source_locks[job['source_db_conn']]:
+            with print_lock:
+                print(f"\n{prefix}-> Bearbetar: {job['source_table']} -> {target_table} ({job['load_type']})...")
+            t0 = time.perf_counter()
+            try:
+                rows = sync_bronze_job(job, source_engines[job['source_db_conn']], mssql_engine, log=log)
+                return {'table': target_table, 'ok': True, 'rows': rows, 'sec': time.perf_counter() - t0}
+            except Exception as e:
+                with print_lock:
+                    print(f"{prefix}FEL vid synk av {target_table}: {e}")
+                    traceback.print_exc()
+                # fortsätter till nästa tabell även om en misslyckas
+                return {'table': target_table, 'ok': False, 'rows': 0, 'sec': time.perf_counter() - t0, 'error': str(e)}
+
+    if max_workers == 1:
+        results = [run_job(job) for job in BRONZE_JOBS]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bronze') as pool:
+            futures = [pool.submit(run_job, job) for job in BRONZE_JOBS]
+            done = {f.result()['table']: f.result() for f in as_completed(futures)}
+        # Rapportera i samma ordning som BRONZE_JOBS
+        results = [done[job['target_table']] for job in BRONZE_JOBS]
+
+    # Sammanställning per tabell
+    print("\n-> Resultat per tabell:")
+    for res in results:
+        status = "OK " if res['ok'] else "FEL"
+        extra = f" ({res['error']})" if not res['ok'] else ""
+        print(f"   [{status}] {res['table']}: {res['rows']} rader på {res['sec']:.1f}s{extra}")
+
+    for engine in source_engines.values():
+        engine.dispose()
 
     print("\n--- Bronze-laddning slutförd ---")
+    return results
 
 if __name__ == '__main__':
-    sync_bronze_layer()
\ No newline at end of file
+    sync_bronze_layer()
@@ -6,23 +6,488 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 JOBB 1.5: Kundsegmentering (Business Logic) -
 ================================================================
 - 'Segment_Sjukanmälan' (Kollar Key, Namn och Tjänst).
-- Säkrar 'mode()' med safe_mode för att undvika krasch på tom data.
+- Vektoriserad segmentering (array-masker) och TjänstTyp-mode via value counts.
+- Månatliga topp-timmar via tät (grupp x 168)-matris + argpartition.
+- SEGMENT_MODE='KMEANS': Mini-batch K-Means på kundprofiler (volym, AHT, 7x24), varmstartade centroider.
+- SQL_PUSHDOWN: dag-cellerna aggregeras i MSSQL (pandas-vägen finns kvar som reserv).
+- Inkrementellt aggregatlager (SEGMENT_INCREMENTAL): dag-celler per kund, endast nya dagar läses in.
+- Benchmark: python 1.5_Run_Customer_Segmentation.py --benchmark [antal_kunder]
 """
 
 import pandas as pd
 import numpy as np
 from sqlalchemy import create_engine, text
 import config
+import os
+import pickle
 import sys
+import time
 import traceback
-from DataDriven_utils import add_all_features
+from DataDriven_utils import add_all_features, bulk_write, get_current_time
+from sklearn.cluster import MiniBatchKMeans
 
-# --- HJÄLPFUNKTION: Safe Mode ---
-def safe_mode(x):
-    """Hanterar om mode() returnerar tomt (t.ex. vid unik data eller tom serie)"""
-    m = x.mode()
-    if m.empty: return 'Okänd Typ'
-    return m.iloc[0]
+SICK_SEGMENT = 'Segment_Sjukanmälan'
+
+# --- HJÄLPFUNKTION: Mode per grupp ---
+def group_mode(df: pd.DataFrame, key: str, col: str, default='Okänd Typ', weight_col: str = None) -> pd.Series:
+    """
+    Vanligaste värdet av `col` per `key` via value counts (ersätter groupby.agg(safe_mode)).
+    Samma regler som Series.mode(): NaN ignoreras, vid lika antal vinner minsta värdet,
+    grupper utan värden får `default`. Med weight_col summeras vikten istället för att räkna rader.
+    """
+    keys = df[key].dropna().unique()
+    grouped = df.groupby([key, col], sort=False)
+    counts = (grouped.size() if weight_col is None else grouped[weight_col].sum()).reset_index(name='_n')
+    counts = counts.sort_values([key, '_n', col], ascending=[True, False, True], kind='mergesort')
+    top = counts.drop_duplicates(subset=[key], keep='first').set_index(key)[col]
+    return top.reindex(keys).fillna(default).rename(col)
+
+def assign_segments(df_segments: pd.DataFrame, vol_limit: float, aht_limit: float) -> pd.Series:
+    """
+    Vektoriserad Behavior_Segment.
+    Sjukanmälan (Key, Namn eller TjänstTyp, case insensitive) går före kvantil-logiken.
+    """
+    c_key = df_segments['CustomerKey'].astype(str).str.upper().str.strip()
+    c_name = df_segments['Name'].astype(str).str.lower()
+    c_service = df_segments['TjänstTyp'].astype(str).str.lower()
+
+    is_sick = (
+        (c_key == 'INTERNAL_SICK')
+        | c_name.str.contains('sjukanmälan', regex=False)
+        | c_service.str.contains('personal', regex=False)
+        | c_service.str.contains('sjuk', regex=False)
+    ).to_numpy()
+
+    vol_label = np.where(df_segments['Total_Samtal'].to_numpy() > vol_limit, 'Hög-Volym', 'Låg-Volym')
+    aht_label = np.where(df_segments['Genomsnittlig_AHT_Sek'].to_numpy() > aht_limit, 'Långa-Ärenden', 'Korta-Ärenden')
+    segments = np.char.add(np.char.add(vol_label, '_'), aht_label).astype(object)
+    segments[is_sick] = SICK_SEGMENT
+    return pd.Series(segments, index=df_segments.index, name='Behavior_Segment')
+
+def aggregate_customers(df_history: pd.DataFrame, weight_col: str = None) -> pd.DataFrame:
+    """
+    Kundaggregat (STEG 2) utan Python-nivå lambdas.
+    weight_col=None: en rad per samtal. Annars är raderna föraggregerade celler (Antal/Samtalstid_Sek).
+    """
+    if weight_col is None:
+        df_agg = df_history.groupby(['CustomerKey']).agg(
+            Total_Samtal=('CallId', 'count'),
+            Total_Samtalstid_Sek=('TalkTimeInSec', 'sum'),
+            Name=('Name', 'first'),
+        )
+    else:
+        df_agg = df_history.groupby(['CustomerKey']).agg(
+            Total_Samtal=(weight_col, 'sum'),
+            Total_Samtalstid_Sek=('Samtalstid_Sek', 'sum'),
+            Name=('Name', 'first'),
+        )
+    df_agg['TjänstTyp'] = group_mode(df_history, 'CustomerKey', 'TjänstTyp', weight_col=weight_col).reindex(df_agg.index).fillna('Okänd Typ')
+    df_agg = df_agg.reset_index()
+    df_agg['Genomsnittlig_AHT_Sek'] = (df_agg['Total_Samtalstid_Sek'] / df_agg['Total_Samtal']).fillna(0).astype(int)
+    return df_agg
+
+# --- KLUSTRING: Mini-batch K-Means på kundprofiler ---
+def iter_customer_features(df_agg: pd.DataFrame, df_cells: pd.DataFrame, scaling: dict, batch_size: int = 4096):
+    """
+    Kundfeatures i batchar (samma ordning som df_agg):
+    [log-volym, log-AHT] standardiserade med `scaling` + normaliserad 7x24-profil * profile_weight.
+    Profilen byggs per batch från cellerna, så hela (kund x 168)-matrisen behöver aldrig finnas i minnet.
+    """
+    cust_codes = pd.Index(df_agg['CustomerKey']).get_indexer(df_cells['CustomerKey'])
+    valid = cust_codes >= 0
+    order = np.argsort(cust_codes[valid], kind='stable')
+    codes = cust_codes[valid][order]
+    slot = (df_cells['veckodag'].to_numpy(dtype=np.int64) * 24 + df_cells['timme'].to_numpy(dtype=np.int64))[valid][order]
+    weights = df_cells['Antal'].to_numpy(dtype=np.float64)[valid][order]
+    bounds = np.searchsorted(codes, np.arange(0, len(df_agg) + batch_size, batch_size))
+
+    base = (customer_base_features(df_agg) - scaling['mean']) / scaling['std']
+    for start, lo, hi in zip(range(0, len(df_agg), batch_size), bounds[:-1], bounds[1:]):
+        n = min(batch_size, len(df_agg) - start)
+        profile = np.bincount((codes[lo:hi] - start) * 168 + slot[lo:hi], weights=weights[lo:hi],
+                              minlength=n * 168).reshape(n, 168)
+        totals = profile.sum(axis=1, keepdims=True)
+        profile = profile / np.where(totals > 0, totals, 1)
+        yield start, np.hstack([base[start:start + n], profile * scaling['profile_weight']])
+
+def customer_base_features(df_agg: pd.DataFrame) -> np.ndarray:
+    return np.column_stack([
+        np.log1p(df_agg['Total_Samtal'].to_numpy(dtype=np.float64)),
+        np.log1p(df_agg['Genomsnittlig_AHT_Sek'].clip(lower=0).to_numpy(dtype=np.float64)),
+    ])
+
+def kmeans_segments(df_segments: pd.DataFrame, df_cells: pd.DataFrame, is_sick: np.ndarray) -> pd.Series:
+    """
+    Behavior_Segment via Mini-batch K-Means (partial_fit per kundbatch).
+    Centroider + skalning sparas i MODEL_DIR och används som start nästa körning,
+    så att 'Kluster_NN' behåller sin betydelse mellan körningar. Vid kallstart
+    numreras klustren efter fallande volym. Sjukanmälan-överstyrningen gäller som tidigare.
+    """
+    n_clusters = int(getattr(config, 'SEGMENT_N_CLUSTERS', 6))
+    batch_size = int(getattr(config, 'SEGMENT_KMEANS_BATCH', 4096))
+    epochs = int(getattr(config, 'SEGMENT_KMEANS_EPOCHS', 3))
+    state_path = os.path.join(config.MODEL_DIR, 'segment_kmeans.pkl')
+
+    state = None
+    if os.path.exists(state_path):
+        with open(state_path, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('n_clusters') != n_clusters:
+            print("   -> Antal kluster ändrat, kallstartar K-Means.")
+            state = None
+
+    if state is None:
+        base = customer_base_features(df_segments[~is_sick])
+        std = base.std(axis=0)
+        scaling = {'mean': base.mean(axis=0), 'std': np.where(std > 0, std, 1.0),
+                   'profile_weight': float(getattr(config, 'SEGMENT_PROFILE_WEIGHT', 4.0))}
+        init = 'k-means++'
+        reassignment_ratio = 0.01
+    else:
+        scaling = state['scaling']
+        init = state['centroids']
+        # Ingen slumpmässig omplacering av små kluster vid varmstart (index = samma kluster som förra körningen)
+        reassignment_ratio = 0.0
+        print("   -> Varmstart från sparade centroider.")
+
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, init=init, n_init=1, batch_size=batch_size,
+                             reassignment_ratio=reassignment_ratio, random_state=42)
+    for _ in range(epochs):
+        for start, X in iter_customer_features(df_segments, df_cells, scaling, batch_size):
+            X = X[~is_sick[start:start + len(X)]]
+            if len(X) >= n_clusters or (len(X) and hasattr(kmeans, 'cluster_centers_')):
+                kmeans.partial_fit(X)
+
+    if not hasattr(kmeans, 'cluster_centers_'):
+        return None
+
+    if state is None:
+        kmeans.cluster_centers_ = kmeans.cluster_centers_[np.argsort(-kmeans.cluster_centers_[:, 0], kind='stable')]
+
+    labels = np.empty(len(df_segments), dtype=np.int64)
+    for start, X in iter_customer_features(df_segments, df_cells, scaling, batch_size):
+        labels[start:start + len(X)] = kmeans.predict(X)
+
+    os.makedirs(config.MODEL_DIR, exist_ok=True)
+    with open(state_path, 'wb') as f:
+        pickle.dump({'n_clusters': n_clusters, 'centroids': kmeans.cluster_centers_, 'scaling': scaling}, f)
+
+    segments = np.array([f"Kluster_{i + 1:02d}" for i in range(n_clusters)], dtype=object)[labels]
+    segments[is_sick] = SICK_SEGMENT
+    return pd.Series(segments, index=df_segments.index, name='Behavior_Segment')
+
+# --- AGGREGATLAGER: en rad per (kund, dag, timme, tjänst, samtalstyp) ---
+AGG_GRAIN = ['CustomerKey', 'Name', 'TjänstTyp', 'Datum', 'timme', 'Samtalstyp']
+AGG_COLUMNS = AGG_GRAIN + ['Antal', 'Samtalstid_Sek']
+CALENDAR_FEATURES = ['veckodag', 'månad', 'veckodag_namn', 'månad_namn']
+# Cellernas radordning: Name=('Name', 'first') blir namnet på kundens tidigaste samtal,
+# oberoende av MSSQL:s (odefinierade) radordning och av SQL- eller pandas-vägen
+CELL_ORDER = ['CustomerKey', 'Datum', 'timme', 'Name', 'TjänstTyp', 'Samtalstyp']
+
+def sort_cells(df_cells: pd.DataFrame) -> pd.DataFrame:
+    return df_cells.sort_values(CELL_ORDER, kind='mergesort', ignore_index=True)
+
+def talk_time_limits(talk_time: pd.Series):
+    """ Gränser Kort/Normal/Långt (33%/66% av samtal med samtalstid > 0). """
+    talk_time = talk_time[talk_time > 0]
+    if talk_time.empty:
+        return 1.0, 61.0
+    return adjust_talk_time_limits(talk_time.quantile(0.33), talk_time.quantile(0.66))
+
+def adjust_talk_time_limits(lower_limit, upper_limit):
+    if lower_limit == 0: lower_limit = 1
+    if upper_limit <= lower_limit: upper_limit = lower_limit + 60
+    return float(lower_limit), float(upper_limit)
+
+def build_cells(df_history: pd.DataFrame, lower_limit: float, upper_limit: float) -> pd.DataFrame:
+    """ Samtal -> dag-celler (AGG_COLUMNS). Samtal utan samtalstid får Samtalstyp 'Ingen'. """
+    df = df_history[['CustomerKey', 'Name', 'TjänstTyp', 'CallId', 'TalkTimeInSec']].copy()
+    talk = df['TalkTimeInSec'].to_numpy(dtype='float64')
+    with np.errstate(invalid='ignore'):
+        df['Samtalstyp'] = np.select(
+            [~(talk > 0), talk < lower_limit, talk > upper_limit],
+            ['Ingen', 'Kort', 'Långt'], default='Normal')
+    df['Datum'] = df_history['Created'].dt.normalize()
+    df['timme'] = df_history['Created'].dt.hour
+    return df.groupby(AGG_GRAIN, dropna=False, sort=False).agg(
+        Antal=('CallId', 'count'),
+        Samtalstid_Sek=('TalkTimeInSec', 'sum'),
+    ).reset_index()
+
+def read_history(mssql_engine, table_name, where="") -> pd.DataFrame:
+    cols_to_use = ['Created', 'Name', 'QueueId', 'CustomerKey', 'TalkTimeInSec', 'CallId', 'TjänstTyp'] 
+    cols_str = ", ".join([f'[{col}]' for col in cols_to_use])
+    
+    sql_query = f'SELECT {cols_str} FROM [{table_name}]{where}'
+    df_history = pd.read_sql(sql_query, mssql_engine)
+    df_history['Created'] = pd.to_datetime(df_history['Created']).dt.tz_localize(None)
+    print(f"-> Läste {len(df_history)} samtalshändelser.")
+    return df_history
+
+def load_cells_sql(mssql_engine, table_name, where="", limits=None):
+    """ Samma celler som build_cells, men GROUP BY körs i MSSQL (endast aggregatet överförs). """
+    if limits is None:
+        cond = f"{where} AND" if where else " WHERE"
+        df_limits = pd.read_sql(f"""
+            SELECT TOP 1
+                PERCENTILE_CONT(0.33) WITHIN GROUP (ORDER BY CAST(TalkTimeInSec AS float)) OVER () AS lower_limit,
+                PERCENTILE_CONT(0.66) WITHIN GROUP (ORDER BY CAST(TalkTimeInSec AS float)) OVER () AS upper_limit
+            FROM [{table_name}]{cond} TalkTimeInSec > 0
+        """, mssql_engine)
+        if df_limits.empty:
+            limits = (1.0, 61.0)
+        else:
+            limits = adjust_talk_time_limits(df_limits.iloc[0]['lower_limit'], df_limits.iloc[0]['upper_limit'])
+    lower_limit, upper_limit = limits
+
+    df_cells = pd.read_sql(f"""
+        SELECT CustomerKey, Name, [TjänstTyp], Datum, timme, Samtalstyp,
+               COUNT(CallId) AS Antal, COALESCE(SUM(TalkTimeInSec), 0) AS Samtalstid_Sek
+        FROM (
+            SELECT CustomerKey, Name, [TjänstTyp], CallId, TalkTimeInSec,
+                   CAST(CAST(Created AS date) AS datetime2) AS Datum,
+                   DATEPART(hour, Created) AS timme,
+                   CASE WHEN TalkTimeInSec IS NULL OR TalkTimeInSec <= 0 THEN 'Ingen'
+                        WHEN TalkTimeInSec < {lower_limit} THEN 'Kort'
+                        WHEN TalkTimeInSec > {upper_limit} THEN N'Långt'
+                        ELSE 'Normal' END AS Samtalstyp
+            FROM [{table_name}]{where}
+        ) c
+        GROUP BY CustomerKey, Name, [TjänstTyp], Datum, timme, Samtalstyp
+    """, mssql_engine)
+    print(f"-> Läste {len(df_cells)} aggregerade celler (SQL-pushdown).")
+    return df_cells, limits
+
+def load_cells(mssql_engine, table_name, where="", limits=None):
+    """
+    Dag-celler för `where` i CELL_ORDER. Returnerar (df_cells, (lower_limit, upper_limit)).
+    limits=None -> gränserna beräknas från samma urval.
+    """
+    if getattr(config, 'SQL_PUSHDOWN', False):
+        try:
+            df_cells, limits = load_cells_sql(mssql_engine, table_name, where, limits)
+            return sort_cells(df_cells), limits
+        except Exception as e:
+            print(f"   VARNING: SQL-pushdown misslyckades ({e}), aggregerar i pandas.")
+
+    df_history = read_history(mssql_engine, table_name, where)
+    if df_history.empty:
+        return pd.DataFrame(columns=AGG_COLUMNS), limits
+    if limits is None:
+        limits = talk_time_limits(df_history['TalkTimeInSec'])
+    return sort_cells(build_cells(df_history, *limits)), limits
+
+PEAK_TYPES = ['Kort', 'Långt', 'Normal']  # alfabetisk ordning, som groupby-sorteringen
+PEAK_COLUMNS = ['CustomerKey', 'Name', 'månad_namn', 'månad', 'veckodag_namn', 'veckodag', 'timme', 'Samtalstyp']
+
+def _first_by_code(codes: np.ndarray, n_codes: int, values: np.ndarray) -> np.ndarray:
+    """ Första förekomstens värde per kod (vektoriserat alternativ till groupby.first). """
+    first_idx = np.full(n_codes, -1, dtype=np.int64)
+    first_idx[codes[::-1]] = np.arange(len(codes) - 1, -1, -1)
+    out = np.empty(n_codes, dtype=object)
+    found = first_idx >= 0
+    out[found] = values[first_idx[found]]
+    return out
+
+def monthly_top_peaks(df_samtal: pd.DataFrame, top_k: int = 3, chunk_groups: int = 50000) -> pd.DataFrame:
+    """
+    Topp-k timmar per (kund, månad, samtalstyp) på en tät heltalsmatris
+    (grupp x namn x 168 veckodag-timmar) istället för groupby/merge/rank på strängnycklar.
+    Ger samma rader och ordning som Dim_Customer_Monthly_Peaks: en rad per (kund, namn, timme),
+    andel av kundens månad/typ och Peak_Rank över kundens alla namn
+    (lika antal -> namn, veckodagsnamn, timme, som rank(method='first')).
+    """
+    out_cols = PEAK_COLUMNS + ['Antal_Samtal_Denna_Timme', 'Procent_Av_Manad_Typ', 'Peak_Rank']
+    names = df_samtal['Name'].to_numpy()
+    cust_codes, cust_uniques = pd.factorize(df_samtal['CustomerKey'], sort=True)
+    valid = (cust_codes >= 0) & ~pd.isna(names)
+    if not valid.all():
+        df_samtal, names, cust_codes = df_samtal[valid], names[valid], cust_codes[valid]
+    if len(df_samtal) == 0:
+        return pd.DataFrame(columns=out_cols)
+
+    # Namn per kund: (kund, namn)-par sorterade -> namnets ordning inom kunden
+    name_codes, name_uniques = pd.factorize(names, sort=True)
+    pair_codes, pair_keys = pd.factorize(cust_codes.astype(np.int64) * len(name_uniques) + name_codes, sort=True)
+    pair_cust = pair_keys // len(name_uniques)
+    pair_name = np.asarray(name_uniques, dtype=object)[pair_keys % len(name_uniques)]
+    pair_first = np.searchsorted(pair_cust, pair_cust)
+    name_rank = (np.arange(len(pair_keys)) - pair_first)[pair_codes]
+    n_names = int(name_rank.max()) + 1
+    width = n_names * 168
+    type_codes = pd.Categorical(df_samtal['Samtalstyp'], categories=PEAK_TYPES).codes.astype(np.int64)
+    month = df_samtal['månad'].to_numpy(dtype=np.int64)
+    month_name = _first_by_code(month, 13, df_samtal['månad_namn'].to_numpy())
+
+    # Veckodag-axeln sorteras på veckodagsnamn (samma tie-break som den gamla kedjan)
+    weekday = df_samtal['veckodag'].to_numpy(dtype=np.int64)
+    weekday_name = _first_by_code(weekday, 7, df_samtal['veckodag_namn'].to_numpy())
+    weekday_order = np.argsort(np.argsort(np.where(pd.isna(weekday_name), '', weekday_name).astype(str)))
+    slot = name_rank * 168 + weekday_order[weekday] * 24 + df_samtal['timme'].to_numpy(dtype=np.int64)
+    slot_weekday = np.empty(168, dtype=np.int64)
+    slot_weekday[weekday_order.repeat(24) * 24 + np.tile(np.arange(24), 7)] = np.arange(7).repeat(24)
+    slot_hour = np.tile(np.arange(24), 7)
+
+    group_key = (cust_codes.astype(np.int64) * 13 + month) * len(PEAK_TYPES) + type_codes
+    group_ids, group_keys = pd.factorize(group_key)
+    n_groups = len(group_keys)
+    weights = df_samtal['Antal'].to_numpy(dtype=np.float64) if 'Antal' in df_samtal.columns else np.ones(len(df_samtal))
+
+    # Grupperna delas i block om chunk_groups rader i matrisen (begränsar minnet)
+    chunk_groups = max(1, chunk_groups // n_names)
+    if n_groups > chunk_groups:
+        order = np.argsort(group_ids, kind='stable')
+        group_ids, slot, weights = group_ids[order], slot[order], weights[order]
+        bounds = np.searchsorted(group_ids, np.arange(0, n_groups + chunk_groups, chunk_groups))
+    else:
+        bounds = np.array([0, len(group_ids)])
+
+    k = min(top_k, width)
+    tie_break = np.arange(width - 1, -1, -1, dtype=np.int64)
+    parts = []
+    for start_group, lo, hi in zip(range(0, n_groups, chunk_groups), bounds[:-1], bounds[1:]):
+        n = min(chunk_groups, n_groups - start_group)
+        counts = np.bincount((group_ids[lo:hi] - start_group) * width + slot[lo:hi],
+                             weights=weights[lo:hi], minlength=n * width).reshape(n, width).astype(np.int64)
+        totals = counts.sum(axis=1)
+        score = counts * width + tie_break  # unika poäng -> deterministisk ordning vid lika antal
+        if k <= 4:
+            # Litet k: k st argmax-pass är snabbare än argpartition över alla kolumner
+            top = np.empty((n, k), dtype=np.int64)
+            for i in range(k):
+                top[:, i] = score.argmax(axis=1)
+                score[np.arange(n), top[:, i]] = -1
+        else:
+            top = np.argpartition(-score, k - 1, axis=1)[:, :k]
+            top = np.take_along_axis(top, np.argsort(-np.take_along_axis(score, top, axis=1), axis=1), axis=1)
+        top_counts = np.take_along_axis(counts, top, axis=1)
+        rows, ranks = np.nonzero(top_counts > 0)
+        parts.append((start_group + rows, top[rows, ranks], top_counts[rows, ranks], totals[rows], ranks + 1))
+
+    g, sl, cnt, tot, rank = (np.concatenate(x) for x in zip(*parts))
+    gk = group_keys[g]
+    t_code = gk % len(PEAK_TYPES)
+    m_code = (gk // len(PEAK_TYPES)) % 13
+    c_code = gk // (len(PEAK_TYPES) * 13)
+    name_of = pair_name[pair_first[np.searchsorted(pair_cust, c_code)] + sl // 168]
+    sl = sl % 168
+
+    result = pd.DataFrame({
+        'CustomerKey': cust_uniques.to_numpy()[c_code],
+        'Name': name_of,
+        'månad_namn': month_name[m_code],
+        'månad': m_code.astype(df_samtal['månad'].dtype),
+        'veckodag_namn': weekday_name[slot_weekday[sl]],
+        'veckodag': slot_weekday[sl].astype(df_samtal['veckodag'].dtype),
+        'timme': slot_hour[sl].astype(df_samtal['timme'].dtype),
+        'Samtalstyp': np.array(PEAK_TYPES, dtype=object)[t_code],
+        'Antal_Samtal_Denna_Timme': cnt,
+        'Procent_Av_Manad_Typ': np.where(tot > 0, cnt / np.maximum(tot, 1), 0.0),
+        'Peak_Rank': rank.astype(np.float64),
+    })
+    return result.sort_values(by=['CustomerKey', 'månad_namn', 'Samtalstyp', 'Peak_Rank']).reset_index(drop=True)
+
+def read_agg_meta(engine, meta_table):
+    try:
+        df_meta = pd.read_sql(f"SELECT * FROM [{meta_table}]", engine)
+        return None if df_meta.empty else df_meta.iloc[0]
+    except Exception:
+        return None
+
+def write_agg_meta(engine, meta_table, last_day, lower_limit, upper_limit, window_days):
+    df_meta = pd.DataFrame([{
+        'Last_Day': pd.Timestamp(last_day), 'Lower_Limit': lower_limit,
+        'Upper_Limit': upper_limit, 'Window_Days': -1 if window_days is None else int(window_days),
+    }])
+    bulk_write(df_meta, meta_table, engine, if_exists='replace')
+
+def silver_first_day(mssql_engine, table_name_training):
+    """ Första dagen som finns kvar i Silver efter retention-DELETE (None om tabellen är tom). """
+    df_min = pd.read_sql(f"SELECT MIN(Created) AS min_created FROM [{table_name_training}]", mssql_engine)
+    first = df_min.iloc[0]['min_created']
+    return None if pd.isna(first) else pd.Timestamp(first).normalize()
+
+def update_aggregate_store(mssql_engine, table_name_training):
+    """
+    Uppdaterar aggregatlagret med dagar som inte redan absorberats och tar bort dagar
+    som lämnat fönstret (SEGMENT_WINDOW_DAYS). Returnerar cellerna inom fönstret.
+    Utan SEGMENT_WINDOW_DAYS följer fönstret Silvers retention (OPERATIONAL_MONTHS_AGO):
+    dagar före Silvers första dag tas bort, så lagret ser samma samtal som fullt läge.
+    Senast absorberade dag läses om (ofullständig dag / sena rader).
+    Samtalstyp-gränserna frysas vid ombyggnad och sparas i meta-tabellen.
+    """
+    store_table = config.TABLE_NAMES.get('Customer_Behavior_Aggregates', 'Agg_Customer_Behavior_Daily')
+    meta_table = f"{store_table}_Meta"
+    staging_table = f"{store_table}_STAGING"
+    window_days = getattr(config, 'SEGMENT_WINDOW_DAYS', None)
+    if window_days:
+        window_start = pd.Timestamp(get_current_time()).normalize() - pd.Timedelta(days=int(window_days))
+    else:
+        window_start = silver_first_day(mssql_engine, table_name_training)
+
+    meta = read_agg_meta(mssql_engine, meta_table)
+    rebuild = meta is None or int(meta['Window_Days']) != (-1 if window_days is None else int(window_days))
+
+    if rebuild:
+        print(f"-> Bygger aggregatlager '{store_table}' från grunden...")
+        where = f" WHERE Created >= '{window_start}'" if window_start is not None else ""
+        df_cells, limits = load_cells(mssql_engine, table_name_training, where)
+        if df_cells.empty:
+            return df_cells
+        lower_limit, upper_limit = limits
+        bulk_write(df_cells, staging_table, mssql_engine, if_exists='replace')
+        with mssql_engine.connect() as connection:
+            connection.execute(text(f"""
+                BEGIN TRY
+                    BEGIN TRANSACTION;
+                    IF OBJECT_ID('{store_table}', 'U') IS NOT NULL DROP TABLE [{store_table}];
+                    SELECT * INTO [{store_table}] FROM [{staging_table}];
+                    CREATE CLUSTERED INDEX [IX_{store_table}_Datum] ON [{store_table}] (Datum);
+                    COMMIT TRANSACTION;
+                END TRY
+                BEGIN CATCH
+                    ROLLBACK TRANSACTION;
+                    THROW;
+                END CATCH;
+            """))
+            connection.commit()
+        write_agg_meta(mssql_engine, meta_table, df_cells['Datum'].max(), lower_limit, upper_limit, window_days)
+        print(f"   -> {len(df_cells)} celler i aggregatlagret.")
+        return df_cells
+
+    lower_limit, upper_limit = float(meta['Lower_Limit']), float(meta['Upper_Limit'])
+    from_day = pd.Timestamp(meta['Last_Day']).normalize()
+    print(f"-> Inkrementell uppdatering av '{store_table}' från {from_day.date()}...")
+    df_cells_new, _ = load_cells(mssql_engine, table_name_training, f" WHERE Created >= '{from_day}'", (lower_limit, upper_limit))
+
+    col_list = ", ".join([f"[{c}]" for c in AGG_COLUMNS])
+    expire_sql = f"DELETE FROM [{store_table}] WHERE Datum < '{window_start}';" if window_start is not None else ""
+    if not df_cells_new.empty:
+        bulk_write(df_cells_new[AGG_COLUMNS], staging_table, mssql_engine, if_exists='replace')
+        insert_sql = f"INSERT INTO [{store_table}] ({col_list}) SELECT {col_list} FROM [{staging_table}];"
+    else:
+        insert_sql = ""
+    with mssql_engine.connect() as connection:
+        connection.execute(text(f"""
+            BEGIN TRY
+                BEGIN TRANSACTION;
+                DELETE FROM [{store_table}] WHERE Datum >= '{from_day}';
+                {insert_sql}
+                {expire_sql}
+                COMMIT TRANSACTION;
+            END TRY
+            BEGIN CATCH
+                ROLLBACK TRANSACTION;
+                THROW;
+            END CATCH;
+        """))
+        connection.commit()
+    last_day = df_cells_new['Datum'].max() if not df_cells_new.empty else from_day
+    write_agg_meta(mssql_engine, meta_table, last_day, lower_limit, upper_limit, window_days)
+    print(f"   -> {len(df_cells_new)} celler absorberade.")
+
+    # Samma radordning som load_cells (Name='first'); lagrets radordning i MSSQL är odefinierad
+    return sort_cells(pd.read_sql(f"SELECT {col_list} FROM [{store_table}]", mssql_engine))
 
 def create_and_save_segments():
     print("--- Startar Jobb 1.5: Kundsegmentering (Business Logic) ---")
@@ -34,48 +499,37 @@ def create_and_save_segments():
         print(f"FATALT FEL: Kunde inte ansluta till MSSQL: {e}")
         raise Exception('Processen avbröts pga fel')
 
-    # === STEG 1: Läs in historik ===
+    # === STEG 1: Läs in historik (som dag-celler) ===
     table_name_training = config.TABLE_NAMES['Operative_Training_Data']
     print(f"-> Läser in historik från '{table_name_training}'...")
 
     try:
-        cols_to_use = ['Created', 'Name', 'QueueId', 'CustomerKey', 'TalkTimeInSec', 'CallId', 'TjänstTyp'] 
-        cols_str = ", ".join([f'[{col}]' for col in cols_to_use])
-        
-        sql_query = f'SELECT {cols_str} FROM [{table_name_training}]'
-        df_history = pd.read_sql(sql_query, mssql_engine)
-        df_history['Created'] = pd.to_datetime(df_history['Created']).dt.tz_localize(None)
-        
-        if df_history.empty:
+        if getattr(config, 'SEGMENT_INCREMENTAL', False):
+            df_cells = update_aggregate_store(mssql_engine, table_name_training)
+        else:
+            df_cells, _ = load_cells(mssql_engine, table_name_training)
+
+        if df_cells.empty:
             print("VARNING: Ingen historisk data hittades.")
             return 
             
-        print(f"-> Läste {len(df_history)} samtalshändelser.")
-        
     except Exception as e:
         print(f"FEL: Kunde inte läsa data från '{table_name_training}'.")
         print(f"Tekniskt fel: {e}")
         raise Exception('Processen avbröts pga fel')
 
+    df_cells['Datum'] = pd.to_datetime(df_cells['Datum'])
+    df_cells['Antal'] = df_cells['Antal'].astype('int64')
+    df_cells = add_all_features(df_cells, ds_col='Datum', features=CALENDAR_FEATURES)
+
     # === STEG 2: Aggregera ===
-    print("-> Aggregerar per (CustomerKey)...")
-    df_history_features = df_history.rename(columns={'Created': 'ds'})
-    df_history_features = add_all_features(df_history_features, ds_col='ds')
-    
-    df_agg = df_history_features.groupby(['CustomerKey']).agg(
-        Total_Samtal=('CallId', 'count'),
-        Total_Samtalstid_Sek=('TalkTimeInSec', 'sum'),
-        Name=('Name', 'first'),
-        # Använder safe_mode här
-        TjänstTyp=('TjänstTyp', safe_mode) 
-    ).reset_index()
-    
-    df_agg['Genomsnittlig_AHT_Sek'] = (df_agg['Total_Samtalstid_Sek'] / df_agg['Total_Samtal']).fillna(0).astype(int)
+    print(f"-> Aggregerar per (CustomerKey) från {len(df_cells)} celler...")
+    df_agg = aggregate_customers(df_cells, weight_col='Antal')
 
     # === STEG 3: Peak Pattern ===
     print("-> Beräknar 'Peak Pattern'...")
-    df_peak_pattern = df_history_features.groupby(['CustomerKey', 'veckodag', 'timme']).agg(
-        Antal=('CallId', 'count')
+    df_peak_pattern = df_cells.groupby(['CustomerKey', 'veckodag', 'timme']).agg(
+        Antal=('Antal', 'sum')
     ).reset_index()
     df_peak_pattern = df_peak_pattern.sort_values(by='Antal', ascending=False)
     df_peak = df_peak_pattern.drop_duplicates(subset=['CustomerKey'], keep='first').copy()
@@ -94,29 +548,16 @@ def create_and_save_segments():
     print(f"   -> Gräns Hög Volym (Top 20%): > {vol_limit:.0f} samtal")
     print(f"   -> Gräns Långa Ärenden (Median): > {aht_limit:.0f} sek")
 
-    def get_segment(row):
-        
-        # kollar både ID, Namn och TjänstTyp för att vara säkra (Case Insensitive)
-        c_key = str(row['CustomerKey']).upper().strip()
-        c_name = str(row['Name']).lower()
-        c_service = str(row['TjänstTyp']).lower()
-        
-        # Logic: Om någon av dessa stämmer är det Sjukanmälan
-        is_sick = (c_key == 'INTERNAL_SICK') or \
-                  ('sjukanmälan' in c_name) or \
-                  ('personal' in c_service) or \
-                  ('sjuk' in c_service)
-
-        if is_sick:
-            return 'Segment_Sjukanmälan'
-        
-        # Vanlig logik
-        vol_label = 'Hög-Volym' if row['Total_Samtal'] > vol_limit else 'Låg-Volym'
-        aht_label = 'Långa-Ärenden' if row['Genomsnittlig_AHT_Sek'] > aht_limit else 'Korta-Ärenden'
-        
-        return f"{vol_label}_{aht_label}"
+    df_segments['Behavior_Segment'] = assign_segments(df_segments, vol_limit, aht_limit)
 
-    df_segments['Behavior_Segment'] = df_segments.apply(get_segment, axis=1)
+    if str(getattr(config, 'SEGMENT_MODE', 'QUANTILE')).upper() == 'KMEANS':
+        print("-> Klustrar kunder (Mini-batch K-Means)...")
+        is_sick = (df_segments['Behavior_Segment'] == SICK_SEGMENT).to_numpy()
+        kmeans_result = kmeans_segments(df_segments, df_cells, is_sick)
+        if kmeans_result is not None:
+            df_segments['Behavior_Segment'] = kmeans_result
+        else:
+            print("   VARNING: För få kunder för K-Means, behåller kvantil-segment.")
     
     print("   -> Segmentfördelning:")
     print(df_segments['Behavior_Segment'].value_counts())
@@ -130,7 +571,7 @@ def create_and_save_segments():
 
     try:
         print(f"-> Sparar till STAGING '{staging_table_name}'...")
-        df_to_save.to_sql(staging_table_name, mssql_engine, if_exists='replace', index=False, chunksize=1000)
+        bulk_write(df_to_save, staging_table_name, mssql_engine, if_exists='replace')
 
         print(f"-> Flyttar till PROD '{output_table_name}'...")
         # Använder Transaction & Rollback (Säkerhet)
@@ -157,44 +598,14 @@ def create_and_save_segments():
     # === STEG 6: Peak Analysis ===
     print("-> Analyserar månatliga topp-tider...")
     try:
-        df_samtal = df_history_features[df_history_features['TalkTimeInSec'] > 0].copy()
+        df_samtal = df_cells[df_cells['Samtalstyp'] != 'Ingen']
         if not df_samtal.empty:
-            lower_limit = df_samtal['TalkTimeInSec'].quantile(0.33)
-            upper_limit = df_samtal['TalkTimeInSec'].quantile(0.66)
-            if lower_limit == 0: lower_limit = 1 
-            if upper_limit <= lower_limit: upper_limit = lower_limit + 60 
-
-            df_samtal['Samtalstyp'] = 'Normal'
-            df_samtal.loc[df_samtal['TalkTimeInSec'] < lower_limit, 'Samtalstyp'] = 'Kort'
-            df_samtal.loc[df_samtal['TalkTimeInSec'] > upper_limit, 'Samtalstyp'] = 'Långt'
-
-            df_peak_monthly = df_samtal.groupby(
-                ['CustomerKey', 'Name', 'månad_namn', 'månad', 'veckodag_namn', 'veckodag', 'timme', 'Samtalstyp']
-            ).agg(Antal_Samtal_Denna_Timme=('CallId', 'count')).reset_index()
-
-            df_monthly_totals = df_peak_monthly.groupby(
-                ['CustomerKey', 'månad_namn', 'Samtalstyp']
-            )['Antal_Samtal_Denna_Timme'].sum().to_frame('Totala_Samtal_Manad_Typ').reset_index()
-
-            df_peak_monthly = pd.merge(df_peak_monthly, df_monthly_totals, on=['CustomerKey', 'månad_namn', 'Samtalstyp'], how='left')
-            
-            mask = df_peak_monthly['Totala_Samtal_Manad_Typ'] > 0
-            df_peak_monthly.loc[mask, 'Procent_Av_Manad_Typ'] = (df_peak_monthly['Antal_Samtal_Denna_Timme'] / df_peak_monthly['Totala_Samtal_Manad_Typ'])
-            df_peak_monthly['Procent_Av_Manad_Typ'] = df_peak_monthly['Procent_Av_Manad_Typ'].fillna(0)
-
-            df_peak_monthly['Peak_Rank'] = df_peak_monthly.groupby(
-                ['CustomerKey', 'månad_namn', 'Samtalstyp']
-            )['Antal_Samtal_Denna_Timme'].rank(method='first', ascending=False)
-
-            df_top_peaks = df_peak_monthly[df_peak_monthly['Peak_Rank'] <= 3].copy()
-            df_top_peaks = df_top_peaks.sort_values(
-                by=['CustomerKey', 'månad_namn', 'Samtalstyp', 'Peak_Rank']
-            ).drop(columns=['Totala_Samtal_Manad_Typ'])
+            df_top_peaks = monthly_top_peaks(df_samtal, top_k=3)
 
             peak_table_name = config.TABLE_NAMES.get('Monthly_Peak_Analysis', 'Dim_Customer_Monthly_Peaks')
             peak_staging_table_name = f"{peak_table_name}_STAGING"
 
-            df_top_peaks.to_sql(peak_staging_table_name, mssql_engine, if_exists='replace', index=False, chunksize=1000)
+            bulk_write(df_top_peaks, peak_staging_table_name, mssql_engine, if_exists='replace')
             
             with mssql_engine.connect() as connection:
                 connection.execute(text(f"""
@@ -218,5 +629,67 @@ def create_and_save_segments():
         
     print("\n--- Kundsegmentering slutförd ---")
 
+def benchmark_segmentation(n_customers: int = 100000, calls_per_customer: int = 20, seed: int = 42):
+    """
+    Jämför vektoriserad segmentering mot den gamla radvisa logiken (safe_mode + apply)
+    på syntetisk data och verifierar att resultaten är identiska.
+    """
+    rng = np.random.default_rng(seed)
+    n_calls = n_customers * calls_per_customer
+    services = np.array(['Växel', 'Personal', 'Sjukanmälan', 'Support', 'Bokning', None], dtype=object)
+    df_calls = pd.DataFrame({
+        'CustomerKey': rng.integers(0, n_customers, n_calls).astype(str),
+        'CallId': np.arange(n_calls),
+        'TalkTimeInSec': rng.integers(0, 900, n_calls),
+        'TjänstTyp': services[rng.integers(0, len(services), n_calls)],
+    })
+    df_calls.loc[df_calls['CustomerKey'] == '0', 'CustomerKey'] = 'INTERNAL_SICK'
+    df_calls['Name'] = 'Kund ' + df_calls['CustomerKey']
+    print(f"--- Benchmark segmentering: {n_customers} kunder, {n_calls} samtal ---")
+
+    t0 = time.perf_counter()
+    df_new = aggregate_customers(df_calls)
+    vol_limit = df_new['Total_Samtal'].quantile(0.80)
+    aht_limit = df_new['Genomsnittlig_AHT_Sek'].quantile(0.50)
+    df_new['Behavior_Segment'] = assign_segments(df_new, vol_limit, aht_limit)
+    t_new = time.perf_counter() - t0
+
+    def safe_mode(x):
+        m = x.mode()
+        if m.empty: return 'Okänd Typ'
+        return m.iloc[0]
+
+    def get_segment(row):
+        c_key = str(row['CustomerKey']).upper().strip()
+        c_name = str(row['Name']).lower()
+        c_service = str(row['TjänstTyp']).lower()
+        if (c_key == 'INTERNAL_SICK') or ('sjukanmälan' in c_name) or ('personal' in c_service) or ('sjuk' in c_service):
+            return SICK_SEGMENT
+        vol_label = 'Hög-Volym' if row['Total_Samtal'] > vol_limit else 'Låg-Volym'
+        aht_label = 'Långa-Ärenden' if row['Genomsnittlig_AHT_Sek'] > aht_limit else 'Korta-Ärenden'
+        return f"{vol_label}_{aht_label}"
+
+    t0 = time.perf_counter()
+    df_old = df_calls.groupby(['CustomerKey']).agg(
+        Total_Samtal=('CallId', 'count'),
+        Total_Samtalstid_Sek=('TalkTimeInSec', 'sum'),
+        Name=('Name', 'first'),
+        TjänstTyp=('TjänstTyp', safe_mode)
+    ).reset_index()
+    df_old['Genomsnittlig_AHT_Sek'] = (df_old['Total_Samtalstid_Sek'] / df_old['Total_Samtal']).fillna(0).astype(int)
+    df_old['Behavior_Segment'] = df_old.apply(get_segment, axis=1)
+    t_old = time.perf_counter() - t0
+
+    cols = ['CustomerKey', 'Name', 'TjänstTyp', 'Total_Samtal', 'Genomsnittlig_AHT_Sek', 'Behavior_Segment']
+    pd.testing.assert_frame_equal(df_new[cols], df_old[cols])
+    print(f"-> Radvis (safe_mode + apply): {t_old:.2f}s")
+    print(f"-> Vektoriserad:               {t_new:.2f}s  ({t_old / max(t_new, 1e-9):.1f}x snabbare)")
+    print("-> Resultaten är identiska.")
+    return {'rows_per_sec_old': n_customers / t_old, 'rows_per_sec_new': n_customers / t_new}
+
 if __name__ == '__main__':
-    create_and_save_segments()
\ No newline at end of file
+    if '--benchmark' in sys.argv:
+        args = [a for a in sys.argv[1:] if a != '--benchmark']
+        benchmark_segmentation(int(args[0]) if args else 100000)
+    else:
+        create_and_save_segments()
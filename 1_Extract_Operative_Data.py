@@ -4,7 +4,11 @@ JOBB 1: Extrahera & Tvätta Operativ Data (1_Extract_Operative_Data.py)
 ================================================================
 *** SJUKANMÄLAN-TAGGNING & REDIAL-BERÄKNING ***
 - Matchning: Använder original .str.strip() för att garantera kundmatchning.
-- Redial: Använder 'CallerNr' för korrekt analys.
+- Redial: Använder 'CallerNr' för korrekt analys (vektoriserad motor, detect_redials).
+- Inkrementellt läge (config.SILVER_INCREMENTAL): bearbetar bara dagarna efter
+  Silvers vattenstämpel (+ överlapp), ersätter dessa dagar i Silver och rensar
+  dagar som fallit ur fönstret med en DELETE på Created-indexet.
+- Kundkategori (config.CUSTOMER_CATEGORIES) sparas som 'kategori' i Silver (categorize_customer).
 """
 
 import os
@@ -13,9 +17,11 @@ from sqlalchemy import create_engine, text
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import config
-from DataDriven_utils import map_queue_to_service, get_customer_data
+from DataDriven_utils import map_queue_to_service, get_customer_data_cached, enrich_with_customers, bulk_write, detect_redials, first_touch_sql, FIRST_TOUCH_COLUMNS
+from DataDriven_utils import apply_dtype_plan, memory_mb, widen_for_sql, categorize_customer
 import sys
 import traceback
+import tracemalloc
 import numpy as np 
 
 def get_last_date_from_source(engine):
@@ -31,6 +37,69 @@ def get_last_date_from_source(engine):
         print(f"VARNING: Kunde inte dynamiskt hitta sista datum: {e}")
     return datetime(2025, 10, 10) 
 
+# Inkrementell Silver-byggnad (endast PRODUCTION, VALIDATION bygger alltid om)
+SILVER_INCREMENTAL = getattr(config, 'SILVER_INCREMENTAL', False)
+# Dagar som alltid räknas om (sent inkomna ben / statusändringar)
+SILVER_OVERLAP_DAYS = getattr(config, 'SILVER_OVERLAP_DAYS', 1)
+# Kontext före fönstret: First-Touch för samtal som korsar gränsen + redial-look-back
+SILVER_CONTEXT_HOURS = getattr(config, 'SILVER_CONTEXT_HOURS', 1)
+
+# Dtype-plan för df_enriched: upprepade strängar -> category (eller Arrow-strängar)
+ENRICHED_STRING_COLS = ['Status', 'ChannelType', 'TjänstTyp', 'Name', 'CustomerKey', 'ParentName', 'BillingType', 'LandingNumber', 'kategori']
+SILVER_STRING_DTYPE = getattr(config, 'SILVER_STRING_DTYPE', 'category')
+# Rapportera toppminne (tracemalloc kostar lite prestanda)
+SILVER_MEMORY_REPORT = getattr(config, 'SILVER_MEMORY_REPORT', False)
+
+def get_silver_watermark(engine, table_name):
+    """ Sista dagen i Silver (None om tabellen saknas/är tom). """
+    try:
+        df_max = pd.read_sql(f"SELECT MAX(Created) AS last_created FROM [{table_name}]", engine)
+        if not df_max.empty and pd.notna(df_max.iloc[0]['last_created']):
+            return pd.to_datetime(df_max.iloc[0]['last_created']).tz_localize(None).normalize()
+    except Exception:
+        pass
+    return None
+
+# Kolumner som saknas i äldre Silver-tabeller; saknas de byggs Silver om en gång (inte inkrementellt)
+SILVER_REQUIRED_COLUMNS = ['kategori']
+
+def silver_columns(engine, table_name) -> list:
+    try:
+        return list(pd.read_sql(f"SELECT TOP 0 * FROM [{table_name}]", engine).columns)
+    except Exception:
+        return []
+
+def merge_into_silver(engine, table_name, staging_table, columns, process_start, end_date, retention_start):
+    """
+    Ersätter dagarna [process_start, end_date] i Silver med STAGING och tar bort
+    dagar före retention_start. Allt i en transaktion; index på Created behålls.
+    """
+    col_list = ", ".join([f"[{c}]" for c in columns])
+    with engine.connect() as conn:
+        conn.execute(text(f"""
+            BEGIN TRY
+                BEGIN TRANSACTION;
+                DELETE FROM [{table_name}] WHERE Created >= '{process_start}' AND Created <= '{end_date}';
+                INSERT INTO [{table_name}] ({col_list}) SELECT {col_list} FROM [{staging_table}];
+                DELETE FROM [{table_name}] WHERE Created < '{retention_start}';
+                COMMIT TRANSACTION;
+            END TRY
+            BEGIN CATCH
+                ROLLBACK TRANSACTION;
+                THROW;
+            END CATCH;
+        """))
+        conn.commit()
+
+def ensure_created_index(engine, table_name):
+    """ Klustrat index på Created så att dag-intervall (merge/retention) blir range-scans. """
+    with engine.connect() as conn:
+        conn.execute(text(f"""
+            IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE object_id = OBJECT_ID('{table_name}') AND type = 1)
+            CREATE CLUSTERED INDEX [IX_{table_name}_Created] ON [{table_name}] (Created);
+        """))
+        conn.commit()
+
 def update_dim_queue(mssql_engine):
     print("-> Startar uppdatering av 'Dim_Queue'...")
     try:
@@ -42,7 +111,7 @@ def update_dim_queue(mssql_engine):
         table_name = config.TABLE_NAMES['Queue_Dimension']
         staging_table_name = f"{table_name}_STAGING"
 
-        df_queues.to_sql(staging_table_name, mssql_engine, if_exists='replace', index=False)
+        bulk_write(df_queues, staging_table_name, mssql_engine, if_exists='replace')
         
         sql_transaction = f"""
         IF OBJECT_ID('{table_name}', 'U') IS NOT NULL DROP TABLE [{table_name}];
@@ -57,7 +126,14 @@ def update_dim_queue(mssql_engine):
         print(f"FEL: Kunde inte uppdatera 'Dim_Queue': {e}")
         sys.exit(1)
 
-def update_dim_customer_and_phone(mssql_engine, df_clean_call_data):
+def read_existing_dim(mssql_engine, table_name):
+    """ Befintlig dimension (för inkrementellt läge), tom DataFrame om den saknas. """
+    try:
+        return pd.read_sql(f"SELECT * FROM [{table_name}]", mssql_engine)
+    except Exception:
+        return pd.DataFrame()
+
+def update_dim_customer_and_phone(mssql_engine, df_clean_call_data, merge_existing=False):
     print("-> Startar uppdatering av 'Dim_Customer' och 'Dim_Phone_Lookup'...")
     if df_clean_call_data is None or df_clean_call_data.empty:
         print("FEL: Ingen ren data mottogs.")
@@ -71,9 +147,13 @@ def update_dim_customer_and_phone(mssql_engine, df_clean_call_data):
         df_dim_customer = df_clean_call_data[customer_cols].drop_duplicates(subset=['CustomerKey'])
         
         customer_table_name = config.TABLE_NAMES['Customer_Dimension']
+        if merge_existing:
+            # Inkrementellt: datat täcker bara de senaste dagarna, behåll kända kunder
+            df_existing = read_existing_dim(mssql_engine, customer_table_name)
+            df_dim_customer = pd.concat([df_existing, df_dim_customer], ignore_index=True).drop_duplicates(subset=['CustomerKey'], keep='last')
         customer_staging_table = f"{customer_table_name}_STAGING"
         
-        df_dim_customer.to_sql(customer_staging_table, mssql_engine, if_exists='replace', index=False)
+        bulk_write(df_dim_customer, customer_staging_table, mssql_engine, if_exists='replace')
         
         sql_transaction_cust = f"""
         IF OBJECT_ID('{customer_table_name}', 'U') IS NOT NULL DROP TABLE [{customer_table_name}];
@@ -101,9 +181,12 @@ def update_dim_customer_and_phone(mssql_engine, df_clean_call_data):
         df_phone_lookup = df_phone_lookup.drop_duplicates()
         
         phone_table_name = config.TABLE_NAMES['Phone_Lookup_Dimension']
+        if merge_existing:
+            df_existing = read_existing_dim(mssql_engine, phone_table_name)
+            df_phone_lookup = pd.concat([df_existing, df_phone_lookup], ignore_index=True).drop_duplicates()
         phone_staging_table = f"{phone_table_name}_STAGING"
 
-        df_phone_lookup.to_sql(phone_staging_table, mssql_engine, if_exists='replace', index=False)
+        bulk_write(df_phone_lookup, phone_staging_table, mssql_engine, if_exists='replace')
 
         sql_transaction_phone = f"""
         IF OBJECT_ID('{phone_table_name}', 'U') IS NOT NULL DROP TABLE [{phone_table_name}];
@@ -123,6 +206,8 @@ def update_dim_customer_and_phone(mssql_engine, df_clean_call_data):
 
 def clean_and_export_call_data():
     print(f"Startar skript för datainsamling (BRONZE -> SILVER) - REDIAL V2 (Samma Kö)...")
+    if SILVER_MEMORY_REPORT:
+        tracemalloc.start()
     try:
         mssql_engine = create_engine(config.MSSQL_CONN_STR)
     except Exception as e:
@@ -137,7 +222,7 @@ def clean_and_export_call_data():
         nummer_att_exkludera = []
 
     try:
-        df_customer_mapping = get_customer_data(engine=mssql_engine)
+        df_customer_mapping = get_customer_data_cached(engine=mssql_engine)
         if df_customer_mapping is None: raise Exception("Ingen kunddata.")
         df_customer_mapping['LandingNumber'] = df_customer_mapping['LandingNumber'].astype(str).str.strip()
     except Exception as e:
@@ -159,38 +244,56 @@ def clean_and_export_call_data():
     start_date = start_date_dt.strftime('%Y-%m-%d %H:%M:%S')
     end_date = end_date_dt.strftime('%Y-%m-%d %H:%M:%S')
 
-    print(f"-> Bearbetar data: {start_date} till {end_date}.")
+    tn_train = config.TABLE_NAMES['Operative_Training_Data']
+    tn_ab = config.TABLE_NAMES['Abandoned_Calls_Report']
+
+    # Inkrementellt: bara dagar efter Silvers vattenstämpel (minus överlapp)
+    process_start_dt = start_date_dt
+    incremental = False
+    if SILVER_INCREMENTAL and config.RUN_MODE != 'VALIDATION':
+        silver_last_day = get_silver_watermark(mssql_engine, tn_train)
+        schema_ok = all(set(SILVER_REQUIRED_COLUMNS) <= set(silver_columns(mssql_engine, tn)) for tn in (tn_train, tn_ab))
+        if silver_last_day is not None and not schema_ok:
+            print(f"-> Silver saknar kolumnerna {SILVER_REQUIRED_COLUMNS}, bygger om hela fönstret.")
+        elif silver_last_day is not None:
+            candidate = silver_last_day + relativedelta(days=1) - relativedelta(days=SILVER_OVERLAP_DAYS)
+            if candidate > start_date_dt:
+                process_start_dt = candidate
+                incremental = True
+    read_start_dt = process_start_dt - relativedelta(hours=SILVER_CONTEXT_HOURS) if incremental else process_start_dt
+    process_start = process_start_dt.strftime('%Y-%m-%d %H:%M:%S')
+    read_start = read_start_dt.strftime('%Y-%m-%d %H:%M:%S')
+
+    if incremental:
+        print(f"-> INKREMENTELLT: Bearbetar {process_start} till {end_date} (fönster från {start_date}).")
+    else:
+        print(f"-> Bearbetar data: {start_date} till {end_date}.")
 
     # === STEG 4: SQL ===
     exclude_queues_str = ", ".join([f"'{str(qid)}'" for qid in config.EXCLUDE_QUEUE_IDS])
     bronze_cdr = config.BRONZE_TABLES['cdr']
 
-    query = f"""
-        WITH CallData AS (
-            SELECT * FROM [{bronze_cdr}]
-            WHERE Created BETWEEN '{start_date}' AND '{end_date}'
-        ),
-        CalculatedMetrics AS (
-            SELECT
-                CallId, Status, Created, LandingNumber, ChannelType, QueueId,
-                callerNr,
-                TalkTimeInSec, Duration, CaseId,
-                FIRST_VALUE(QueueId) OVER (PARTITION BY CallId ORDER BY Created ASC) as First_QueueId,
-                FIRST_VALUE(Created) OVER (PARTITION BY CallId ORDER BY Created ASC) as First_Created,
-                FIRST_VALUE(LandingNumber) OVER (PARTITION BY CallId ORDER BY Created ASC) as First_LandingNumber,
-                FIRST_VALUE(callerNr) OVER (PARTITION BY CallId ORDER BY Created ASC) as First_CallerNr,
-                FIRST_VALUE(ChannelType) OVER (PARTITION BY CallId ORDER BY Created ASC) as First_ChannelType,
-                LAST_VALUE(Status) OVER (PARTITION BY CallId ORDER BY Created ASC ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) as Last_Status,
-                ROW_NUMBER() OVER (PARTITION BY CallId ORDER BY Created ASC) as rn_first
-            FROM CallData
+    # Materialiserad First-Touch-tabell (underhålls av Jobb 0) -> enkel range-scan.
+    # Fallback: beräkna fönsterfunktionerna över Bronze CDR som tidigare.
+    first_touch_table = config.BRONZE_TABLES.get('first_touch', 'Bronze_Call_First_Touch')
+    use_first_touch = False
+    if getattr(config, 'SILVER_USE_FIRST_TOUCH', True):
+        with mssql_engine.connect() as conn:
+            use_first_touch = conn.execute(text(f"SELECT OBJECT_ID('{first_touch_table}', 'U')")).scalar() is not None
+
+    if use_first_touch:
+        print(f"-> Läser First-Touch från '{first_touch_table}'.")
+        query = f"""
+            SELECT {', '.join(FIRST_TOUCH_COLUMNS)}
+            FROM [{first_touch_table}]
+            WHERE Created BETWEEN '{read_start}' AND '{end_date}'
+            AND QueueId NOT IN ({exclude_queues_str})
+        """
+    else:
+        query = first_touch_sql(
+            f"SELECT * FROM [{bronze_cdr}] WHERE Created BETWEEN '{read_start}' AND '{end_date}'",
+            extra_where=f"AND First_QueueId NOT IN ({exclude_queues_str})"
         )
-        SELECT
-            CallId, First_Created AS Created, First_LandingNumber AS LandingNumber, First_CallerNr AS CallerNr,
-            First_ChannelType AS ChannelType, First_QueueId AS QueueId, CaseId,
-            Last_Status AS Status, Duration, TalkTimeInSec
-        FROM CalculatedMetrics
-        WHERE rn_first = 1 AND First_QueueId NOT IN ({exclude_queues_str})
-    """
     
     try:
         df_all_calls = pd.read_sql(query, mssql_engine)
@@ -202,71 +305,77 @@ def clean_and_export_call_data():
         df_clean = df_all_calls[~df_all_calls['LandingNumber'].isin(nummer_att_exkludera)]
         df_clean = df_clean[df_clean['LandingNumber'] != '']
         
-        df_enriched = pd.merge(df_clean, df_customer_mapping, on='LandingNumber', how='left')
+        df_enriched = enrich_with_customers(df_clean, df_customer_mapping)
         
-        df_enriched['är_dotterbolag'] = (~df_enriched['ParentId'].isin([0, pd.NA, np.nan, None, ''])).astype(int)
         df_enriched['Name'] = df_enriched['Name'].fillna('Okänd Kund')
+        # Kundkategori per unikt namn (är_dotterbolag sätts nedan som tidigare)
+        df_enriched = categorize_customer(df_enriched)
+        df_enriched['är_dotterbolag'] = (~df_enriched['ParentId'].isin([0, pd.NA, np.nan, None, ''])).astype(int)
         df_enriched['CustomerKey'] = df_enriched['CustomerKey'].fillna('Okänd')
         df_enriched['TjänstTyp'] = df_enriched['QueueId'].apply(map_queue_to_service)
+        del df_all_calls, df_clean
+
+        # Kompakta typer innan redial/sortering (som kopierar hela ramen)
+        mb_before = memory_mb(df_enriched)
+        df_enriched = apply_dtype_plan(df_enriched, ENRICHED_STRING_COLS, string_dtype=SILVER_STRING_DTYPE)
+        print(f"-> Minne df_enriched: {mb_before:.0f} MB -> {memory_mb(df_enriched):.0f} MB (dtype-plan).")
         
         # === REDIAL LOGIK (V2: SAMMA KÖ & STRIKT NUMMER) ===
         print("-> Beräknar Redial (Krav: Samma Kö & < 5 min)...")
         
-        # 1. Tvätta nummer
-        df_enriched['CallerNr_Clean'] = df_enriched['CallerNr'].astype(str).str.replace(r'\D', '', regex=True)
-        
-        # 2. Sortera
-        df_enriched = df_enriched.sort_values(by=['CallerNr_Clean', 'Created']).reset_index(drop=True)
-        
-        # 3. Hämta FÖREGÅENDE data för samma nummer
-        df_enriched['Prev_Created'] = df_enriched.groupby('CallerNr_Clean')['Created'].shift(1)
-        df_enriched['Prev_Status'] = df_enriched.groupby('CallerNr_Clean')['Status'].shift(1)
-        df_enriched['Prev_QueueId'] = df_enriched.groupby('CallerNr_Clean')['QueueId'].shift(1)
-        
-        df_enriched['Time_Diff_Sec'] = (df_enriched['Created'] - df_enriched['Prev_Created']).dt.total_seconds()
-
-        REDIAL_THRESHOLD_SEC = getattr(config, 'REDIAL_THRESHOLD_SEC', 300)
-        df_enriched['is_redial'] = 0
-        
-        # 4. Logik:
+        # Logik (se detect_redials):
         # - Giltigt nummer (> 6 siffror)
         # - Inom 5 minuter
         # - Föregående var 'callabandoned'
         # - OCH: Det är SAMMA KÖ (QueueId == Prev_QueueId)
+        REDIAL_THRESHOLD_SEC = getattr(config, 'REDIAL_THRESHOLD_SEC', 300)
+        is_redial, redial_order, _ = detect_redials(df_enriched, threshold_sec=REDIAL_THRESHOLD_SEC)
         
-        is_valid_number = (df_enriched['CallerNr_Clean'].str.len() >= 7)
-        is_short_time = (df_enriched['Time_Diff_Sec'] <= REDIAL_THRESHOLD_SEC) & (df_enriched['Time_Diff_Sec'] > 0)
-        was_abandoned = df_enriched['Prev_Status'].str.lower() == 'callabandoned'
-        is_same_queue = (df_enriched['QueueId'] == df_enriched['Prev_QueueId'])
-        
-        df_enriched.loc[is_valid_number & is_short_time & was_abandoned & is_same_queue, 'is_redial'] = 1
+        # Samma radordning som tidigare (nummer, tid)
+        df_enriched = df_enriched.iloc[redial_order].reset_index(drop=True)
+        df_enriched['is_redial'] = is_redial[redial_order]
         
         print(f"-> Identifierade {df_enriched['is_redial'].sum()} äkta återuppringningar.")
-        
-        # Städa
-        df_enriched.drop(columns=['Prev_Created', 'Time_Diff_Sec', 'Prev_Status', 'Prev_QueueId', 'CallerNr_Clean'], inplace=True)
+
+        # Kontext-raderna (före fönstret) finns redan i Silver
+        if incremental:
+            df_enriched = df_enriched[df_enriched['Created'] >= process_start_dt].reset_index(drop=True)
 
         # === SPARA ===
+        # Datum läggs på en gång, sedan används urval utan extra .copy()
+        df_enriched['Datum'] = df_enriched['Created'].dt.date
+
         # Abandoned Report
-        df_abandoned = df_enriched[df_enriched['Status'].str.lower() == 'callabandoned'].copy()
-        df_abandoned['Datum'] = df_abandoned['Created'].dt.date
-        tn_ab = config.TABLE_NAMES['Abandoned_Calls_Report']
-        df_abandoned.to_sql(f"{tn_ab}_STAGING", mssql_engine, if_exists='replace', index=False)
-        with mssql_engine.connect() as conn:
-            conn.execute(text(f"IF OBJECT_ID('{tn_ab}', 'U') IS NOT NULL DROP TABLE [{tn_ab}]; SELECT * INTO [{tn_ab}] FROM [{tn_ab}_STAGING];"))
-            conn.commit()
+        df_abandoned = df_enriched[df_enriched['Status'].str.lower() == 'callabandoned']
+        # SQL-schemat ska inte ärva dtype-planens krympta heltal (BIGINT/FLOAT som tidigare)
+        bulk_write(widen_for_sql(df_abandoned), f"{tn_ab}_STAGING", mssql_engine, if_exists='replace')
+        if incremental:
+            merge_into_silver(mssql_engine, tn_ab, f"{tn_ab}_STAGING", list(df_abandoned.columns), process_start, end_date, start_date)
+        else:
+            with mssql_engine.connect() as conn:
+                conn.execute(text(f"IF OBJECT_ID('{tn_ab}', 'U') IS NOT NULL DROP TABLE [{tn_ab}]; SELECT * INTO [{tn_ab}] FROM [{tn_ab}_STAGING];"))
+                conn.commit()
 
         # Main Data
-        tn_train = config.TABLE_NAMES['Operative_Training_Data']
-        final_cols = ['CallId', 'CaseId', 'Created', 'Status', 'Duration', 'TalkTimeInSec', 'ChannelType', 'LandingNumber', 'CallerNr', 'QueueId', 'Name', 'CustomerKey', 'är_dotterbolag', 'TjänstTyp', 'is_redial']
-        df_save = df_enriched[[c for c in final_cols if c in df_enriched.columns]].copy()
-        df_save['Datum'] = df_save['Created'].dt.date
+        final_cols = ['CallId', 'CaseId', 'Created', 'Status', 'Duration', 'TalkTimeInSec', 'ChannelType', 'LandingNumber', 'CallerNr', 'QueueId', 'Name', 'CustomerKey', 'kategori', 'är_dotterbolag', 'TjänstTyp', 'is_redial']
+        df_save = df_enriched[[c for c in final_cols if c in df_enriched.columns] + ['Datum']]
         
         print(f"-> Sparar {len(df_save)} rader till {tn_train}...")
-        df_save.to_sql(f"{tn_train}_STAGING", mssql_engine, if_exists='replace', index=False, chunksize=5000)
-        with mssql_engine.connect() as conn:
-            conn.execute(text(f"IF OBJECT_ID('{tn_train}', 'U') IS NOT NULL DROP TABLE [{tn_train}]; SELECT * INTO [{tn_train}] FROM [{tn_train}_STAGING];"))
-            conn.commit()
+        bulk_write(widen_for_sql(df_save), f"{tn_train}_STAGING", mssql_engine, if_exists='replace')
+        if incremental:
+            merge_into_silver(mssql_engine, tn_train, f"{tn_train}_STAGING", list(df_save.columns), process_start, end_date, start_date)
+        else:
+            with mssql_engine.connect() as conn:
+                conn.execute(text(f"IF OBJECT_ID('{tn_train}', 'U') IS NOT NULL DROP TABLE [{tn_train}]; SELECT * INTO [{tn_train}] FROM [{tn_train}_STAGING];"))
+                conn.commit()
+        if SILVER_INCREMENTAL:
+            ensure_created_index(mssql_engine, tn_train)
+            ensure_created_index(mssql_engine, tn_ab)
+
+        if SILVER_MEMORY_REPORT:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"-> Toppminne (tracemalloc): {peak / (1024 * 1024):.0f} MB.")
 
         return df_enriched, mssql_engine
 
@@ -278,7 +387,8 @@ def clean_and_export_call_data():
 if __name__ == '__main__':
     df_clean_data, engine = clean_and_export_call_data()
     if engine and df_clean_data is not None:
-        update_dim_customer_and_phone(mssql_engine=engine, df_clean_call_data=df_clean_data) 
+        merge_existing = SILVER_INCREMENTAL and config.RUN_MODE != 'VALIDATION'
+        update_dim_customer_and_phone(mssql_engine=engine, df_clean_call_data=df_clean_data, merge_existing=merge_existing) 
         update_dim_queue(mssql_engine=engine)
     else:
         print("FATALT FEL: Huvudprocessen misslyckades.")
@@ -4,39 +4,91 @@ JOBB 2: Träna Operativ Modell
 ================================================================
 - Sparar 'cat_dtypes' i modellen. Detta är nyckeln för att prognosen
   ska förstå att "Kundtjänst" är samma sak som "Kundtjänst".
+- SQL_PUSHDOWN: timaggregatet (Timme x TjänstTyp x Segment) beräknas i MSSQL,
+  pandas-vägen finns kvar som reserv och ger samma resultat.
+- Modellerna tränas parallellt i processer (TRAIN_MAX_WORKERS) med en
+  trådbudget per modell (TRAIN_THREADS / antal samtidiga), tid per modell rapporteras.
+- Binnat träningsdataset (lgb.Dataset) byggs EN gång per feature-matris och körning och delas
+  mellan objectives (binär i en temporär katalog, DATASET_WORK_DIR). Ingen cache mellan
+  körningar: datat ändras varje dag och bin-gränserna ska följa det.
+- TRAIN_MODE='INCREMENTAL': gårdagens modeller boostas vidare (eller refit av lövvärden)
+  på ett kort fönster. Full träning vid schema (TRAIN_FULL_EVERY_DAYS), drift eller
+  nya kategorier. Baslinjen är fullträningens loss på de sista TRAIN_VALIDATION_DAYS dagarna
+  (modell tränad utan dem); en inkrementell version publiceras bara om samma uppdatering,
+  validerad på holdout, håller sig inom TRAIN_DRIFT_RATIO x baslinjen -> annars full träning.
+  Baslinjemodellerna tränas på en delmängd av det delade datasetet i samma processpool.
+  CONTINUE växer med TRAIN_INCREMENTAL_ROUNDS träd per dag; vid TRAIN_MAX_TREES
+  (default 2 x num_boost_round) tränas fullt.
+  Kontroll mot full träning: --validate-incremental.
+- Modellregister (MODEL_DIR/registry): varje körning blir en version (LightGBM-textformat +
+  manifest.json) och 'current' pekas om atomiskt. --list-models, --rollback [version].
+  Varje modell exporteras även till en kompilerad NumPy-prediktor (.npz), verifierad exakt mot LightGBM.
+- TRAIN_GRID_MODE='OPEN_HOURS': timrutnätet innehåller bara öppettider (config.OPENING_HOURS)
+  + timmar med faktiska samtal. Lags via tätt positionsindex -> samma värden som fulla rutnätet.
+- HISTORY_INCREMENTAL: Hourly_Aggregated_History byggs inte om varje körning; bara timmar från
+  senast lagrade dag - HISTORY_OVERLAP_DAYS räknas om och ersätts, lags fylls ur lagrad historik.
+  Nya kunder i segmentdimensionen tvingar ingen ombyggnad; omsegmenterade kunder gör det
+  (HISTORY_RESEGMENT_REBUILD), liksom nya (TjänstTyp, Segment)-kombinationer, och en full
+  ombyggnad sker var HISTORY_FULL_REBUILD_DAYS:e dag. Historiken kontrolleras vara tät efter uppdateringen.
+  Tabellen har klustrat index på ds (range-frågorna i jobb 3 och 4).
 """
 
 import pandas as pd
 import numpy as np
 import lightgbm as lgb
-import pickle
 import os
-from DataDriven_utils import add_all_features, create_lag_features 
+import time
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from DataDriven_utils import add_all_features, create_dense_lag_features, bulk_write, is_open_hour
+from DataDriven_utils import (begin_model_version, discard_model_version, staged_model_path, model_manifest_entry, publish_model_version,
+                              registered_model_path, list_model_versions, get_current_version, rollback_model_version,
+                              compile_registered_model, read_model_manifest)
 import config
 from sqlalchemy import create_engine, text
 import sys
 import re
+import json
 
-def train_final_system():
-    print("--- Startar TRÄNING (KATEGORI FIX) ---")
-    try:
-        mssql_engine = create_engine(config.MSSQL_CONN_STR)
-    except Exception as e:
-        print(f"FATALT FEL: {e}")
-        sys.exit(1)
+HOURLY_AGG_COLUMNS = ['Created', 'TjänstTyp', 'Behavior_Segment', 'Antal_Samtal',
+                      'Total_Samtalstid_Sek', 'Total_V_ntetid_Sek', 'Antal_Besvarade_Samtal']
 
-    # 1. Läs data
-    table_name_training = config.TABLE_NAMES['Operative_Training_Data']
-    print(f"-> Läser data från {table_name_training}...")
+def read_hourly_agg_sql(mssql_engine, table_name_training, since=None):
+    """ Timaggregatet direkt i MSSQL: endast (timme, tjänst, segment)-rader överförs. """
+    table_name_segments = config.TABLE_NAMES['Customer_Behavior_Dimension']
+    hour_expr = "DATEADD(hour, DATEDIFF(hour, 0, r.Created), 0)"
+    service_expr = "COALESCE(LTRIM(RTRIM(r.[TjänstTyp])), 'None')"
+    segment_expr = "COALESCE(LTRIM(RTRIM(s.Behavior_Segment)), N'Okänt')"
+    wait_expr = "r.Duration - r.TalkTimeInSec"
+    df_hourly_agg = pd.read_sql(f"""
+        SELECT {hour_expr} AS Created,
+               {service_expr} AS [TjänstTyp],
+               {segment_expr} AS Behavior_Segment,
+               COUNT(*) AS Antal_Samtal,
+               SUM(r.TalkTimeInSec) AS Total_Samtalstid_Sek,
+               SUM(CASE WHEN {wait_expr} < 0 THEN 0 ELSE {wait_expr} END) AS Total_V_ntetid_Sek,
+               SUM(CASE WHEN LOWER(r.Status) = 'callabandoned' THEN 0 ELSE 1 END) AS Antal_Besvarade_Samtal
+        FROM [{table_name_training}] r
+        LEFT JOIN [{table_name_segments}] s ON s.CustomerKey = r.CustomerKey
+        WHERE r.[ChannelType] = 'call' AND r.Created IS NOT NULL{f" AND r.Created >= '{since}'" if since is not None else ""}
+        GROUP BY {hour_expr}, {service_expr}, {segment_expr}
+    """, mssql_engine)
+    df_hourly_agg['Created'] = pd.to_datetime(df_hourly_agg['Created'])
+    # Samma ordning som groupby i pandas-vägen
+    df_hourly_agg = df_hourly_agg.sort_values(['Created', 'TjänstTyp', 'Behavior_Segment']).reset_index(drop=True)
+    print(f"-> Läste {len(df_hourly_agg)} aggregerade timrader (SQL-pushdown).")
+    return df_hourly_agg[HOURLY_AGG_COLUMNS]
+
+def read_hourly_agg_pandas(mssql_engine, table_name_training, since=None):
     sql_query = f'''
         SELECT [Created], [CustomerKey], [TjänstTyp], [ChannelType], 
                [TalkTimeInSec], [Duration], [Status]
         FROM [{table_name_training}] 
-        WHERE [ChannelType] = 'call'
+        WHERE [ChannelType] = 'call'{f" AND [Created] >= '{since}'" if since is not None else ""}
     '''
     df_raw = pd.read_sql(sql_query, mssql_engine)
     df_raw['Created'] = pd.to_datetime(df_raw['Created']).dt.tz_localize(None)
-    
+
     # Tvätta text
     df_raw['TjänstTyp'] = df_raw['TjänstTyp'].astype(str).str.strip()
 
@@ -64,12 +116,36 @@ def train_final_system():
         Total_V_ntetid_Sek=('WaitTime', 'sum'),
         Antal_Besvarade_Samtal=('is_answered', 'sum')
     ).reset_index()
+    return df_hourly_agg
+
+def read_hourly_agg(mssql_engine, table_name_training, since=None):
+    if getattr(config, 'SQL_PUSHDOWN', False):
+        try:
+            return read_hourly_agg_sql(mssql_engine, table_name_training, since)
+        except Exception as e:
+            print(f"   VARNING: SQL-pushdown misslyckades ({e}), aggregerar i pandas.")
+    return read_hourly_agg_pandas(mssql_engine, table_name_training, since)
 
-    # Grid
-    start_time = df_hourly_agg['Created'].min()
+def build_hourly_grid(df_hourly_agg: pd.DataFrame, sparse_grid: bool = False, start_time=None,
+                      extra_combos: pd.DataFrame = None, lag_source: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Timrutnät (timmar x (TjänstTyp, Segment)) med features och lags.
+    Inkrementellt: start_time = första timme att räkna om, extra_combos = kombinationer som
+    redan finns i historiken och lag_source = lagrade rader (ds, Tj_nstTyp, Behavior_Segment,
+    Antal_Samtal) före start_time som lagarna för de nya timmarna hämtas från.
+    """
+    if start_time is None:
+        start_time = df_hourly_agg['Created'].min()
     end_time = df_hourly_agg['Created'].max()
     all_hours = pd.date_range(start=start_time, end=end_time, freq='h')
+    if sparse_grid:
+        # Stängda timmar utan samtal är alltid 0 -> lagras inte (saknad cell = 0 i lagmotorn)
+        n_dense = len(all_hours)
+        all_hours = all_hours[is_open_hour(all_hours) | all_hours.isin(df_hourly_agg['Created'])]
+        print(f"-> Öppettidsrutnät: {len(all_hours)} av {n_dense} timmar.")
     unique_combos = df_hourly_agg[['TjänstTyp', 'Behavior_Segment']].drop_duplicates()
+    if extra_combos is not None:
+        unique_combos = pd.concat([unique_combos, extra_combos], ignore_index=True).drop_duplicates()
     df_master = pd.merge(pd.DataFrame({'Created': all_hours}), unique_combos, how='cross')
     
     df_final = pd.merge(df_master, df_hourly_agg, on=['Created', 'TjänstTyp', 'Behavior_Segment'], how='left')
@@ -82,20 +158,571 @@ def train_final_system():
     print(f"-> Skapar lags för {len(df_final)} rader...")
     df_final = add_all_features(df_final, ds_col='ds')
     df_final.columns = [re.sub(r'[^A-Za-z0-9_]+', '_', col) for col in df_final.columns]
-    df_final = create_lag_features(df_final, group_cols=['Tj_nstTyp', 'Behavior_Segment'], target_col='Antal_Samtal', lags=[1, 7, 14, 28, 364])
-    
-    # Spara Historik
-    tn_hist = config.TABLE_NAMES['Hourly_Aggregated_History']
-    df_final.to_sql(f"{tn_hist}_STAGING", mssql_engine, if_exists='replace', index=False, chunksize=50000)
-    with mssql_engine.connect() as conn:
-        conn.execute(text(f"IF OBJECT_ID('{tn_hist}', 'U') IS NOT NULL DROP TABLE [{tn_hist}]; SELECT * INTO [{tn_hist}] FROM [{tn_hist}_STAGING];"))
+    # Rutnätet ovan är tätt (alla timmar x alla kombinationer), eller glest med positionsindex -> matris-lagmotorn
+    lag_kwargs = dict(group_cols=['Tj_nstTyp', 'Behavior_Segment'], target_col='Antal_Samtal', lags=[1, 7, 14, 28, 364], freq='h')
+    if lag_source is None:
+        return create_dense_lag_features(df_final, **lag_kwargs, fill_missing=0.0 if sparse_grid else None)
+
+    # Lags för nya timmar ur lagrad historik; saknad cell = 0 som i det fullständiga rutnätet
+    key_cols = ['ds', 'Tj_nstTyp', 'Behavior_Segment', 'Antal_Samtal']
+    df_lags = pd.concat([lag_source[key_cols].assign(_rad=-1),
+                         df_final[key_cols].assign(_rad=np.arange(len(df_final)))], ignore_index=True)
+    df_lags = create_dense_lag_features(df_lags, **lag_kwargs, fill_missing=0.0)
+    df_lags = df_lags[df_lags['_rad'] >= 0].sort_values('_rad')
+    lag_cols = [c for c in df_lags.columns if c.startswith('Antal_Samtal_lag_')]
+    df_final[lag_cols] = df_lags[lag_cols].to_numpy()
+    return df_final.sort_values(by=['Tj_nstTyp', 'Behavior_Segment', 'ds'])
+
+def complete_daily_grid(df_daily: pd.DataFrame, df_hourly: pd.DataFrame) -> pd.DataFrame:
+    """
+    Fyller ut ett dag-aggregat (index: ds, nyckel) till alla dagar x alla nycklar med 0,
+    som när det aggregeras från det fulla timrutnätet (öppettidsrutnätet saknar t.ex. helger).
+    """
+    days = pd.date_range(df_hourly['ds'].min().normalize(), df_hourly['ds'].max().normalize(), freq='D')
+    keys = df_daily.index.get_level_values(1).unique().sort_values()
+    full_index = pd.MultiIndex.from_product([days, keys], names=df_daily.index.names)
+    if len(df_daily) == len(full_index):
+        return df_daily.reset_index()
+    dtypes = df_daily.dtypes
+    return df_daily.reindex(full_index, fill_value=0).astype(dtypes).reset_index()
+
+# --- TIMHISTORIK (Hourly_Aggregated_History) ---
+HISTORY_TRAINING_COLUMNS = ['ds', 'Tj_nstTyp', 'Behavior_Segment', 'Antal_Samtal',
+                            'Total_Samtalstid_Sek', 'Total_V_ntetid_Sek', 'Antal_Besvarade_Samtal']
+
+def read_segment_dimension(engine) -> pd.DataFrame:
+    """ (CustomerKey, Behavior_Segment) som timaggregatet använder; tom om dimensionen saknas. """
+    table_name_segments = config.TABLE_NAMES['Customer_Behavior_Dimension']
+    try:
+        df_dim = pd.read_sql(f"SELECT CustomerKey, Behavior_Segment FROM [{table_name_segments}]", engine)
+    except Exception:
+        return pd.DataFrame(columns=['CustomerKey', 'Behavior_Segment'])
+    df_dim['Behavior_Segment'] = df_dim['Behavior_Segment'].fillna('Okänt').astype(str).str.strip()
+    return df_dim
+
+def segment_changes(df_dim: pd.DataFrame, snapshot_table: str, engine):
+    """
+    Jämför segmentdimensionen med ögonblicksbilden från när historiken senast skrevs.
+    Returnerar (omsegmenterade/borttagna kunder, nya kunder), eller None om bilden saknas.
+    """
+    try:
+        df_snap = pd.read_sql(f"SELECT CustomerKey, Behavior_Segment FROM [{snapshot_table}]", engine)
+    except Exception:
+        return None
+    merged = pd.merge(df_snap, df_dim, on='CustomerKey', how='outer', suffixes=('_old', '_new'), indicator=True)
+    both = merged['_merge'] == 'both'
+    changed = (merged['_merge'] == 'left_only') | (both & (merged['Behavior_Segment_old'] != merged['Behavior_Segment_new']))
+    return int(changed.sum()), int((merged['_merge'] == 'right_only').sum())
+
+def read_history_meta(engine, meta_table):
+    try:
+        df_meta = pd.read_sql(f"SELECT * FROM [{meta_table}]", engine)
+        return None if df_meta.empty else df_meta.iloc[0]
+    except Exception:
+        return None
+
+def write_history_meta(engine, meta_table, last_hour, grid_mode, last_full):
+    df_meta = pd.DataFrame([{'Last_Hour': pd.Timestamp(last_hour), 'Grid_Mode': grid_mode,
+                             'Last_Full': pd.Timestamp(last_full)}])
+    bulk_write(df_meta, meta_table, engine, if_exists='replace')
+
+def history_columns(engine, tn_hist) -> list:
+    try:
+        return list(pd.read_sql(f"SELECT TOP 0 * FROM [{tn_hist}]", engine).columns)
+    except Exception:
+        return []
+
+def history_is_dense(df_hist: pd.DataFrame) -> bool:
+    """ Tätt rutnät: varje (Tj_nstTyp, Behavior_Segment) har en rad för varje lagrad timme (lagmotorn kräver det). """
+    sizes = df_hist.groupby(['Tj_nstTyp', 'Behavior_Segment'], observed=True).size()
+    return bool((sizes == df_hist['ds'].nunique()).all())
+
+def rebuild_history(engine, table_name_training, tn_hist, sparse_grid):
+    """ Bygger om hela historiktabellen (med klustrat index på ds för jobb 3/4). """
+    df_final = build_hourly_grid(read_hourly_agg(engine, table_name_training), sparse_grid)
+    bulk_write(df_final, f"{tn_hist}_STAGING", engine, if_exists='replace')
+    with engine.connect() as conn:
+        conn.execute(text(f"""
+            BEGIN TRY
+                BEGIN TRANSACTION;
+                IF OBJECT_ID('{tn_hist}', 'U') IS NOT NULL DROP TABLE [{tn_hist}];
+                SELECT * INTO [{tn_hist}] FROM [{tn_hist}_STAGING];
+                CREATE CLUSTERED INDEX [IX_{tn_hist}_ds] ON [{tn_hist}] (ds);
+                COMMIT TRANSACTION;
+            END TRY
+            BEGIN CATCH
+                ROLLBACK TRANSACTION;
+                THROW;
+            END CATCH;
+        """))
         conn.commit()
+    return df_final
+
+def update_history(engine, table_name_training, tn_hist, sparse_grid):
+    """
+    Uppdaterar Hourly_Aggregated_History och returnerar timraderna som träningen behöver.
+    HISTORY_INCREMENTAL: endast timmar från (senast lagrade dag - HISTORY_OVERLAP_DAYS)
+    räknas om och ersätts (korrigerade dagar i Silver), lags hämtas ur lagrad historik.
+    Full ombyggnad vid första körning, byte av rutnätsläge, nytt kolumnschema, var
+    HISTORY_FULL_REBUILD_DAYS:e dag, samt när befintliga kunder bytt segment
+    (HISTORY_RESEGMENT_REBUILD, default True). Nya kunder ger ingen ombyggnad: deras
+    redan lagrade timmar ligger kvar under 'Okänt' tills nästa fulla ombyggnad.
+    En ny (TjänstTyp, Segment)-kombination ger full ombyggnad, annars skulle den sakna
+    rader före fönstret; historiken kontrolleras vara tät efter varje inkrementell uppdatering.
+    """
+    grid_mode = 'OPEN_HOURS' if sparse_grid else 'DENSE'
+    meta_table = f"{tn_hist}_Meta"
+    snapshot_table = f"{tn_hist}_Segments"
+    if not getattr(config, 'HISTORY_INCREMENTAL', False):
+        return rebuild_history(engine, table_name_training, tn_hist, sparse_grid)
+
+    df_dim = read_segment_dimension(engine)
+    today = pd.Timestamp.now().normalize()
+
+    def full_rebuild(reason):
+        print(f"-> Bygger '{tn_hist}' från grunden ({reason})...")
+        df_full = rebuild_history(engine, table_name_training, tn_hist, sparse_grid)
+        bulk_write(df_dim, snapshot_table, engine, if_exists='replace')
+        write_history_meta(engine, meta_table, df_full['ds'].max(), grid_mode, today)
+        return df_full
+
+    meta = read_history_meta(engine, meta_table)
+    if meta is None or 'Last_Full' not in meta.index:
+        return full_rebuild('ingen tidigare historik')
+    if str(meta['Grid_Mode']) != grid_mode:
+        return full_rebuild('nytt rutnätsläge')
+    full_every = int(getattr(config, 'HISTORY_FULL_REBUILD_DAYS', 7))
+    if (today - pd.Timestamp(meta['Last_Full']).normalize()).days >= full_every:
+        return full_rebuild(f'schemalagd var {full_every}:e dag')
+    changes = segment_changes(df_dim, snapshot_table, engine)
+    if changes is None:
+        return full_rebuild('segmentbild saknas')
+    n_changed, n_new = changes
+    if n_changed and getattr(config, 'HISTORY_RESEGMENT_REBUILD', True):
+        return full_rebuild(f'{n_changed} kunder har bytt segment')
+    if n_changed or n_new:
+        print(f"   -> Segment: {n_new} nya kunder, {n_changed} omsegmenterade (gäller nya timmar).")
+    stored_columns = history_columns(engine, tn_hist)
+    if not stored_columns:
+        return full_rebuild('historiktabellen saknas')
+
+    overlap_days = int(getattr(config, 'HISTORY_OVERLAP_DAYS', getattr(config, 'SILVER_OVERLAP_DAYS', 1)))
+    from_hour = pd.Timestamp(meta['Last_Hour']).normalize() - pd.Timedelta(days=overlap_days)
+    print(f"-> Inkrementell uppdatering av '{tn_hist}' från {from_hour.date()}...")
+    df_hourly_agg = read_hourly_agg(engine, table_name_training, since=from_hour)
+
+    if not df_hourly_agg.empty:
+        # Lagkälla: längsta lag (364 d) + en veckas marginal så att fönstrets början alltid har rader
+        lag_start = from_hour - pd.Timedelta(days=364 + 7)
+        df_source = pd.read_sql(f"""
+            SELECT ds, Tj_nstTyp, Behavior_Segment, Antal_Samtal FROM [{tn_hist}]
+            WHERE ds >= '{lag_start}' AND ds < '{from_hour}'
+        """, engine)
+        df_source['ds'] = pd.to_datetime(df_source['ds'])
+        combos = pd.read_sql(f"SELECT DISTINCT Tj_nstTyp AS [TjänstTyp], Behavior_Segment FROM [{tn_hist}]", engine)
+        new_combos = pd.merge(df_hourly_agg[['TjänstTyp', 'Behavior_Segment']].drop_duplicates(), combos,
+                              how='left', indicator=True)
+        n_new_combos = int((new_combos['_merge'] == 'left_only').sum())
+        if n_new_combos:
+            return full_rebuild(f'{n_new_combos} nya kombinationer (TjänstTyp, Segment)')
+        df_new = build_hourly_grid(df_hourly_agg, sparse_grid, start_time=from_hour,
+                                   extra_combos=combos, lag_source=df_source)
+        if sorted(df_new.columns) != sorted(stored_columns):
+            return full_rebuild('kolumnschemat har ändrats')
+
+        col_list = ", ".join([f"[{c}]" for c in stored_columns])
+        bulk_write(df_new[stored_columns], f"{tn_hist}_STAGING", engine, if_exists='replace')
+        with engine.connect() as conn:
+            conn.execute(text(f"""
+                BEGIN TRY
+                    BEGIN TRANSACTION;
+                    DELETE FROM [{tn_hist}] WHERE ds >= '{from_hour}';
+                    INSERT INTO [{tn_hist}] ({col_list}) SELECT {col_list} FROM [{tn_hist}_STAGING];
+                    COMMIT TRANSACTION;
+                END TRY
+                BEGIN CATCH
+                    ROLLBACK TRANSACTION;
+                    THROW;
+                END CATCH;
+            """))
+            conn.commit()
+        write_history_meta(engine, meta_table, df_new['ds'].max(), grid_mode, meta['Last_Full'])
+        print(f"   -> {len(df_new)} timrader omräknade.")
+    if n_changed or n_new:
+        bulk_write(df_dim, snapshot_table, engine, if_exists='replace')
+
+    col_list = ", ".join([f"[{c}]" for c in HISTORY_TRAINING_COLUMNS])
+    df_final = pd.read_sql(f"SELECT {col_list} FROM [{tn_hist}]", engine)
+    df_final['ds'] = pd.to_datetime(df_final['ds'])
+    if not history_is_dense(df_final):
+        return full_rebuild('historiken är inte tät efter inkrementell uppdatering')
+    return df_final
+
+# --- DELAT BINNAT DATASET ---
+def pandas_categorical_of(X: pd.DataFrame) -> list:
+    """ Samma kategori-karta som LightGBM sparar när den tränas direkt på en DataFrame. """
+    return [list(X[c].cat.categories) for c in X.columns if isinstance(X[c].dtype, pd.CategoricalDtype)] or None
+
+def build_shared_dataset(name: str, X: pd.DataFrame, categorical_features: list, work_dir: str) -> str:
+    """
+    Bygger det binnade datasetet för en feature-matris EN gång per körning och returnerar
+    sökvägen till LightGBM-binären i work_dir (delas mellan processerna, tas bort efter
+    träningen). Labels sätts per modell vid träning. Bin-gränserna följer alltid dagens data
+    som vid DataFrame-träning; daglig omträning har alltid nya rader, så binären sparas
+    inte mellan körningar.
+    """
+    t0 = time.perf_counter()
+    dataset = lgb.Dataset(X, label=np.zeros(len(X)), categorical_feature=categorical_features,
+                          params={'verbose': -1}, free_raw_data=True).construct()
+    bin_path = os.path.join(work_dir, f'{name}.bin')
+    dataset.save_binary(bin_path)
+    print(f"  -> Dataset '{name}': {len(X)} rader binnade på {time.perf_counter() - t0:.1f}s.")
+    return bin_path
+
+# --- PARALLELL TRÄNING ---
+def fit_and_save_model(job: dict, n_threads: int):
+    """
+    Tränar en modell (körs i egen process) på det delade binnade datasetet och sparar
+    den i LightGBM:s textformat (registrets versionskatalog) direkt när den är klar.
+    job['subset'] (radpositioner) tränar på en delmängd av datasetet, med samma bin-gränser.
+    Returnerar (namn, sekunder).
+    """
+    t0 = time.perf_counter()
+    params = {**job['params'], 'num_threads': n_threads, 'verbose': -1}
+    train_set = lgb.Dataset(job['dataset'], label=np.asarray(job['y'], dtype=np.float64), params={'verbose': -1})
+    if job.get('subset') is not None:
+        train_set = train_set.subset(job['subset'])
+    model = lgb.train(params, train_set, num_boost_round=job['num_boost_round'])
+    # Prognosen predikterar på DataFrames -> samma kategori-karta som vid DataFrame-träning
+    model.pandas_categorical = job['pandas_categorical']
+    model.save_model(job['path'])
+    return job['name'], time.perf_counter() - t0
+
+def train_models_parallel(jobs: list):
+    """
+    Kör oberoende modellträningar samtidigt i processer.
+    Kärnorna (TRAIN_THREADS, default alla) delas mellan samtidiga fits för att undvika överbokning.
+    TRAIN_MAX_WORKERS=1 tränar sekventiellt i samma process.
+    """
+    total_threads = int(getattr(config, 'TRAIN_THREADS', None) or os.cpu_count() or 1)
+    max_workers = int(getattr(config, 'TRAIN_MAX_WORKERS', None) or min(len(jobs), total_threads))
+    max_workers = max(1, min(max_workers, len(jobs)))
+    n_threads = max(1, total_threads // max_workers)
+    print(f"-> Tränar {len(jobs)} modeller: {max_workers} samtidigt x {n_threads} trådar.")
+
+    t0 = time.perf_counter()
+    timings = {}
+    if max_workers == 1:
+        for job in jobs:
+            name, seconds = fit_and_save_model(job, n_threads)
+            timings[name] = seconds
+            print(f"  -> {name} klar ({seconds:.1f}s)")
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # Rå-matriserna behövs inte i arbetarna (de läser det binnade datasetet)
+            futures = {
+                executor.submit(fit_and_save_model, {k: v for k, v in job.items() if k not in ('X', 'ds')}, n_threads): job['name']
+                for job in jobs
+            }
+            for future in as_completed(futures):
+                name, seconds = future.result()
+                timings[name] = seconds
+                print(f"  -> {name} klar ({seconds:.1f}s)")
+
+    wall = time.perf_counter() - t0
+    print(f"-> Träning klar på {wall:.1f}s (summa per modell {sum(timings.values()):.1f}s).")
+    return timings
+
+# --- INKREMENTELL TRÄNING ---
+TRAINING_STATE_FILE = 'training_state.json'
+
+def model_loss(model, job: dict, X: pd.DataFrame, y: np.ndarray) -> float:
+    """ Pinball-loss för kvantilmodeller, annars MAE. """
+    pred = model.predict(X)
+    diff = np.asarray(y, dtype=np.float64) - pred
+    if job['params']['objective'] == 'quantile':
+        alpha = job['params']['alpha']
+        return float(np.mean(np.maximum(alpha * diff, (alpha - 1) * diff)))
+    return float(np.mean(np.abs(diff)))
+
+def recent_mask(ds: np.ndarray, days: int, end=None) -> np.ndarray:
+    end = pd.Timestamp(ds.max()) if end is None else pd.Timestamp(end)
+    return (ds > np.datetime64(end - pd.Timedelta(days=days))) & (ds <= np.datetime64(end))
+
+def holdout_split(ds: np.ndarray, days: int):
+    """ (start, mask) för de sista `days` dagarna i ds. """
+    start = pd.Timestamp(ds.max()) - pd.Timedelta(days=days)
+    return start, ds > np.datetime64(start)
+
+def fit_booster(job: dict, mask: np.ndarray, n_threads: int):
+    """ Full träning på raderna i mask (samma parametrar som den publicerade modellen). """
+    data = lgb.Dataset(job['X'][mask], label=np.asarray(job['y'][mask], dtype=np.float64),
+                       categorical_feature=job['categorical_features'], params={'verbose': -1})
+    booster = lgb.train({**job['params'], 'num_threads': n_threads, 'verbose': -1}, data,
+                        num_boost_round=job['num_boost_round'])
+    booster.pandas_categorical = job['pandas_categorical']
+    return booster
+
+def job_categories(job: dict) -> dict:
+    return {c: [str(v) for v in dtype.categories] for c, dtype in job['cat_dtypes'].items()}
+
+def load_booster(path: str):
+    if path is None or not os.path.exists(path): return None
+    return lgb.Booster(model_file=path)
+
+def load_training_state():
+    path = os.path.join(config.MODEL_DIR, TRAINING_STATE_FILE)
+    if not os.path.exists(path): return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_training_state(jobs: list, full: bool, previous: dict = None):
+    """ Sparar datum för senaste fullträning, baslinje-loss (holdout) och kategorier per modell. """
+    state = dict(previous or {})
+    today = pd.Timestamp.now().normalize().strftime('%Y-%m-%d')
+    state['last_update'] = today
+    if full:
+        state['last_full'] = today
+        state['baseline_holdout_loss'] = {job['name']: job['metrics']['loss_holdout'] for job in jobs}
+        state.pop('baseline_loss', None)  # gammal träningsloss, inte jämförbar
+    state['categories'] = {job['name']: job_categories(job) for job in jobs}
+    with open(os.path.join(config.MODEL_DIR, TRAINING_STATE_FILE), 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+
+def decide_training_mode(jobs: list, state: dict, active_version: str):
+    """
+    Returnerar ('FULL' | 'INCREMENTAL', orsak). active_version är registrets 'current'
+    (inte config.MODEL_VERSION, som bara fäster prognosens version).
+    """
+    if str(getattr(config, 'TRAIN_MODE', 'FULL')).upper() != 'INCREMENTAL':
+        return 'FULL', 'TRAIN_MODE=FULL'
+    if not state or 'last_full' not in state:
+        return 'FULL', 'ingen tidigare fullträning'
+    if not state.get('baseline_holdout_loss'):
+        return 'FULL', 'ingen holdout-baslinje'
+    if active_version is None or any(registered_model_path(job['name'], active_version) is None for job in jobs):
+        return 'FULL', 'modell saknas i registret'
+
+    days_since_full = (pd.Timestamp.now().normalize() - pd.Timestamp(state['last_full'])).days
+    full_every = int(getattr(config, 'TRAIN_FULL_EVERY_DAYS', 7))
+    if days_since_full >= full_every:
+        return 'FULL', f'schemalagd ({days_since_full} dagar sedan fullträning)'
+
+    for job in jobs:
+        if state.get('categories', {}).get(job['name']) != job_categories(job):
+            return 'FULL', f"nya kategorier i {job['name']}"
+
+    boosters = {job['name']: load_booster(registered_model_path(job['name'], active_version)) for job in jobs}
+    if str(getattr(config, 'TRAIN_INCREMENTAL_METHOD', 'CONTINUE')).upper() != 'REFIT':
+        # CONTINUE lägger till träd varje dag -> full träning när modellen nått taket
+        rounds = int(getattr(config, 'TRAIN_INCREMENTAL_ROUNDS', 50))
+        for job in jobs:
+            max_trees = int(getattr(config, 'TRAIN_MAX_TREES', None) or 2 * job['num_boost_round'])
+            n_trees = boosters[job['name']].num_trees()
+            if n_trees + rounds > max_trees:
+                return 'FULL', f"{job['name']} har {n_trees} träd (tak {max_trees})"
+
+    # Drift: aktiv modell på dagarna efter dess träningsfönster (osedda, som baslinjen)
+    drift_ratio = float(getattr(config, 'TRAIN_DRIFT_RATIO', 1.5))
+    manifest = read_model_manifest(active_version)
+    for job in jobs:
+        baseline = state['baseline_holdout_loss'].get(job['name'])
+        window_end = manifest['models'][job['name']].get('training_window', {}).get('end')
+        if not baseline or not window_end:
+            continue
+        unseen = job['ds'] > np.datetime64(pd.Timestamp(window_end))
+        if not unseen.any():
+            continue
+        loss_now = model_loss(boosters[job['name']], job, job['X'][unseen], job['y'][unseen])
+        if loss_now > baseline * drift_ratio:
+            return 'FULL', f"drift i {job['name']} (loss {loss_now:.3f} > {drift_ratio} x {baseline:.3f})"
+    return 'INCREMENTAL', f'{days_since_full} dagar sedan fullträning'
+
+def update_booster(booster, job: dict, X: pd.DataFrame, y: np.ndarray, n_threads: int):
+    """
+    CONTINUE: boostar vidare TRAIN_INCREMENTAL_ROUNDS träd på fönstret (init_model).
+    REFIT: behåller trädstrukturen och uppdaterar lövvärdena (decay TRAIN_REFIT_DECAY).
+    """
+    method = str(getattr(config, 'TRAIN_INCREMENTAL_METHOD', 'CONTINUE')).upper()
+    y = np.asarray(y, dtype=np.float64)
+    if method == 'REFIT':
+        new_booster = booster.refit(X, y, decay_rate=float(getattr(config, 'TRAIN_REFIT_DECAY', 0.9)))
+    else:
+        train_set = lgb.Dataset(X, label=y, categorical_feature=job['categorical_features'],
+                                params={'verbose': -1}, free_raw_data=False)
+        params = {**job['params'], 'num_threads': n_threads, 'verbose': -1}
+        new_booster = lgb.train(params, train_set, init_model=booster,
+                                num_boost_round=int(getattr(config, 'TRAIN_INCREMENTAL_ROUNDS', 50)))
+    new_booster.pandas_categorical = job['pandas_categorical']
+    return new_booster
+
+def train_models_incremental(jobs: list, active_version: str):
+    """
+    Uppdaterar gårdagens modeller (aktiv registerversion, active_version) på de senaste
+    TRAIN_INCREMENTAL_WINDOW_DAYS dagarna och sparar dem i den nya versionen (job['path']).
+    """
+    window_days = int(getattr(config, 'TRAIN_INCREMENTAL_WINDOW_DAYS', 28))
+    n_threads = int(getattr(config, 'TRAIN_THREADS', None) or os.cpu_count() or 1)
+    t0 = time.perf_counter()
+    for job in jobs:
+        t_job = time.perf_counter()
+        booster = load_booster(registered_model_path(job['name'], active_version))
+        mask = recent_mask(job['ds'], window_days)
+        update_booster(booster, job, job['X'][mask], job['y'][mask], n_threads).save_model(job['path'])
+        print(f"  -> {job['name']} uppdaterad på {mask.sum()} rader ({time.perf_counter() - t_job:.1f}s)")
+    print(f"-> Inkrementell träning klar på {time.perf_counter() - t0:.1f}s.")
+
+def holdout_jobs(jobs: list, work_dir: str) -> list:
+    """
+    Baslinjemodeller för full träning: samma jobb på en delmängd av det delade datasetet,
+    utan de sista TRAIN_VALIDATION_DAYS dagarna. Tränas i samma processpool som modellerna.
+    """
+    holdout_days = int(getattr(config, 'TRAIN_VALIDATION_DAYS', 7))
+    return [{**job, 'name': f"{job['name']}_holdout", 'path': os.path.join(work_dir, f"{job['name']}_holdout.txt"),
+             'subset': np.flatnonzero(~holdout_split(job['ds'], holdout_days)[1])} for job in jobs]
+
+def holdout_baseline(jobs: list, baseline_jobs: list):
+    """
+    Baslinje efter full träning: baslinjemodellernas loss på de utelämnade dagarna
+    (job['loss_holdout']). Träningslossen är för optimistisk för att jämföras med loss på nya dagar.
+    """
+    holdout_days = int(getattr(config, 'TRAIN_VALIDATION_DAYS', 7))
+    for job, baseline_job in zip(jobs, baseline_jobs):
+        _, holdout = holdout_split(job['ds'], holdout_days)
+        job['loss_holdout'] = model_loss(load_booster(baseline_job['path']), job, job['X'][holdout], job['y'][holdout])
+
+def version_trained_before(jobs: list, end):
+    """ Senaste registerversion vars modeller (samma features) bara sett data t.o.m. end, annars None. """
+    for version in reversed(list_model_versions()):
+        models = read_model_manifest(version)['models']
+        if all(job['name'] in models and models[job['name']]['features'] == job['features']
+               and models[job['name']].get('training_window', {}).get('end')
+               and pd.Timestamp(models[job['name']]['training_window']['end']) <= end for job in jobs):
+            return version
+    return None
+
+def validate_incremental_update(jobs: list, state: dict, active_version: str):
+    """
+    Grind innan en inkrementell version publiceras. Uppdateringen upprepas från en
+    registerversion som inte sett holdout (de sista TRAIN_VALIDATION_DAYS dagarna) på
+    fönstret fram till holdout; loss på holdout jämförs med fullträningens holdout-baslinje.
+    Returnerar orsak till full träning, eller None om alla modeller klarar TRAIN_DRIFT_RATIO.
+    """
+    holdout_days = int(getattr(config, 'TRAIN_VALIDATION_DAYS', 7))
+    window_days = int(getattr(config, 'TRAIN_INCREMENTAL_WINDOW_DAYS', 28))
+    drift_ratio = float(getattr(config, 'TRAIN_DRIFT_RATIO', 1.5))
+    n_threads = int(getattr(config, 'TRAIN_THREADS', None) or os.cpu_count() or 1)
+    holdout_start = max(holdout_split(job['ds'], holdout_days)[0] for job in jobs)
+    base_version = version_trained_before(jobs, holdout_start)
+    if base_version is None:
+        print("  -> VARNING: Ingen registerversion tränad före holdout, validerar från aktiv version.")
+        base_version = active_version
+    for job in jobs:
+        baseline = state['baseline_holdout_loss'].get(job['name'])
+        if not baseline:
+            return f"holdout-baslinje saknas för {job['name']}"
+        _, holdout = holdout_split(job['ds'], holdout_days)
+        window = recent_mask(job['ds'], window_days, end=pd.Timestamp(job['ds'].max()) - pd.Timedelta(days=holdout_days))
+        booster = update_booster(load_booster(registered_model_path(job['name'], base_version)), job,
+                                 job['X'][window], job['y'][window], n_threads)
+        job['loss_holdout'] = model_loss(booster, job, job['X'][holdout], job['y'][holdout])
+        ratio = job['loss_holdout'] / max(baseline, 1e-9)
+        print(f"  -> {job['name']}: holdout {job['loss_holdout']:.3f} | baslinje {baseline:.3f} ({ratio:.2f}x)")
+        if ratio > drift_ratio:
+            return f"validering {job['name']} (holdout-loss {ratio:.2f} x baslinjen > {drift_ratio})"
+    return None
+
+# --- MODELLREGISTER ---
+def compile_and_verify(job: dict):
+    """
+    Exporterar modellen till den kompilerade NumPy-prediktorn (.npz bredvid .txt) och
+    kontrollerar att den ger exakt samma prediktioner som LightGBM på träningsmatrisen.
+    Returnerar filnamnet, eller None (prognosen använder då LightGBM).
+    """
+    try:
+        compiled = compile_registered_model(job['path'])
+        exact = np.array_equal(compiled.predict(job['X']), load_booster(job['path']).predict(job['X']))
+    except Exception as e:
+        print(f"  -> VARNING: Kunde inte kompilera {job['name']}: {e}")
+        exact = False
+    npz_path = os.path.splitext(job['path'])[0] + '.npz'
+    if not exact:
+        print(f"  -> VARNING: Kompilerad {job['name']} avviker från LightGBM, sparas inte.")
+        if os.path.exists(npz_path): os.remove(npz_path)
+        return None
+    return os.path.basename(npz_path)
+
+def publish_trained_models(jobs: list, version: str, mode: str, reason: str):
+    """ Loss på fönstret + manifest (features, kategorier, träningsfönster) -> ny aktiv registerversion. """
+    window_days = int(getattr(config, 'TRAIN_INCREMENTAL_WINDOW_DAYS', 28))
+    models = {}
+    for job in jobs:
+        mask = recent_mask(job['ds'], window_days)
+        job['metrics'] = {
+            'loss_window': model_loss(load_booster(job['path']), job, job['X'][mask], job['y'][mask]),
+            'window_days': window_days,
+            'loss_holdout': job.get('loss_holdout'),
+            'holdout_days': int(getattr(config, 'TRAIN_VALIDATION_DAYS', 7)),
+        }
+        seen = mask if mode == 'INCREMENTAL' else np.ones(len(job['ds']), dtype=bool)
+        window = {'start': str(pd.Timestamp(job['ds'][seen].min()).date()),
+                  'end': str(pd.Timestamp(job['ds'][seen].max()).date()), 'rows': int(seen.sum())}
+        models[job['name']] = model_manifest_entry(job['name'], job['features'], job['categorical_features'],
+                                                   job['cat_dtypes'], params=job['params'], window=window,
+                                                   metrics=job['metrics'], compiled=compile_and_verify(job))
+    publish_model_version(version, models, info={'training_mode': mode, 'reason': reason, 'lightgbm': lgb.__version__})
+    print(f"-> Modellversion {version} publicerad (current).")
+
+def validate_incremental(jobs: list):
+    """
+    Jämför inkrementell uppdatering mot full träning på en holdout (sista TRAIN_VALIDATION_DAYS dagarna):
+    - 'Gårdagens' modell = full träning fram till holdout - TRAIN_VALIDATION_DAYS.
+    - Inkrementell = den modellen uppdaterad på fönstret fram till holdout.
+    - Full = full träning fram till holdout.
+    Sparar inga modeller. Returnerar {modell: (loss_full, loss_inkrementell)}.
+    """
+    holdout_days = int(getattr(config, 'TRAIN_VALIDATION_DAYS', 7))
+    window_days = int(getattr(config, 'TRAIN_INCREMENTAL_WINDOW_DAYS', 28))
+    n_threads = int(getattr(config, 'TRAIN_THREADS', None) or os.cpu_count() or 1)
+    print(f"\n--- Validerar inkrementell träning mot full träning (holdout {holdout_days} dagar) ---")
+    results = {}
+    for job in jobs:
+        ds, X, y = job['ds'], job['X'], job['y']
+        holdout_start, holdout = holdout_split(ds, holdout_days)
+        base_end = holdout_start - pd.Timedelta(days=holdout_days)
+
+        full_model = fit_booster(job, ~holdout, n_threads)
+        base_model = fit_booster(job, ds <= np.datetime64(base_end), n_threads)
+        window = recent_mask(ds, window_days, end=holdout_start)
+        inc_model = update_booster(base_model, job, X[window], y[window], n_threads)
+
+        loss_full = model_loss(full_model, job, X[holdout], y[holdout])
+        loss_inc = model_loss(inc_model, job, X[holdout], y[holdout])
+        results[job['name']] = (loss_full, loss_inc)
+        print(f"  -> {job['name']}: full {loss_full:.3f} | inkrementell {loss_inc:.3f} ({loss_inc / max(loss_full, 1e-9):.2f}x)")
+    return results
+
+def train_final_system():
+    print("--- Startar TRÄNING (KATEGORI FIX) ---")
+    try:
+        mssql_engine = create_engine(config.MSSQL_CONN_STR)
+    except Exception as e:
+        print(f"FATALT FEL: {e}")
+        sys.exit(1)
+
+    # 1. Läs, aggregera och spara timhistorik (grid, features & lags)
+    table_name_training = config.TABLE_NAMES['Operative_Training_Data']
+    print(f"-> Läser data från {table_name_training}...")
+    sparse_grid = str(getattr(config, 'TRAIN_GRID_MODE', 'DENSE')).upper() == 'OPEN_HOURS'
+    tn_hist = config.TABLE_NAMES['Hourly_Aggregated_History']
+    df_final = update_history(mssql_engine, table_name_training, tn_hist, sparse_grid)
 
     # --- 1. VOLYM (DAGLIG) ---
-    print("\n--- Tränar Volym (Daglig) ---")
-    df_vol_train = df_final.groupby([pd.Grouper(key='ds', freq='D'), 'Tj_nstTyp']).agg({'Antal_Samtal': 'sum'}).reset_index()
+    print("\n--- Förbereder Volym (Daglig) ---")
+    df_vol_train = complete_daily_grid(df_final.groupby([pd.Grouper(key='ds', freq='D'), 'Tj_nstTyp']).agg({'Antal_Samtal': 'sum'}), df_final)
     df_vol_train = add_all_features(df_vol_train, ds_col='ds')
-    df_vol_train = create_lag_features(df_vol_train, group_cols=['Tj_nstTyp'], target_col='Antal_Samtal', lags=[1, 7, 14, 28, 364])
+    # Dagsdata: lag i DAGAR (samma som create_daily_lags i prognosen)
+    df_vol_train = create_dense_lag_features(df_vol_train, group_cols=['Tj_nstTyp'], target_col='Antal_Samtal', lags=[1, 7, 14, 28, 364], freq='D')
     df_vol_train = df_vol_train.dropna(subset=['Antal_Samtal_lag_1d'])
     
     raw_base_features = ['veckodag', 'dag_på_året', 'vecka_nr', 'månad', 'kvartal', 'är_arbetsdag']
@@ -115,29 +742,33 @@ def train_final_system():
         'operative': {'obj': 'tweedie', 'alpha': None}
     }
 
+    X_vol = df_vol_train[vol_features]
+
+    training_jobs = []
     for name, params in models_to_train.items():
-        print(f"  -> Tränar Volume_{name}...")
-        kw = {'objective': params['obj'], 'n_estimators': 500, 'random_state': 42}
+        kw = {'objective': params['obj'], 'seed': 42}
         if params['alpha']: kw['alpha'] = params['alpha']
         
-        model = lgb.LGBMRegressor(**kw)
-        model.fit(df_vol_train[vol_features], df_vol_train['Antal_Samtal'], categorical_feature=cat_features)
-        
         # SPARA MED KATEGORI-KARTA
-        path = os.path.join(config.MODEL_DIR, f'final_model_volume_{name}.pkl')
-        with open(path, 'wb') as f:
-            pickle.dump({
-                'model': model, 
-                'features': vol_features, 
-                'categorical_features': cat_features,
-                'cat_dtypes': category_dtypes 
-            }, f)
+        training_jobs.append({
+            'name': f'Volume_{name}',
+            'params': kw,
+            'num_boost_round': 500,
+            'dataset_name': 'volume',
+            'X': X_vol,
+            'ds': df_vol_train['ds'].to_numpy(),
+            'pandas_categorical': pandas_categorical_of(X_vol),
+            'y': df_vol_train['Antal_Samtal'].to_numpy(),
+            'features': vol_features,
+            'categorical_features': cat_features,
+            'cat_dtypes': category_dtypes,
+        })
 
     # --- 2. AHT (SEGMENT) ---
-    print("\n--- Tränar AHT (Segment) ---")
-    df_aht_train = df_final.groupby([pd.Grouper(key='ds', freq='D'), 'Behavior_Segment']).agg({
+    print("\n--- Förbereder AHT (Segment) ---")
+    df_aht_train = complete_daily_grid(df_final.groupby([pd.Grouper(key='ds', freq='D'), 'Behavior_Segment']).agg({
         'Antal_Samtal': 'sum', 'Total_Samtalstid_Sek': 'sum', 'Total_V_ntetid_Sek': 'sum', 'Antal_Besvarade_Samtal': 'sum'
-    }).reset_index()
+    }), df_final)
     
     df_aht_train['Snitt_Taltid'] = np.where(df_aht_train['Antal_Besvarade_Samtal'] > 0, 
                                             df_aht_train['Total_Samtalstid_Sek'] / df_aht_train['Antal_Besvarade_Samtal'], 0)
@@ -155,21 +786,71 @@ def train_final_system():
 
     df_aht_clean = df_aht_train[df_aht_train['Antal_Samtal'] > 0].copy()
 
-    # AHT Model
-    print("  -> Tränar AHT...")
-    model_aht = lgb.LGBMRegressor(objective='regression', n_estimators=500, random_state=42)
-    model_aht.fit(df_aht_clean[aht_features], df_aht_clean['Snitt_Taltid'], categorical_feature=cat_aht)
-    with open(os.path.join(config.MODEL_DIR, 'final_model_aht.pkl'), 'wb') as f:
-        pickle.dump({'model': model_aht, 'features': aht_features, 'categorical_features': cat_aht, 'cat_dtypes': aht_dtypes}, f)
+    X_aht = df_aht_clean[aht_features]
+
+    for name, target in [('aht', 'Snitt_Taltid'), ('awt', 'Snitt_Vantetid')]:
+        training_jobs.append({
+            'name': name.upper(),
+            'params': {'objective': 'regression', 'seed': 42},
+            'num_boost_round': 500,
+            'dataset_name': 'aht',
+            'X': X_aht,
+            'ds': df_aht_clean['ds'].to_numpy(),
+            'pandas_categorical': pandas_categorical_of(X_aht),
+            'y': df_aht_clean[target].to_numpy(),
+            'features': aht_features,
+            'categorical_features': cat_aht,
+            'cat_dtypes': aht_dtypes,
+        })
+
+    print("\n--- Tränar modeller ---")
+    state = load_training_state()
+    active_version = get_current_version()
+    mode, reason = decide_training_mode(training_jobs, state, active_version)
+    print(f"-> Träningsläge: {mode} ({reason})")
+    version = begin_model_version()
+    try:
+        for job in training_jobs:
+            job['path'] = staged_model_path(version, job['name'])
+        if mode == 'INCREMENTAL':
+            train_models_incremental(training_jobs, active_version)
+            failed = validate_incremental_update(training_jobs, state, active_version)
+            if failed:
+                mode, reason = 'FULL', failed
+                print(f"   VARNING: Inkrementell version publiceras inte, tränar fullt ({reason}).")
+        if mode == 'FULL':
+            with tempfile.TemporaryDirectory(prefix='lgb_datasets_', dir=getattr(config, 'DATASET_WORK_DIR', None)) as work_dir:
+                datasets = {}
+                for job in training_jobs:
+                    if job['dataset_name'] not in datasets:
+                        datasets[job['dataset_name']] = build_shared_dataset(job['dataset_name'], job['X'],
+                                                                             job['categorical_features'], work_dir)
+                    job['dataset'] = datasets[job['dataset_name']]
+                baseline_jobs = holdout_jobs(training_jobs, work_dir)
+                train_models_parallel(training_jobs + baseline_jobs)
+                holdout_baseline(training_jobs, baseline_jobs)
+        publish_trained_models(training_jobs, version, mode, reason)
+    except BaseException:
+        # Opublicerad version (.<version>) får inte ligga kvar i registret
+        discard_model_version(version)
+        print(f"   VARNING: Modellversion {version} publicerades inte, stagingkatalogen är borttagen.")
+        raise
+    save_training_state(training_jobs, full=(mode == 'FULL'), previous=state)
 
-    # AWT Model
-    print("  -> Tränar AWT...")
-    model_awt = lgb.LGBMRegressor(objective='regression', n_estimators=500, random_state=42)
-    model_awt.fit(df_aht_clean[aht_features], df_aht_clean['Snitt_Vantetid'], categorical_feature=cat_aht)
-    with open(os.path.join(config.MODEL_DIR, 'final_model_awt.pkl'), 'wb') as f:
-        pickle.dump({'model': model_awt, 'features': aht_features, 'categorical_features': cat_aht, 'cat_dtypes': aht_dtypes}, f)
+    if getattr(config, 'TRAIN_VALIDATE_INCREMENTAL', False) or '--validate-incremental' in sys.argv:
+        validate_incremental(training_jobs)
 
     print("\n-> ALLA MODELLER TRÄNADE & SPARADE (MED KATEGORI-FIX)!")
 
 if __name__ == '__main__':
-    train_final_system()
\ No newline at end of file
+    if '--list-models' in sys.argv:
+        current = get_current_version()
+        for v in list_model_versions():
+            print(f"{v}{'  <- current' if v == current else ''}")
+    elif '--rollback' in sys.argv:
+        # --rollback [version]: utan version -> versionen före den aktiva
+        idx = sys.argv.index('--rollback')
+        target = sys.argv[idx + 1] if len(sys.argv) > idx + 1 else None
+        print(f"-> Aktiv modellversion: {rollback_model_version(target)}")
+    else:
+        train_final_system()
\ No newline at end of file
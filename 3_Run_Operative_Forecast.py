@@ -5,14 +5,15 @@ JOBB 3: Skapa Operativ Prognos (BUSINESS HOURS FIX)
 - Öppettider Mån-Fre 06:00 - 18:00.
 - All volym utanför dessa tider sätts till 0.
 - Dagsvolymen fördelas om så den enbart hamnar på öppettiderna.
+- Volymmodellen läses ur modellregistret ('current', eller fäst med --model-version / MODEL_VERSION),
+  som kompilerad NumPy-prediktor när versionen har en (FORECAST_PREDICTOR). Saknas modellen i
+  registret avbryts jobbet (ingen reserv till gamla picklar).
 """
 
 import pandas as pd
 import numpy as np
-import pickle
-import os
 from datetime import datetime, timedelta
-from DataDriven_utils import add_all_features
+from DataDriven_utils import add_all_features, create_dense_lag_features, is_open_hour, load_registered_model, load_compiled_model
 import config
 from sqlalchemy import create_engine, text 
 import sys
@@ -20,17 +21,59 @@ import re
 
 # --- FUNKTIONER ---
 def create_daily_lags(df, group_cols, target_col, lags):
-    df_out = df.copy()
-    df_out = df_out.sort_values(by=group_cols + ['ds'])
-    g = df_out.groupby(group_cols)
-    for lag_days in lags:
-        col_name = f'{target_col}_lag_{lag_days}d'
-        df_out[col_name] = g[target_col].shift(lag_days)
-    return df_out
-
-def load_model_payload(model_path: str):
-    if not os.path.exists(model_path): return None
-    with open(model_path, 'rb') as f: return pickle.load(f)
+    """
+    Samma lagmotor som träningen (lag i DAGAR). Saknade dagar för en serie (t.ex. en ny
+    tjänst) räknas som 0 samtal, som i träningens utfyllda dagsrutnät (complete_daily_grid);
+    övriga fel (dubbla dagar, NaN i nycklar) avbryter prognosen.
+    """
+    try:
+        return create_dense_lag_features(df, group_cols, target_col, lags, freq='D', verbose=False)
+    except ValueError as e:
+        print(f"  -> VARNING: {e} Saknade dagar räknas som 0.")
+    return create_dense_lag_features(df, group_cols, target_col, lags, freq='D', verbose=False, fill_missing=0.0)
+
+def requested_model_version():
+    """ --model-version <id> på kommandoraden, annars config.MODEL_VERSION (None = 'current'). """
+    if '--model-version' in sys.argv:
+        idx = sys.argv.index('--model-version')
+        if len(sys.argv) > idx + 1:
+            return sys.argv[idx + 1]
+    return None
+
+def load_forecast_model(name: str):
+    """
+    Modell ur registret (aktiv eller fäst version). Saknas den avbryts jobbet: de gamla
+    picklarna uppdateras inte längre av träningen och skulle ge en inaktuell prognos.
+    FORECAST_PREDICTOR='COMPILED' (default): kompilerad NumPy-prediktor, LightGBM laddas inte.
+    """
+    version = requested_model_version()
+    payload = None
+    if str(getattr(config, 'FORECAST_PREDICTOR', 'COMPILED')).upper() == 'COMPILED':
+        payload = load_compiled_model(name, version)
+    kind = 'kompilerad'
+    if payload is None:
+        payload, kind = load_registered_model(name, version), 'LightGBM'
+    if payload is not None:
+        print(f"-> Modell '{name}' från registret, version {payload['version']} ({kind}).")
+        return payload
+    label = version or getattr(config, 'MODEL_VERSION', None) or 'current'
+    raise FileNotFoundError(f"Modell '{name}' saknas i modellregistret (version {label}). Kör jobb 2 (träning) först.")
+
+def complete_history_days(engine, hist_table, df_hist_raw, lookback):
+    """
+    Öppettidsrutnätet (TRAIN_GRID_MODE='OPEN_HOURS') lagrar inte stängda dagar utan samtal.
+    Fyller ut till alla dagar x (Tj_nstTyp, Segment) med 0, som det fulla rutnätet gav.
+    """
+    if df_hist_raw.empty:
+        return df_hist_raw
+    df_min = pd.read_sql(f"SELECT MIN(ds) AS min_ds FROM [{hist_table}]", engine)
+    first_day = pd.to_datetime(df_min.iloc[0]['min_ds']).tz_localize(None).normalize()
+    days = pd.date_range(max(first_day, lookback.normalize()), df_hist_raw['ds'].max(), freq='D')
+    combos = df_hist_raw[['Tj_nstTyp', 'Behavior_Segment']].drop_duplicates()
+    df_full = pd.merge(pd.DataFrame({'ds': days}), combos, how='cross')
+    df_full = pd.merge(df_full, df_hist_raw, on=['ds', 'Tj_nstTyp', 'Behavior_Segment'], how='left')
+    df_full['Antal_Samtal'] = df_full['Antal_Samtal'].fillna(0).astype(df_hist_raw['Antal_Samtal'].dtype)
+    return df_full
 
 def get_forecast_start_date(engine) -> datetime:
     if config.RUN_MODE == 'VALIDATION':
@@ -49,7 +92,7 @@ def calculate_hourly_shape(engine, services_list, target_col):
     df[target_col] = df['Tj_nstTyp'].astype(str).str.strip()
     
     df = df[df[target_col].isin(services_list)]
-    df = add_all_features(df, ds_col='ds')
+    df = add_all_features(df, ds_col='ds', features=['datum', 'veckodag', 'timme'])
     df_daily = df.groupby(['datum', target_col])['Antal_Samtal'].sum().reset_index(name='Daily_Total')
     df = pd.merge(df, df_daily, on=['datum', target_col])
     df['Hourly_Proportion'] = df['Antal_Samtal'] / df['Daily_Total']
@@ -76,11 +119,11 @@ def create_final_forecast():
 
     forecast_start = get_forecast_start_date(mssql_engine)
     
-    payload_vol = load_model_payload(os.path.join(config.MODEL_DIR, 'final_model_volume_operative.pkl'))
-    model_vol = payload_vol.get('model') if payload_vol else None
-    feats_vol = payload_vol.get('features') if payload_vol else []
-    cat_vol = payload_vol.get('categorical_features') if payload_vol else []
-    dtypes_vol = payload_vol.get('cat_dtypes', {}) if payload_vol else {}
+    payload_vol = load_forecast_model('Volume_operative')
+    model_vol = payload_vol['model']
+    feats_vol = payload_vol['features']
+    cat_vol = payload_vol['categorical_features']
+    dtypes_vol = payload_vol['cat_dtypes']
 
     hist_table = config.TABLE_NAMES['Hourly_Aggregated_History']
     lookback = forecast_start - pd.Timedelta(days=370)
@@ -97,9 +140,11 @@ def create_final_forecast():
     df_hist_raw = pd.read_sql(q_hist, mssql_engine)
     df_hist_raw['ds'] = pd.to_datetime(df_hist_raw['ds']).dt.tz_localize(None).dt.normalize()
     df_hist_raw['Tj_nstTyp'] = df_hist_raw['Tj_nstTyp'].astype(str).str.strip()
+    if str(getattr(config, 'TRAIN_GRID_MODE', 'DENSE')).upper() == 'OPEN_HOURS':
+        df_hist_raw = complete_history_days(mssql_engine, hist_table, df_hist_raw, lookback)
     
     # Stat
-    df_hist_temp = add_all_features(df_hist_raw.copy(), ds_col='ds')
+    df_hist_temp = add_all_features(df_hist_raw.copy(), ds_col='ds', features=['veckodag'])
     recent_cutoff = forecast_start - pd.Timedelta(days=35)
     df_recent = df_hist_temp[df_hist_temp['ds'] >= recent_cutoff]
     df_stats = df_recent.groupby(['Tj_nstTyp', 'veckodag'])['Antal_Samtal'].mean().reset_index(name='Stat_Avg')
@@ -178,7 +223,7 @@ def create_final_forecast():
         df_hourly_base = pd.concat([df_hourly_base, hours])
         
     df_res = pd.merge(df_hourly_base, df_base, left_on='datum', right_on='ds', suffixes=('_h', ''))
-    df_res = add_all_features(df_res, ds_col='ds_h')
+    df_res = add_all_features(df_res, ds_col='ds_h', features=['veckodag', 'timme'])
     df_res = pd.merge(df_res, df_shape, on=['veckodag', 'timme', 'Tj_nstTyp'], how='left')
     
     # --- NY LOGIK: ÖPPETTIDER & NORMALISERING ---
@@ -186,13 +231,8 @@ def create_final_forecast():
     # 1. Sätt bas-vikt (0 istället för 1/24 för att inte fylla nätter med skräp)
     df_res['Shape_Weight'] = df_res['Avg_Hourly_Proportion'].fillna(0)
     
-    # 2. HÅRT FILTER: Stängt Helger + Nätter (Före 06:00, Efter 18:00)
-    # 0=Mån, 4=Fre, 5=Lör, 6=Sön
-    mask_closed = (
-        (df_res['ds_h'].dt.weekday >= 5) |       # Lördag/Söndag
-        (df_res['ds_h'].dt.hour >= 18) |         # Stänger 18:00
-        (df_res['ds_h'].dt.hour < 6)             # Öppnar 06:00 
-    )
+    # 2. HÅRT FILTER: Stängt utanför öppettiderna (config.OPENING_HOURS, default Mån-Fre 06-18)
+    mask_closed = ~is_open_hour(df_res['ds_h'])
     df_res.loc[mask_closed, 'Shape_Weight'] = 0
     
     # 3. Normalisera Vikterna (Så att summan blir 1 per dag, men BARA på öppettider)
@@ -4,8 +4,21 @@ VERKTYGSLÅDA (DataDriven_utils.py)
 ================================================================
 ***
 - get_current_time() för centraliserad tid.
-- add_all_features: Tvingar 'naive' datetimes (tar bort tidszon).
+- create_dense_lag_features: Lag-/rullande features som vyer på en (tid x serie)-matris (även glesa rutnät).
+- get_opening_hours / is_open_hour: Öppettider från config.OPENING_HOURS.
+- add_all_features: Tvingar 'naive' datetimes (tar bort tidszon). Memoiserad kalenderdimension.
 - get_customer_data: Använder den robusta logiken från 1_Extract.
+- get_customer_data_cached / enrich_with_customers: Disk-cachad kundmappning (fingeravtryck) + hash-uppslag.
+- categorize_customer: En kompilerad regex för alla kategorier, explicit prioritet, cache per unikt namn
+  (kolumnen 'kategori' i Silver, Jobb 1).
+- bulk_write: Snabb bulk-skrivning till MSSQL (executemany / bcp) med rader/s-rapport.
+- detect_redials: Vektoriserad redial-motor (heltalskodade nummer, chunkvis med state).
+- first_touch_sql: First-Touch-SQL (en rad per CallId), delas av Jobb 0 och Jobb 1.
+- apply_dtype_plan: Kategorier/nedkastade tal för stora DataFrames (+ memory_mb);
+  widen_for_sql vidgar talen igen innan skrivning till SQL.
+- Modellregister: versionerade LightGBM-modeller (eget textformat + JSON-manifest) under
+  MODEL_DIR/registry med atomisk 'current'-pekare, fäst version (MODEL_VERSION) och rollback.
+- CompiledTreeModel / load_compiled_model: Träden som platta NumPy-arrayer, predict utan LightGBM.
 """
 
 import pandas as pd
@@ -13,7 +26,14 @@ import numpy as np
 from workalendar.europe import Sweden
 import config
 from sqlalchemy import create_engine
+import os
+import re
+import json
+import math
+import shutil
 import sys
+import subprocess
+import tempfile
 import traceback 
 from datetime import datetime
 import pytz 
@@ -21,38 +41,110 @@ import pandas as pd
 import numpy as np
 
 
-def create_lag_features(df, group_cols, target_col, lags):
-    """ 
-    Skapar lag-features grupperat (t.ex. per segment eller CustomerKey).
-    Kräver att 'ds' (datetime) finns i df.
+# Steg per dag för lag-motorn
+_STEPS_PER_DAY = {'h': 24, 'H': 24, 'D': 1, 'd': 1}
+
+def create_dense_lag_features(df, group_cols, target_col, lags, freq='h', rolling_windows=None,
+                              rolling_funcs=('mean',), ds_col='ds', verbose=True, fill_missing=None):
+    """
+    Lag-motor för TÄTA rutnät (varje serie har en rad per tidssteg, samma tidsaxel).
+    Serierna läggs i en sammanhängande 2-D array (tid x serie); en lag på k steg är
+    en förskjuten VY av en utfylld kopia (ingen groupby.shift per lag).
+    - lags: i dagar, freq 'h' = timdata, 'D' = dagdata
+    - rolling_windows: fönster i dagar; medel/summa över de w dagar som slutar vid den
+      minsta lagen (ingen information nyare än lagarna läcker in)
+    Kastar ValueError om datat inte är tätt. Resultatet (ordning, index, värden)
+    är identiskt med groupby(group_cols)[target_col].shift(lag i steg) på tät data.
+    - fill_missing: tillåter glesa rutnät (t.ex. bara öppettider). Tidsaxeln blir ett tätt
+      positionsindex (ds - min(ds)) / steg och saknade (tid, serie)-celler får fill_missing,
+      vilket ger samma lags som det fullständiga rutnätet för de rader som finns.
     """
-    df_out = df.copy()
-    if 'ds' not in df_out.columns:
-        print("FEL i create_lag_features: 'ds'-kolumn saknas.")
-        return df_out
-        
-    df_out = df_out.sort_values(by=group_cols + ['ds'])
-    
-    # Säkerställ att group_cols är en lista, även om det bara är en
     if not isinstance(group_cols, list):
         group_cols = [group_cols]
-        
-    g = df_out.groupby(group_cols)
-    
-    for lag_days in lags:
-        lag_hours = lag_days * 24
-        col_name = f'{target_col}_lag_{lag_days}d'
-        print(f"  -> Skapar {col_name} (shift {lag_hours}h)...")
-        try:
-            # Använd shift() inom groupby för att förhindra dataläckage mellan grupper
-            df_out[col_name] = g[target_col].shift(lag_hours)
-        except Exception as e:
-            print(f"    VARNING: Kunde inte skapa lag feature {col_name}: {e}")
-            df_out[col_name] = np.nan
-            
+    if ds_col not in df.columns:
+        raise ValueError(f"create_dense_lag_features: '{ds_col}'-kolumn saknas.")
+    if freq not in _STEPS_PER_DAY:
+        raise ValueError(f"create_dense_lag_features: okänd frekvens '{freq}' (använd 'h' eller 'D').")
+    steps_per_day = _STEPS_PER_DAY[freq]
+    step = np.timedelta64(24 * 3600 // steps_per_day, 's')
+
+    df_out = df.sort_values(by=group_cols + [ds_col])
+
+    # 1. Koda tid och serie till heltal
+    times = df_out[ds_col].to_numpy(dtype='datetime64[ns]')
+    s_idx = df_out.groupby(group_cols, sort=False).ngroup().to_numpy()
+    n_series = int(s_idx.max()) + 1 if len(s_idx) else 0
+    if (s_idx < 0).any() or np.isnat(times).any():
+        raise ValueError("create_dense_lag_features: NaN i tid eller gruppkolumner.")
+
+    if fill_missing is None:
+        t_idx, t_uniques = pd.factorize(times, sort=True)
+        n_times = len(t_uniques)
+
+        # 2. Kontrollera att rutnätet är tätt
+        if n_times > 1 and not (np.diff(t_uniques) == step).all():
+            raise ValueError(f"create_dense_lag_features: tidsaxeln har luckor (förväntat steg {freq}).")
+        flat = t_idx.astype(np.int64) * n_series + s_idx
+        if len(df_out) != n_times * n_series or len(np.unique(flat)) != len(flat):
+            raise ValueError("create_dense_lag_features: rutnätet är inte tätt (saknade/dubbla (tid, serie)-rader).")
+    else:
+        # 2. Glest rutnät: positionsindex på den täta tidsaxeln
+        offset = times - times.min() if len(times) else times.astype('timedelta64[ns]')
+        if (offset % step != np.timedelta64(0, 's')).any():
+            raise ValueError(f"create_dense_lag_features: tider utanför steg-rutnätet ({freq}).")
+        t_idx = (offset // step).astype(np.int64)
+        n_times = int(t_idx.max()) + 1 if len(t_idx) else 0
+        flat = t_idx * n_series + s_idx
+        if len(np.unique(flat)) != len(flat):
+            raise ValueError("create_dense_lag_features: dubbla (tid, serie)-rader.")
+
+    # 3. Matris (tid x serie) med NaN-utfyllnad framför -> lag = vy
+    lag_steps = {lag_days: lag_days * steps_per_day for lag_days in lags}
+    min_lag = min(lag_steps.values()) if lag_steps else steps_per_day
+    windows = {w: w * steps_per_day for w in (rolling_windows or [])}
+    pad = max(list(lag_steps.values()) + [min_lag + w for w in windows.values()] + [0])
+
+    padded = np.full((pad + n_times, n_series), np.nan)
+    if fill_missing is not None:
+        padded[pad:] = fill_missing
+    padded[pad + t_idx, s_idx] = df_out[target_col].to_numpy(dtype=float)
+
+    if verbose:
+        print(f"  -> Skapar {len(lag_steps)} lags {list(lags)} ({freq}) för {n_series} serier x {n_times} steg...")
+    for lag_days, k in lag_steps.items():
+        lagged = padded[pad - k: pad - k + n_times]  # vy, ingen kopia
+        df_out[f'{target_col}_lag_{lag_days}d'] = lagged[t_idx, s_idx]
+
+    # 4. Rullande medel/summa via kumulativ summa (kräver fullt fönster)
+    if windows:
+        valid = ~np.isnan(padded)
+        csum = np.vstack([np.zeros((1, n_series)), np.cumsum(np.where(valid, padded, 0.0), axis=0)])
+        ccount = np.vstack([np.zeros((1, n_series)), np.cumsum(valid, axis=0)])
+        end = pad + np.arange(n_times) - min_lag + 1  # exklusivt slut i csum-koordinater
+        for w, width in windows.items():
+            start = end - width
+            sums = csum[end] - csum[start]
+            counts = ccount[end] - ccount[start]
+            sums[counts < width] = np.nan
+            if 'sum' in rolling_funcs:
+                df_out[f'{target_col}_roll_sum_{w}d'] = sums[t_idx, s_idx]
+            if 'mean' in rolling_funcs:
+                df_out[f'{target_col}_roll_mean_{w}d'] = (sums / width)[t_idx, s_idx]
+
     return df_out
 
 
+# Öppettider: definieras EN gång i config.OPENING_HOURS (träningsrutnät + prognosens nollning)
+DEFAULT_OPENING_HOURS = {'weekdays': [0, 1, 2, 3, 4], 'open_hour': 6, 'close_hour': 18}
+
+def get_opening_hours() -> dict:
+    return {**DEFAULT_OPENING_HOURS, **(getattr(config, 'OPENING_HOURS', None) or {})}
+
+def is_open_hour(ds) -> np.ndarray:
+    """ True för timmar inom öppettiderna (veckodag i 'weekdays' och open_hour <= timme < close_hour). """
+    ds = pd.DatetimeIndex(ds)
+    opening = get_opening_hours()
+    return np.asarray(ds.weekday.isin(opening['weekdays']) & (ds.hour >= opening['open_hour']) & (ds.hour < opening['close_hour']))
 
 def get_current_time() -> datetime:
     """
@@ -145,6 +237,107 @@ def get_customer_data(engine=None) -> pd.DataFrame:
         print(f"FATALT FEL i get_customer_data: {e}", file=sys.stderr)
         return None
 
+# Version av kund-cachen (öka om get_customer_data ändrar logik)
+CUSTOMER_CACHE_VERSION = 1
+
+def _customer_fingerprint(engine) -> str:
+    """ Fingeravtryck av Bronze-kundtabellen (antal + checksumma) + exkluderingslistan. """
+    customer_table = config.BRONZE_TABLES['customers']
+    try:
+        df_fp = pd.read_sql(f"SELECT COUNT(*) AS n, CHECKSUM_AGG(BINARY_CHECKSUM(*)) AS cs FROM [{customer_table}]", engine)
+        exclude_ids = sorted(str(cid) for cid in getattr(config, 'EXCLUDE_CUSTOMER_IDS', []) or [])
+        return f"v{CUSTOMER_CACHE_VERSION}|{df_fp.iloc[0]['n']}|{df_fp.iloc[0]['cs']}|{','.join(exclude_ids)}"
+    except Exception as e:
+        print(f"VARNING: Kunde inte beräkna fingeravtryck för kunddata: {e}", file=sys.stderr)
+        return None
+
+def get_customer_data_cached(engine=None) -> pd.DataFrame:
+    """
+    Som get_customer_data, men resultatet (LandingNumber -> CustomerKey m.m.) sparas
+    på disk tillsammans med ett fingeravtryck av Bronze-kundtabellen.
+    Byggs bara om när Bronze-kunderna har ändrats.
+    """
+    if engine is None:
+        engine = create_engine(config.MSSQL_CONN_STR)
+
+    cache_dir = getattr(config, 'CACHE_DIR', os.path.join(config.MODEL_DIR, 'cache'))
+    cache_path = os.path.join(cache_dir, 'customer_mapping.pkl')
+    fingerprint = _customer_fingerprint(engine)
+
+    if fingerprint is not None and os.path.exists(cache_path):
+        try:
+            payload = pd.read_pickle(cache_path)
+            if payload.get('fingerprint') == fingerprint:
+                print("-> Kundmappning från cache (oförändrade kunder).", file=sys.stderr)
+                return payload['mapping'].copy()
+        except Exception as e:
+            print(f"VARNING: Kunde inte läsa kund-cachen: {e}", file=sys.stderr)
+
+    df_mapping = get_customer_data(engine=engine)
+    if df_mapping is not None and fingerprint is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = cache_path + '.tmp'
+            pd.to_pickle({'fingerprint': fingerprint, 'mapping': df_mapping}, tmp_path)
+            os.replace(tmp_path, cache_path)
+        except Exception as e:
+            print(f"VARNING: Kunde inte spara kund-cachen: {e}", file=sys.stderr)
+    return df_mapping
+
+def enrich_with_customers(df_calls: pd.DataFrame, df_customer_mapping: pd.DataFrame, key: str = 'LandingNumber') -> pd.DataFrame:
+    """
+    Vänster-join av samtal mot kundmappningen på LandingNumber.
+    Är nyckeln unik i mappningen görs en hash-uppslagning (Index.reindex) istället för merge;
+    resultatet är detsamma som pd.merge(..., how='left').
+    """
+    if not df_customer_mapping[key].is_unique:
+        return pd.merge(df_calls, df_customer_mapping, on=key, how='left')
+    right = df_customer_mapping.set_index(key).reindex(df_calls[key].to_numpy())
+    return pd.concat([df_calls.reset_index(drop=True), right.reset_index(drop=True)], axis=1)
+
+# Kolumner i First-Touch-tabellen (en rad per CallId)
+FIRST_TOUCH_COLUMNS = ['CallId', 'Created', 'LandingNumber', 'CallerNr', 'ChannelType', 'QueueId',
+                       'CaseId', 'Status', 'Duration', 'TalkTimeInSec']
+
+def first_touch_sql(call_data_sql: str, extra_where: str = "", insert_into: str = None, select_into: str = None) -> str:
+    """
+    SQL för First-Touch-attribution: EN rad per CallId med första kö, landningsnummer,
+    uppringare och kanal samt sista status (över alla ben i call_data_sql).
+    - insert_into: 'INSERT INTO [tabell] (...)' före SELECT
+    - select_into: 'SELECT ... INTO [tabell]' (skapar tabellen)
+    """
+    insert_sql = ""
+    if insert_into:
+        insert_sql = f"INSERT INTO [{insert_into}] ({', '.join(FIRST_TOUCH_COLUMNS)})"
+    into_sql = f"INTO [{select_into}]" if select_into else ""
+    return f"""
+        WITH CallData AS (
+            {call_data_sql}
+        ),
+        CalculatedMetrics AS (
+            SELECT
+                CallId, Status, Created, LandingNumber, ChannelType, QueueId,
+                callerNr,
+                TalkTimeInSec, Duration, CaseId,
+                FIRST_VALUE(QueueId) OVER (PARTITION BY CallId ORDER BY Created ASC) as First_QueueId,
+                FIRST_VALUE(Created) OVER (PARTITION BY CallId ORDER BY Created ASC) as First_Created,
+                FIRST_VALUE(LandingNumber) OVER (PARTITION BY CallId ORDER BY Created ASC) as First_LandingNumber,
+                FIRST_VALUE(callerNr) OVER (PARTITION BY CallId ORDER BY Created ASC) as First_CallerNr,
+                FIRST_VALUE(ChannelType) OVER (PARTITION BY CallId ORDER BY Created ASC) as First_ChannelType,
+                LAST_VALUE(Status) OVER (PARTITION BY CallId ORDER BY Created ASC ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) as Last_Status,
+                ROW_NUMBER() OVER (PARTITION BY CallId ORDER BY Created ASC) as rn_first
+            FROM CallData
+        )
+        {insert_sql}
+        SELECT
+            CallId, First_Created AS Created, First_LandingNumber AS LandingNumber, First_CallerNr AS CallerNr,
+            First_ChannelType AS ChannelType, First_QueueId AS QueueId, CaseId,
+            Last_Status AS Status, Duration, TalkTimeInSec
+        {into_sql}
+        FROM CalculatedMetrics
+        WHERE rn_first = 1 {extra_where}
+    """
+
 def get_holidays(years: list) -> pd.DataFrame:
     cal = Sweden()
     all_holidays = []
@@ -156,6 +349,44 @@ def get_holidays(years: list) -> pd.DataFrame:
     holidays_df['ds'] = pd.to_datetime(holidays_df['ds'])
     return holidays_df
 
+# Kompilerad kategori-matchare + cache per unikt kundnamn
+_CATEGORY_MATCHER = {'key': None, 'pattern': None, 'categories': None, 'cache': {}}
+
+def _get_category_matcher():
+    """
+    Bygger EN regex för alla kategorier: (?=(?P<g0>...)|(?P<g1>...)|...) i prioritetsordning.
+    Lookahead gör att varje position provas, och vid varje position vinner första (högst
+    prioriterade) alternativet -> bästa kategori = lägsta gruppindex över alla träffar.
+    Prioritet: config.CUSTOMER_CATEGORY_PRIORITY (högst först), annars som tidigare
+    loop-logik där senare kategori i CUSTOMER_CATEGORIES skriver över tidigare.
+    """
+    categories = {c: '|'.join(kw) for c, kw in (getattr(config, 'CUSTOMER_CATEGORIES', None) or {}).items()}
+    priority = getattr(config, 'CUSTOMER_CATEGORY_PRIORITY', None) or list(reversed(list(categories)))
+    ordered = [c for c in priority if categories.get(c)]
+    key = tuple((c, categories[c]) for c in ordered)
+
+    if _CATEGORY_MATCHER['key'] != key:
+        if ordered:
+            body = '|'.join(f"(?P<g{i}>{categories[c]})" for i, c in enumerate(ordered))
+            pattern = re.compile(f"(?=(?:{body}))", re.IGNORECASE)
+        else:
+            pattern = None
+        _CATEGORY_MATCHER.update(key=key, pattern=pattern, categories=ordered, cache={})
+    return _CATEGORY_MATCHER
+
+def _match_category(name: str, matcher: dict) -> str:
+    pattern = matcher['pattern']
+    if pattern is None:
+        return 'Övrigt'
+    best = None
+    for m in pattern.finditer(name):
+        idx = int(m.lastgroup[1:])
+        if best is None or idx < best:
+            best = idx
+            if best == 0:
+                break
+    return 'Övrigt' if best is None else matcher['categories'][best]
+
 def categorize_customer(df: pd.DataFrame) -> pd.DataFrame:
     if 'Name' not in df.columns:
         print("VARNING: 'Name'-kolumn saknas, kan inte kategorisera kunder.", file=sys.stderr)
@@ -163,21 +394,30 @@ def categorize_customer(df: pd.DataFrame) -> pd.DataFrame:
         df['är_dotterbolag'] = 0
         return df
     df['Name'] = df['Name'].astype(str)
-    df['kategori'] = 'Övrigt' 
-    for category, keywords in config.CUSTOMER_CATEGORIES.items():
-        keyword_regex = '|'.join(keywords)
-        if keyword_regex:
-            df.loc[df['Name'].str.contains(keyword_regex, case=False, na=False), 'kategori'] = category
+
+    # Matcha bara unika namn (namnen upprepas kraftigt), resultat cachas mellan anrop
+    matcher = _get_category_matcher()
+    cache = matcher['cache']
+    codes, uniques = pd.factorize(df['Name'])
+    unique_categories = []
+    for name in uniques:
+        category = cache.get(name)
+        if category is None:
+            category = _match_category(name, matcher)
+            cache[name] = category
+        unique_categories.append(category)
+    df['kategori'] = np.asarray(unique_categories, dtype=object)[codes] if len(uniques) else 'Övrigt'
+
     if 'ParentId' not in df.columns:
          df['är_dotterbolag'] = 0
     else:
         df['är_dotterbolag'] = (~df['ParentId'].isin([0, np.nan, None, ''])).astype(int)
     return df
 
-def add_all_features(df: pd.DataFrame, ds_col: str = 'ds') -> pd.DataFrame:
+def _compute_time_features(df: pd.DataFrame, ds_col: str = 'ds') -> pd.DataFrame:
     """
-    Skapar alla nödvändiga tids-features från en datumkolumn ('ds').
-    *** KORRIGERAD: Tvingar 'naive' datetime och lägger till namn. ***
+    Referensberäkning av alla tids-features (utan cache).
+    Används för att bygga kalenderdimensionen och som fallback (t.ex. NaT i ds).
     """
     # KORRIGERING: Tvinga bort all tidszons-information
     df[ds_col] = pd.to_datetime(df[ds_col]).dt.tz_localize(None)
@@ -227,4 +467,772 @@ def add_all_features(df: pd.DataFrame, ds_col: str = 'ds') -> pd.DataFrame:
     df['year_sin'] = np.sin(2 * np.pi * df['dag_på_året'] / 365.25)
     df['year_cos'] = np.cos(2 * np.pi * df['dag_på_året'] / 365.25)
     
-    return df
\ No newline at end of file
+    return df
+
+# Ordningen på kolumnerna som add_all_features skapar
+TIME_FEATURES = ['timme', 'minut', 'veckodag', 'dag_på_året', 'vecka_nr', 'månad', 'kvartal', 'år', 'datum',
+                 'veckodag_namn', 'månad_namn', 'är_arbetsdag', 'är_dagen_efter_stängt',
+                 'är_tidig_morgon', 'är_förmiddag', 'är_lunchtid', 'är_eftermiddag', 'year_sin', 'year_cos']
+# Features som bara beror på datumet (hämtas från kalenderdimensionen)
+DAY_FEATURES = ['veckodag', 'dag_på_året', 'vecka_nr', 'månad', 'kvartal', 'år', 'datum',
+                'veckodag_namn', 'månad_namn', 'är_arbetsdag', 'är_dagen_efter_stängt', 'year_sin', 'year_cos']
+
+# Memoiserad kalenderdimension: en rad per dag, byggs ut vid behov
+_CALENDAR_DIM = None
+
+def get_calendar_dimension(days) -> pd.DataFrame:
+    """
+    Returnerar kalenderdimensionen (index = dag 00:00) för minst de angivna dagarna.
+    Saknade dagar beräknas EN gång med referenslogiken och cachas för resten av processen.
+    """
+    global _CALENDAR_DIM
+    days = pd.DatetimeIndex(days).normalize().unique()
+    if len(days) == 0 and _CALENDAR_DIM is None:
+        return pd.DataFrame(columns=DAY_FEATURES, index=pd.DatetimeIndex([], name='ds'))
+    missing = days if _CALENDAR_DIM is None else days.difference(_CALENDAR_DIM.index)
+    if len(missing):
+        # Bygg hela år så att helgdagslogiken (dagen efter stängt) ser samma dagar som förut
+        years = sorted(set(missing.year))
+        all_days = pd.date_range(f"{years[0]}-01-01", f"{years[-1]}-12-31", freq='D')
+        if _CALENDAR_DIM is not None:
+            all_days = all_days.difference(_CALENDAR_DIM.index)
+        df_days = _compute_time_features(pd.DataFrame({'ds': all_days}), ds_col='ds')
+        df_days = df_days.set_index('ds')[DAY_FEATURES]
+        _CALENDAR_DIM = df_days if _CALENDAR_DIM is None else pd.concat([_CALENDAR_DIM, df_days]).sort_index()
+    return _CALENDAR_DIM
+
+def add_all_features(df: pd.DataFrame, ds_col: str = 'ds', features: list = None) -> pd.DataFrame:
+    """
+    Skapar alla nödvändiga tids-features från en datumkolumn ('ds').
+    *** KORRIGERAD: Tvingar 'naive' datetime och lägger till namn. ***
+    Dagsfeatures hämtas från den memoiserade kalenderdimensionen via heltalsposition
+    (istället för .dt/isocalendar/map/helgdagar per rad). features=[...] skapar bara
+    de angivna kolumnerna. Resultatet är identiskt med _compute_time_features.
+    """
+    # KORRIGERING: Tvinga bort all tidszons-information
+    df[ds_col] = pd.to_datetime(df[ds_col]).dt.tz_localize(None)
+    wanted = TIME_FEATURES if features is None else [f for f in TIME_FEATURES if f in features]
+
+    ds = df[ds_col]
+    if df.empty or ds.isna().any():
+        df_full = _compute_time_features(df, ds_col=ds_col)
+        return df_full.drop(columns=[c for c in TIME_FEATURES if c not in wanted])
+
+    # Dagsfeatures: unika dagar -> kalenderdimension -> take per rad
+    day_codes, unique_days = pd.factorize(ds.dt.normalize())
+    calendar = get_calendar_dimension(unique_days).reindex(pd.DatetimeIndex(unique_days))
+
+    need_time = any(f in wanted for f in ['timme', 'minut', 'är_tidig_morgon', 'är_förmiddag', 'är_lunchtid', 'är_eftermiddag'])
+    if need_time:
+        hour = ds.dt.hour
+        minute = ds.dt.minute
+        time_as_float = hour + minute / 60.0
+
+    for col in wanted:
+        if col in DAY_FEATURES:
+            df[col] = calendar[col].to_numpy()[day_codes]
+        elif col == 'timme':
+            df[col] = hour
+        elif col == 'minut':
+            df[col] = minute
+        elif col == 'är_tidig_morgon':
+            df[col] = ((time_as_float >= 6.5) & (time_as_float < 8)).astype(int)
+        elif col == 'är_förmiddag':
+            df[col] = ((time_as_float >= 8) & (time_as_float < 11)).astype(int)
+        elif col == 'är_lunchtid':
+            df[col] = ((time_as_float >= 11) & (time_as_float < 13)).astype(int)
+        elif col == 'är_eftermiddag':
+            df[col] = ((time_as_float >= 13) & (time_as_float < 17.5)).astype(int)
+
+    return df
+
+# ================================================================
+# BULK-SKRIVNING (ersätter rad-för-rad INSERT från DataFrame.to_sql)
+# ================================================================
+# Lägen (config.BULK_WRITE_MODE):
+#   'pandas'      -> vanlig DataFrame.to_sql (reserv/fallback)
+#   'executemany' -> batchad executemany med array-bindning (pyodbc fast_executemany)
+#   'auto'        -> executemany, men filbaserad bcp-laddning för stora volymer
+#   'bcp'         -> alltid filbaserad bcp-laddning (kräver config.BULK_BCP_ARGS)
+BULK_FIELD_SEP = '|~|'
+
+def _bulk_rows(df: pd.DataFrame):
+    """ Gör om DataFrame till DBAPI-vänliga tupler (NaN/NaT -> None, Timestamp är en datetime-subklass). """
+    columns = []
+    for c in df.columns:
+        col = df[c]
+        # astype(object) ger Timestamp-objekt för datetime-kolumner (dt.to_pydatetime ger FutureWarning)
+        values = col.astype(object).where(col.notna(), None).to_numpy(copy=True)
+        values[pd.isna(col).to_numpy()] = None
+        columns.append(values)
+    return list(zip(*columns))
+
+def _bulk_insert_executemany(df, table_name, engine, batch_size):
+    cols = ", ".join([f"[{c}]" for c in df.columns])
+    # pyodbc använder '?', pymssql '%s'
+    placeholder = "?" if engine.dialect.paramstyle == 'qmark' else "%s"
+    params = ", ".join([placeholder] * len(df.columns))
+    insert_sql = f"INSERT INTO [{table_name}] ({cols}) VALUES ({params})"
+
+    raw_conn = engine.raw_connection()
+    try:
+        cursor = raw_conn.cursor()
+        # pyodbc: skicka hela batchen som en parameter-array istället för en rad i taget
+        if hasattr(cursor, 'fast_executemany'):
+            cursor.fast_executemany = True
+        for start in range(0, len(df), batch_size):
+            cursor.executemany(insert_sql, _bulk_rows(df.iloc[start:start + batch_size]))
+        raw_conn.commit()
+        cursor.close()
+    except Exception:
+        raw_conn.rollback()
+        raise
+    finally:
+        raw_conn.close()
+
+def _bulk_insert_bcp(df, table_name, bcp_args, batch_size):
+    # Bygg textrader kolumnvis: tomt fält = NULL i bcp teckenläge
+    text_cols = []
+    for c in df.columns:
+        col = df[c]
+        if pd.api.types.is_datetime64_any_dtype(col):
+            col = col.dt.strftime('%Y-%m-%d %H:%M:%S.%f').str[:-3]
+        elif pd.api.types.is_bool_dtype(col):
+            col = col.astype(int)
+        col = col.astype(object).where(pd.notna(col), None)
+        # Avgränsare och radbrytningar får inte finnas i textfälten
+        col = col.astype(str).where(col.notna(), '')
+        text_cols.append(col.str.replace(r'[\r\n]+', ' ', regex=True).str.replace(BULK_FIELD_SEP, ' ', regex=False))
+    lines = text_cols[0].str.cat(text_cols[1:], sep=BULK_FIELD_SEP) if len(text_cols) > 1 else text_cols[0]
+
+    stage_dir = getattr(config, 'BULK_STAGE_DIR', None) or tempfile.gettempdir()
+    fd, path = tempfile.mkstemp(prefix=f"{table_name}_", suffix='.dat', dir=stage_dir)
+    os.close(fd)
+    try:
+        with open(path, 'w', encoding='utf-8', newline='\n') as f:
+            f.write('\n'.join(lines.tolist()))
+            f.write('\n')
+
+        cmd = ['bcp', table_name, 'in', path, '-c', '-C', '65001',
+               '-t', BULK_FIELD_SEP, '-r', '0x0a', '-b', str(batch_size)] + list(bcp_args)
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"bcp misslyckades ({result.returncode}): {result.stdout} {result.stderr}")
+    finally:
+        os.remove(path)
+
+def sql_column_types(df: pd.DataFrame, bounded_cols: list = None, min_length: int = 128) -> dict:
+    """
+    SQL-typer för object-kolumner, härledda från hela kolumnen som to_sql gör.
+    En tom DataFrame (head(0)) ger annars TEXT för t.ex. datetime.date/time.
+    bounded_cols: strängkolumner som ska kunna indexeras -> NVARCHAR(n) i stället för
+    NVARCHAR(max), n = max(min_length, längsta värdet).
+    """
+    from sqlalchemy.types import NVARCHAR, TIMESTAMP, BigInteger, Boolean, Date, DateTime, Float, Time
+    types = {}
+    for col in df.columns[df.dtypes == object]:
+        values = df[col]
+        kind = pd.api.types.infer_dtype(values, skipna=True)
+        if kind == 'date':
+            types[col] = Date
+        elif kind == 'time':
+            types[col] = Time
+        elif kind == 'datetime':
+            first = values.dropna().iloc[0] if values.notna().any() else None
+            types[col] = TIMESTAMP(timezone=True) if getattr(first, 'tzinfo', None) is not None else DateTime
+        elif kind == 'boolean':
+            types[col] = Boolean
+        elif kind == 'floating':
+            types[col] = Float(precision=53)
+        elif kind == 'integer':
+            types[col] = BigInteger
+        elif col in (bounded_cols or []):
+            longest = values.dropna().astype(str).str.len().max() if values.notna().any() else 0
+            types[col] = NVARCHAR(max(int(min_length), int(longest)))
+    return types
+
+def bulk_write(df: pd.DataFrame, table_name: str, engine, if_exists: str = 'append', mode: str = None, batch_size: int = None) -> dict:
+    """
+    Snabb skrivning av en DataFrame till MSSQL.
+    - Skapar/ersätter tabellen med samma schema som to_sql (via en tom to_sql med
+      kolumntyperna härledda från hela DataFrame:n).
+    - Skriver raderna med vald metod (se BULK_WRITE_MODE ovan).
+    - Rapporterar rader/sekund per tabell och returnerar statistiken.
+    """
+    mode = (mode or getattr(config, 'BULK_WRITE_MODE', 'auto')).lower()
+    batch_size = batch_size or getattr(config, 'BULK_BATCH_SIZE', 50000)
+    bcp_args = getattr(config, 'BULK_BCP_ARGS', None)
+    file_min_rows = getattr(config, 'BULK_FILE_MIN_ROWS', 500000)
+
+    if mode == 'auto':
+        mode = 'bcp' if (bcp_args and len(df) >= file_min_rows) else 'executemany'
+    if mode == 'bcp' and not bcp_args:
+        print("VARNING: BULK_BCP_ARGS saknas i config, använder executemany istället.", file=sys.stderr)
+        mode = 'executemany'
+
+    t0 = datetime.now()
+    if mode == 'pandas' or df.empty:
+        mode = 'pandas'
+        df.to_sql(table_name, engine, if_exists=if_exists, index=False, chunksize=batch_size)
+    else:
+        # Skapa tabellen (schema från pandas), skriv sedan datat i bulk
+        df.head(0).to_sql(table_name, engine, if_exists=if_exists, index=False, dtype=sql_column_types(df))
+        if mode == 'bcp':
+            _bulk_insert_bcp(df, table_name, bcp_args, batch_size)
+        else:
+            _bulk_insert_executemany(df, table_name, engine, batch_size)
+
+    seconds = max((datetime.now() - t0).total_seconds(), 1e-6)
+    stats = {'table': table_name, 'rows': len(df), 'seconds': seconds, 'rows_per_sec': len(df) / seconds, 'mode': mode}
+    print(f"   -> [{mode}] {table_name}: {len(df)} rader på {seconds:.1f}s ({stats['rows_per_sec']:.0f} rader/s)")
+    return stats
+
+
+# ================================================================
+# REDIAL-MOTOR (vektoriserad, heltalskodade nummer)
+# ================================================================
+def detect_redials(df: pd.DataFrame, threshold_sec: int = 300, state: pd.DataFrame = None):
+    """
+    Hittar äkta återuppringningar (REDIAL V2) med NumPy istället för groupby.shift:
+    - Giltigt nummer (>= 7 siffror efter tvätt)
+    - Inom threshold_sec (och > 0 s) efter föregående samtal från samma nummer
+    - Föregående samtal var 'callabandoned'
+    - OCH samma kö (QueueId == föregående QueueId)
+
+    Numren tvättas (regex) bara en gång per unikt värde och kodas till heltal,
+    sedan görs EN sortering (nummer, Created).
+
+    Kräver kolumnerna 'CallerNr', 'Created', 'Status', 'QueueId'.
+    För chunkvis körning (tidsordnade chunkar) skickas 'state' från föregående
+    chunk in, så att första samtalet per nummer jämförs med förra chunkens sista.
+
+    Returnerar (is_redial, order, state):
+    - is_redial: int-array (0/1) i samma radordning som df
+    - order: radpositioner sorterade på (tvättat nummer, Created) - samma ordning
+      som sort_values(['CallerNr_Clean', 'Created'])
+    - state: sista samtalet per nummer (att skicka till nästa chunk)
+    """
+    n = len(df)
+    threshold_ns = np.int64(threshold_sec) * 1_000_000_000
+
+    # 1. Koda nummer: regex bara på unika råvärden, sorterade koder = strängordning
+    raw_codes, raw_uniques = pd.factorize(df['CallerNr'].astype(str).fillna(''))
+    clean_per_raw = pd.Series(np.asarray(raw_uniques, dtype=object)).str.replace(r'\D', '', regex=True)
+    clean_codes_per_raw, clean_uniques = pd.factorize(clean_per_raw, sort=True)
+    caller = clean_codes_per_raw[raw_codes] if n else np.zeros(0, dtype=np.int64)
+    clean_uniques = pd.Index(clean_uniques, dtype=object)
+    valid_number = np.asarray(clean_uniques.str.len() >= 7, dtype=bool)
+
+    created = df['Created'].to_numpy(dtype='datetime64[ns]').view('int64')
+    status_codes, status_uniques = pd.factorize(df['Status'])
+    abandoned_per_status = (pd.Series(np.asarray(status_uniques, dtype=object)).str.lower() == 'callabandoned').to_numpy(dtype=bool)
+    abandoned = np.zeros(n, dtype=bool)
+    has_status = status_codes >= 0
+    abandoned[has_status] = abandoned_per_status[status_codes[has_status]]
+    queue_codes, _ = pd.factorize(df['QueueId'])
+    queue_raw = df['QueueId'].to_numpy()
+
+    # 2. EN sortering (stabil): nummer, sedan tid
+    order = np.lexsort((created, caller))
+    c = caller[order]
+    t = created[order]
+    ab = abandoned[order]
+    q = queue_codes[order]
+
+    # 3. Föregående samtal (samma nummer) via skiftade vyer
+    has_prev = np.zeros(n, dtype=bool)
+    diff = np.zeros(n, dtype=np.int64)
+    prev_ab = np.zeros(n, dtype=bool)
+    same_queue = np.zeros(n, dtype=bool)
+    if n > 1:
+        has_prev[1:] = c[1:] == c[:-1]
+        diff[1:] = t[1:] - t[:-1]
+        prev_ab[1:] = ab[:-1]
+        same_queue[1:] = (q[1:] == q[:-1]) & (q[1:] >= 0)
+
+    # 4. Första samtalet per nummer i chunken: jämför med medförd state
+    if state is not None and not state.empty and n:
+        first_idx = np.flatnonzero(~has_prev)
+        st = state.reindex(clean_uniques[c[first_idx]])
+        found = st['last_created'].notna().to_numpy()
+        idx = first_idx[found]
+        st = st[found]
+        has_prev[idx] = True
+        diff[idx] = t[idx] - st['last_created'].to_numpy(dtype='datetime64[ns]').view('int64')
+        prev_ab[idx] = st['last_abandoned'].to_numpy(dtype=bool)
+        same_queue[idx] = pd.Series(queue_raw[order][idx]).eq(pd.Series(st['last_queue'].to_numpy())).to_numpy()
+
+    is_redial_sorted = valid_number[c] & has_prev & (diff > 0) & (diff <= threshold_ns) & prev_ab & same_queue
+    is_redial = np.zeros(n, dtype=int)
+    is_redial[order] = is_redial_sorted
+
+    # 5. Ny state: sista samtalet per (giltigt) nummer, äldre än tröskeln behövs inte
+    is_last = np.ones(n, dtype=bool)
+    if n > 1:
+        is_last[:-1] = c[:-1] != c[1:]
+    keep = is_last & valid_number[c]
+    new_state = pd.DataFrame({
+        'last_created': t[keep].view('datetime64[ns]'),
+        'last_abandoned': ab[keep],
+        'last_queue': queue_raw[order][keep],
+    }, index=pd.Index(clean_uniques[c[keep]], name='CallerNr_Clean'))
+    if state is not None and not state.empty:
+        new_state = pd.concat([state[~state.index.isin(new_state.index)], new_state])
+    if n:
+        cutoff = np.datetime64(int(t.max() - threshold_ns), 'ns')
+        new_state = new_state[new_state['last_created'] >= cutoff]
+
+    return is_redial, order, new_state
+
+
+# ================================================================
+# DTYPE-PLAN (minneskompakta DataFrames)
+# ================================================================
+def memory_mb(df: pd.DataFrame) -> float:
+    """ Faktisk minnesanvändning (inkl. strängar) i MB. """
+    return df.memory_usage(deep=True).sum() / (1024 * 1024)
+
+def apply_dtype_plan(df: pd.DataFrame, string_cols: list, string_dtype: str = 'category') -> pd.DataFrame:
+    """
+    Gör om DataFrame till kompakta typer (på plats, kolumn för kolumn):
+    - string_cols -> 'category' (eller t.ex. 'string[pyarrow]')
+    - heltal -> minsta heltalstyp som rymmer värdena
+    - flyttal -> float32 ENDAST om alla värden går att återskapa exakt
+    """
+    for col in df.columns:
+        s = df[col]
+        if col in string_cols:
+            if string_dtype == 'category':
+                df[col] = s.astype('category')
+            else:
+                df[col] = s.astype(string_dtype)
+        elif pd.api.types.is_bool_dtype(s) or not pd.api.types.is_numeric_dtype(s):
+            continue
+        elif pd.api.types.is_integer_dtype(s):
+            df[col] = pd.to_numeric(s, downcast='integer')
+        elif pd.api.types.is_float_dtype(s):
+            s32 = s.astype('float32')
+            if ((s32.astype('float64') == s) | s.isna()).all():
+                df[col] = s32
+    return df
+
+def widen_for_sql(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Vidgar kolumner som apply_dtype_plan har krympt (heltal -> int64, float32 -> float64)
+    innan de skrivs till SQL, så att tabellerna får BIGINT/FLOAT som tidigare och senare
+    inkrementella tillägg med större värden inte flödar över. Endast de kolumnerna kopieras.
+    """
+    widen = {}
+    for col, dtype in df.dtypes.items():
+        if pd.api.types.is_bool_dtype(dtype) or not pd.api.types.is_numeric_dtype(dtype):
+            continue
+        nullable = isinstance(dtype, pd.api.extensions.ExtensionDtype)
+        if pd.api.types.is_integer_dtype(dtype) and str(dtype) not in ('int64', 'Int64'):
+            widen[col] = 'Int64' if nullable else np.int64
+        elif str(dtype) in ('float32', 'Float32'):
+            widen[col] = 'Float64' if nullable else np.float64
+    return df.astype(widen) if widen else df
+
+# --- MODELLREGISTER ---
+# MODEL_DIR/registry/versions/<version>/<modell>.txt (LightGBM:s eget format) + manifest.json,
+# MODEL_DIR/registry/current.json pekar på aktiv version (byts atomiskt med os.replace).
+REGISTRY_MANIFEST = 'manifest.json'
+REGISTRY_CURRENT = 'current.json'
+
+def registry_dir() -> str:
+    return getattr(config, 'MODEL_REGISTRY_DIR', os.path.join(config.MODEL_DIR, 'registry'))
+
+def _registry_versions_dir() -> str:
+    return os.path.join(registry_dir(), 'versions')
+
+def _write_json_atomic(path: str, payload: dict):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, indent=2, ensure_ascii=False, default=str)
+    os.replace(tmp_path, path)
+
+def list_model_versions() -> list:
+    """ Publicerade versioner, äldst först (versions-id är tidsstämplar). """
+    versions_dir = _registry_versions_dir()
+    if not os.path.isdir(versions_dir):
+        return []
+    return sorted(v for v in os.listdir(versions_dir)
+                  if not v.startswith('.') and os.path.exists(os.path.join(versions_dir, v, REGISTRY_MANIFEST)))
+
+def get_current_version():
+    path = os.path.join(registry_dir(), REGISTRY_CURRENT)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('version')
+
+def set_current_version(version: str):
+    """ Pekar om 'current' (atomiskt); används vid publicering och rollback. """
+    if version not in list_model_versions():
+        raise ValueError(f"Modellversion '{version}' finns inte i registret.")
+    _write_json_atomic(os.path.join(registry_dir(), REGISTRY_CURRENT),
+                       {'version': version, 'updated': datetime.now().isoformat(timespec='seconds')})
+
+def rollback_model_version(version: str = None) -> str:
+    """ Sätter 'current' till angiven version, eller versionen före den aktiva. """
+    if version is None:
+        versions = list_model_versions()
+        current = get_current_version()
+        older = [v for v in versions if current is None or v < current]
+        if not older:
+            raise ValueError("Ingen äldre modellversion att rulla tillbaka till.")
+        version = older[-1]
+    set_current_version(version)
+    return version
+
+def begin_model_version() -> str:
+    """ Skapar en ny (opublicerad) versionskatalog; modellerna sparas där under träningen. """
+    versions_dir = _registry_versions_dir()
+    os.makedirs(versions_dir, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    version, n = stamp, 1
+    while os.path.exists(os.path.join(versions_dir, version)) or os.path.exists(os.path.join(versions_dir, f'.{version}')):
+        n += 1
+        version = f'{stamp}_{n}'
+    os.makedirs(os.path.join(versions_dir, f'.{version}'))
+    return version
+
+def discard_model_version(version: str):
+    """ Tar bort en opublicerad versionskatalog (t.ex. när träning eller publicering misslyckas). """
+    shutil.rmtree(os.path.join(_registry_versions_dir(), f'.{version}'), ignore_errors=True)
+
+def staged_model_path(version: str, name: str) -> str:
+    return os.path.join(_registry_versions_dir(), f'.{version}', f'{name}.txt')
+
+def model_manifest_entry(name: str, features: list, categorical_features: list, cat_dtypes: dict,
+                         params: dict = None, window: dict = None, metrics: dict = None, compiled: str = None) -> dict:
+    """ Manifestdel för en modell: features, kategorinivåer, träningsfönster och mått. """
+    return {
+        'file': f'{name}.txt',
+        'features': list(features),
+        'categorical_features': list(categorical_features),
+        'categories': {c: dtype.categories.tolist() for c, dtype in cat_dtypes.items()},
+        'category_types': {c: str(dtype.categories.dtype) for c, dtype in cat_dtypes.items()},
+        'params': params or {},
+        'training_window': window or {},
+        'metrics': metrics or {},
+        'compiled': compiled,
+    }
+
+def publish_model_version(version: str, models: dict, info: dict = None, make_current: bool = True) -> str:
+    """
+    Skriver manifestet, flyttar versionskatalogen på plats (rename) och pekar om 'current'.
+    Äldre versioner utöver MODEL_REGISTRY_KEEP rensas (aktiv version behålls alltid).
+    """
+    versions_dir = _registry_versions_dir()
+    staged_dir = os.path.join(versions_dir, f'.{version}')
+    for name, entry in models.items():
+        for file_name in (entry['file'], entry.get('compiled')):
+            if file_name and not os.path.exists(os.path.join(staged_dir, file_name)):
+                raise FileNotFoundError(f"Modellfil {file_name} saknas för '{name}' i version {version}.")
+    manifest = {'version': version, 'created': datetime.now().isoformat(timespec='seconds'),
+                **(info or {}), 'models': models}
+    _write_json_atomic(os.path.join(staged_dir, REGISTRY_MANIFEST), manifest)
+    os.rename(staged_dir, os.path.join(versions_dir, version))
+    if make_current:
+        set_current_version(version)
+    _prune_model_versions()
+    return version
+
+def _prune_model_versions():
+    keep = int(getattr(config, 'MODEL_REGISTRY_KEEP', 10))
+    versions = list_model_versions()
+    pinned = {get_current_version(), getattr(config, 'MODEL_VERSION', None)}
+    for version in versions[:max(0, len(versions) - keep)]:
+        if version not in pinned:
+            shutil.rmtree(os.path.join(_registry_versions_dir(), version), ignore_errors=True)
+
+def resolve_model_version(version: str = None):
+    """ Explicit version > config.MODEL_VERSION (fäst version) > 'current'. """
+    version = version or getattr(config, 'MODEL_VERSION', None)
+    if version in (None, '', 'current'):
+        return get_current_version()
+    if version not in list_model_versions():
+        raise ValueError(f"Modellversion '{version}' finns inte i registret.")
+    return version
+
+def read_model_manifest(version: str = None):
+    version = resolve_model_version(version)
+    if version is None:
+        return None
+    with open(os.path.join(_registry_versions_dir(), version, REGISTRY_MANIFEST), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def registered_model_path(name: str, version: str = None):
+    manifest = read_model_manifest(version)
+    if manifest is None or name not in manifest['models']:
+        return None
+    return os.path.join(_registry_versions_dir(), manifest['version'], manifest['models'][name]['file'])
+
+def load_registered_model(name: str, version: str = None):
+    """
+    Laddar en modell ur registret som samma payload-dict som de gamla picklarna
+    ({'model', 'features', 'categorical_features', 'cat_dtypes'}) + 'version'.
+    Returnerar None om registret saknar modellen.
+    """
+    import lightgbm as lgb
+    manifest = read_model_manifest(version)
+    if manifest is None or name not in manifest['models']:
+        return None
+    entry = manifest['models'][name]
+    booster = lgb.Booster(model_file=os.path.join(_registry_versions_dir(), manifest['version'], entry['file']))
+    return {
+        'model': booster,
+        'features': entry['features'],
+        'categorical_features': entry['categorical_features'],
+        'cat_dtypes': {c: pd.CategoricalDtype(pd.Index(levels, dtype=entry.get('category_types', {}).get(c)))
+                       for c, levels in entry['categories'].items()},
+        'version': manifest['version'],
+    }
+
+# --- KOMPILERAD TRÄDPREDIKTOR ---
+# En LightGBM-modell (textformat) plattas ut till sammanhängande NumPy-arrayer; alla träd
+# utvärderas samtidigt nivå för nivå. Ger exakt samma värden som Booster.predict
+# (samma beslutsregler för saknade värden och kategoriska bitset, trädsumman i trädordning).
+COMPILED_SUFFIX = '.npz'
+_K_ZERO_THRESHOLD = 1e-35
+_OUTPUT_TRANSFORMS = {'regression': 'identity', 'regression_l1': 'identity', 'huber': 'identity',
+                      'fair': 'identity', 'quantile': 'identity', 'mape': 'identity',
+                      'tweedie': 'exp', 'poisson': 'exp', 'gamma': 'exp'}
+
+def _parse_model_text(model_str: str):
+    """ Header, trädblock och pandas_categorical ur LightGBM:s textformat. """
+    header, trees, pandas_categorical = {}, [], None
+    current, in_trees = header, True
+    for line in model_str.splitlines():
+        if line.startswith('pandas_categorical:'):
+            pandas_categorical = json.loads(line[len('pandas_categorical:'):])
+        elif not in_trees:
+            continue
+        elif line == 'end of trees':
+            in_trees = False
+        elif line.startswith('Tree='):
+            current = {}
+            trees.append(current)
+        elif '=' in line:
+            key, value = line.split('=', 1)
+            current[key] = value
+    return header, trees, pandas_categorical
+
+def compile_model_text(model_str: str) -> dict:
+    """
+    Exporterar en modell till platta arrayer:
+    - noder (alla träd efter varandra): split_feature, threshold, decision_type, left/right
+      (>= 0 = global nodindex, < 0 = ~globalt lövindex)
+    - leaf_value, roots (rot per träd), cat_boundaries/cat_threshold (bitset för kategoriska splits)
+    """
+    header, trees, pandas_categorical = _parse_model_text(model_str)
+    if int(header.get('num_tree_per_iteration', 1)) != 1:
+        raise ValueError("Kompilerad prediktor stöder bara modeller med ett träd per iteration.")
+    objective = header.get('objective', 'regression').split()[0]
+    if objective not in _OUTPUT_TRANSFORMS:
+        raise ValueError(f"Kompilerad prediktor: objective '{objective}' stöds inte.")
+
+    ints = lambda s: np.array(s.split(), dtype=np.int64) if s else np.zeros(0, dtype=np.int64)
+    floats = lambda s: np.array(s.split(), dtype=np.float64) if s else np.zeros(0)
+    feat, thr, dtype_, left, right, leaves, roots, cat_bounds, cat_words = [], [], [], [], [], [], [], [np.zeros(1, dtype=np.int64)], []
+    n_nodes = n_leaves = n_cats = n_words = 0
+    for tree in trees:
+        if int(tree.get('is_linear', 0)):
+            raise ValueError("Kompilerad prediktor: linjära träd stöds inte.")
+        leaf_value = floats(tree['leaf_value'])
+        if int(tree['num_leaves']) == 1:
+            roots.append(~n_leaves)
+        else:
+            children = [ints(tree['left_child']), ints(tree['right_child'])]
+            left.append(np.where(children[0] >= 0, children[0] + n_nodes, ~(~children[0] + n_leaves)))
+            right.append(np.where(children[1] >= 0, children[1] + n_nodes, ~(~children[1] + n_leaves)))
+            decision = ints(tree['decision_type'])
+            threshold = floats(tree['threshold'])
+            # Kategoriska noder: threshold = lokalt kategoriindex -> globalt index i cat_boundaries
+            is_cat = (decision & 1).astype(bool)
+            threshold[is_cat] += n_cats
+            feat.append(ints(tree['split_feature']))
+            thr.append(threshold)
+            dtype_.append(decision)
+            roots.append(n_nodes)
+            n_nodes += len(decision)
+            num_cat = int(tree.get('num_cat', 0))
+            if num_cat > 0:
+                cat_bounds.append(ints(tree['cat_boundaries'])[1:] + n_words)
+                words = ints(tree['cat_threshold'])
+                cat_words.append(words)
+                n_cats += num_cat
+                n_words += len(words)
+        leaves.append(leaf_value)
+        n_leaves += len(leaf_value)
+
+    cat = lambda parts, dtype: np.concatenate(parts).astype(dtype) if parts else np.zeros(0, dtype=dtype)
+    return {
+        'split_feature': cat(feat, np.int32), 'threshold': cat(thr, np.float64),
+        'decision_type': cat(dtype_, np.int8), 'left': cat(left, np.int64), 'right': cat(right, np.int64),
+        'leaf_value': cat(leaves, np.float64), 'roots': np.array(roots, dtype=np.int64),
+        'cat_boundaries': cat(cat_bounds, np.int64), 'cat_threshold': cat(cat_words, np.uint32),
+        'feature_names': np.array(header.get('feature_names', '').split()),
+        'transform': np.array(_OUTPUT_TRANSFORMS[objective]),
+        'pandas_categorical': np.array(json.dumps(pandas_categorical)),
+    }
+
+class CompiledTreeModel:
+    """ Vektoriserad utvärdering av en kompilerad modell; predict(X) som Booster.predict. """
+
+    def __init__(self, arrays: dict):
+        self.arrays = {k: np.asarray(v) for k, v in arrays.items()}
+        self.feature_names = [str(f) for f in self.arrays['feature_names']]
+        self.pandas_categorical = json.loads(str(self.arrays['pandas_categorical']))
+        self.transform = str(self.arrays['transform'])
+        self._build_tables()
+
+    def _build_tables(self):
+        """
+        Gemensam nodtabell: inre noder 0..N-1, löv N..N+L-1 som pekar på sig själva.
+        Då kan alla (rad, träd)-par stegas samtidigt med samma operationer tills alla står i ett löv.
+        """
+        a = self.arrays
+        n_nodes, n_leaves = len(a['decision_type']), len(a['leaf_value'])
+        leaf_ids = np.arange(n_nodes, n_nodes + n_leaves)
+        to_unified = lambda ref: np.where(ref >= 0, ref, n_nodes + ~ref)
+        decision = np.concatenate([a['decision_type'].astype(np.int64), np.zeros(n_leaves, dtype=np.int64)])
+        self._feature = np.concatenate([a['split_feature'], np.zeros(n_leaves)]).astype(np.int32)
+        self._threshold = np.concatenate([a['threshold'], np.zeros(n_leaves)])
+        left = np.concatenate([to_unified(a['left']), leaf_ids])
+        right = np.concatenate([to_unified(a['right']), leaf_ids])
+        # children[2 * nod + 0] = vänster, [2 * nod + 1] = höger -> ett uppslag per steg
+        self._children = np.column_stack([left, right]).ravel().astype(np.int32)
+        self._roots = to_unified(a['roots']).astype(np.int32)
+        self._n_nodes = n_nodes
+        self._values = np.concatenate([np.zeros(n_nodes), a['leaf_value']])
+        self._is_cat = (decision & 1).astype(bool)
+        default_left = (decision & 2).astype(bool)
+        missing_type = (decision >> 2) & 3  # 0 = None, 1 = Zero, 2 = NaN
+        # NaN: missing_type None -> behandlas som 0.0, annars default-riktningen
+        self._nan_left = np.where(missing_type == 0, 0.0 <= self._threshold, default_left)
+        # missing_type Zero: |x| <= kZeroThreshold -> default-riktningen
+        self._zero_node = (missing_type == 1) & ~self._is_cat
+        self._default_left = default_left
+        self._has_zero = bool(self._zero_node.any())
+        self._has_cat = bool(self._is_cat.any())
+        if self._has_cat:
+            # Bitset -> uppslagstabell (kategorisk nod x kategorikod); sista kolumnen = NaN/negativt/okänd -> höger
+            cat_nodes = np.flatnonzero(self._is_cat)
+            self._cat_row = np.zeros(len(decision), dtype=np.int64)
+            self._cat_row[cat_nodes] = np.arange(len(cat_nodes))
+            cat_idx = self._threshold[cat_nodes].astype(np.int64)
+            start, end = a['cat_boundaries'][cat_idx], a['cat_boundaries'][cat_idx + 1]
+            self._n_codes = int((end - start).max()) * 32
+            codes = np.arange(self._n_codes)
+            words = codes >> 5
+            in_range = words[None, :] < (end - start)[:, None]
+            bits = a['cat_threshold'].astype(np.int64)[np.where(in_range, start[:, None] + words[None, :], 0)]
+            table = in_range & (((bits >> (codes & 31)[None, :]) & 1) == 1)
+            self._cat_table = np.column_stack([table, np.zeros(len(cat_nodes), dtype=bool)]).ravel()
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path, allow_pickle=False) as data:
+            return cls({k: data[k] for k in data.files})
+
+    def save(self, path: str):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **self.arrays)
+        os.replace(tmp_path, path)
+
+    def to_matrix(self, X) -> np.ndarray:
+        """ DataFrame -> float64-matris som LightGBM: kategorikolumner kodas mot pandas_categorical. """
+        if not isinstance(X, pd.DataFrame):
+            return np.asarray(X, dtype=np.float64)
+        data = np.empty((len(X), X.shape[1]), dtype=np.float64)
+        levels = iter(self.pandas_categorical or [])
+        for j, col in enumerate(X.columns):
+            values = X[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                col_levels = next(levels, None)
+                codes = values.cat.codes if col_levels is None else pd.Categorical(values, categories=col_levels).codes
+                data[:, j] = np.where(codes < 0, np.nan, codes)
+            else:
+                data[:, j] = values.to_numpy(dtype=np.float64, na_value=np.nan)
+        return data
+
+    def _categorical_left(self, f: np.ndarray, node: np.ndarray) -> np.ndarray:
+        """ int(f) i nodens bitset -> vänster; NaN, negativt och koder utanför bitsetet -> höger. """
+        with np.errstate(invalid='ignore'):
+            code = np.where((f >= 0) & (f < self._n_codes), f, self._n_codes).astype(np.int64)
+        return self._cat_table[self._cat_row[node] * (self._n_codes + 1) + code]
+
+    def predict(self, X) -> np.ndarray:
+        data = self.to_matrix(X)
+        n_rows, n_features = data.shape
+        n_trees = len(self._roots)
+        flat_data = data.ravel()
+        leaf = np.tile(self._roots, n_rows)
+        # Aktiva (rad, träd)-par. Par i ett löv stegar på stället (lövet pekar på sig själv)
+        # och plockas bort först när en fjärdedel av de aktiva är klara.
+        pos = np.arange(len(leaf))
+        node = leaf.copy()
+        offset = np.repeat(np.arange(n_rows, dtype=np.int64) * n_features, n_trees)
+        while len(pos):
+            done = node >= self._n_nodes
+            n_done = np.count_nonzero(done)
+            if n_done == len(node):
+                leaf[pos] = node
+                break
+            if n_done * 4 > len(node):
+                leaf[pos[done]] = node[done]
+                keep = ~done
+                pos, node, offset = pos[keep], node[keep], offset[keep]
+
+            f = flat_data[offset + self._feature[node]]
+            go_left = f <= self._threshold[node]
+            is_nan = np.isnan(f)
+            if is_nan.any():
+                go_left[is_nan] = self._nan_left[node[is_nan]]
+            if self._has_zero:
+                zero = self._zero_node[node] & (np.abs(f) <= _K_ZERO_THRESHOLD)
+                go_left[zero] = self._default_left[node[zero]]
+            if self._has_cat:
+                go_left = np.where(self._is_cat[node], self._categorical_left(f, node), go_left)
+            node = self._children[2 * node + ~go_left]
+
+        # Summa i trädordning (cumsum är sekventiell, som LightGBM)
+        leaf_values = self._values[leaf].reshape(n_rows, n_trees)
+        raw = np.cumsum(leaf_values, axis=1)[:, -1] if n_trees else np.zeros(n_rows)
+        if self.transform == 'exp':
+            return np.array([math.exp(v) for v in raw])
+        return raw
+
+def compiled_model_path(name: str, version: str = None):
+    path = registered_model_path(name, version)
+    return None if path is None else os.path.splitext(path)[0] + COMPILED_SUFFIX
+
+def compile_registered_model(model_file: str) -> CompiledTreeModel:
+    """ Kompilerar en registerad modellfil (.txt) och sparar arrayerna bredvid (.npz). """
+    with open(model_file, 'r', encoding='utf-8') as f:
+        model = CompiledTreeModel(compile_model_text(f.read()))
+    model.save(os.path.splitext(model_file)[0] + COMPILED_SUFFIX)
+    return model
+
+def load_compiled_model(name: str, version: str = None):
+    """
+    Som load_registered_model men med den kompilerade prediktorn (importerar inte LightGBM).
+    Returnerar None om versionen saknar en kompilerad modell.
+    """
+    manifest = read_model_manifest(version)
+    if manifest is None or name not in manifest['models'] or not manifest['models'][name].get('compiled'):
+        return None
+    entry = manifest['models'][name]
+    path = os.path.join(_registry_versions_dir(), manifest['version'], entry['compiled'])
+    if not os.path.exists(path):
+        return None
+    return {
+        'model': CompiledTreeModel.load(path),
+        'features': entry['features'],
+        'categorical_features': entry['categorical_features'],
+        'cat_dtypes': {c: pd.CategoricalDtype(pd.Index(levels, dtype=entry.get('category_types', {}).get(c)))
+                       for c, levels in entry['categories'].items()},
+        'version': manifest['version'],
+    }